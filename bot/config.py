@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings
 from pydantic import Field, field_validator
-from functools import lru_cache
+from typing import Optional
+import asyncio
 import os
 
 
@@ -23,32 +24,196 @@ class Settings(BaseSettings):
     # Backend
     backend_url: str = Field(default="")
     mini_app_url: str = Field(default="")
+    
+    # Токен доступа к /stats (заголовок X-Stats-Token); пустой - endpoint отключен
+    stats_token: str = Field(default="")
+    
+    # Общий HTTP-клиент для скачивания файлов из Telegram
+    http_pool_limit: int = Field(default=100)
+    http_pool_limit_per_host: int = Field(default=32)
+    http_download_timeout: int = Field(default=60)
+    
+    # Анимация статусных сообщений: общий лимит edit_text в секунду и интервал в одном чате
+    progress_edits_per_second: int = Field(default=20)
+    progress_chat_edit_interval: float = Field(default=2.0)
+    
+    # Хранилище FSM: firestore (общее для всех инстансов) или memory (локальный запуск);
+    # локальный кэш чтений с TTL и лимитом ключей, окно объединения записей,
+    # срок хранения документа состояния (поле expires_at для TTL-политики),
+    # повторы неудачной записи с экспоненциальной паузой
+    fsm_storage: str = Field(default="firestore")
+    fsm_cache_ttl_seconds: float = Field(default=5.0)
+    fsm_cache_max_entries: int = Field(default=10000)
+    fsm_flush_delay_seconds: float = Field(default=0.05)
+    fsm_flush_retries: int = Field(default=3)
+    fsm_flush_backoff_seconds: float = Field(default=0.5)
+    fsm_state_ttl_days: int = Field(default=30)
+    
+    # Фоновая обработка апдейтов webhook: воркеры и длина очереди по полосам
+    # (interactive - колбэки и команды, heavy - фото), ожидание очередей при остановке
+    updates_interactive_workers: int = Field(default=16)
+    updates_interactive_queue: int = Field(default=1000)
+    updates_heavy_workers: int = Field(default=8)
+    updates_heavy_queue: int = Field(default=200)
+    updates_drain_seconds: float = Field(default=8.0)
+    # Отсев повторно доставленных апдейтов: локальный LRU по update_id и отметка
+    # в Firestore (processed_updates, поле expires_at для TTL-политики) между инстансами
+    updates_dedup_enabled: bool = Field(default=True)
+    updates_dedup_shared: bool = Field(default=True)
+    updates_dedup_local_size: int = Field(default=10000)
+    updates_dedup_ttl_seconds: int = Field(default=3600)
+    
+    # Generation queue; sweep_seconds - как часто подбирать задачи с истёкшей арендой,
+    # max_attempts - сколько раз задачу можно захватить, прежде чем закрыть её с возвратом энергии
+    generation_workers: int = Field(default=8)
+    generation_sweep_seconds: float = Field(default=60.0)
+    generation_max_attempts: int = Field(default=3)
+    
+    # Общий срок генерации (от получения фото до отправки результата), сек;
+    # готовый результат отправляется не меньше upload_min_seconds даже после срока
+    generation_deadline_seconds: float = Field(default=150.0)
+    generation_upload_min_seconds: float = Field(default=20.0)
+    
+    # Режим нескольких вариантов: сколько генераций одного пользователя идут одновременно
+    variants_per_user_concurrency: int = Field(default=2)
+    
+    # Vertex AI: способ вызова модели (thread - пул потоков, async - generate_content_async)
+    vertex_backend: str = Field(default="thread")
+    
+    # Vertex AI: пулы потоков и лимиты параллельных вызовов по режимам
+    # (при vertex_backend=async пулы не используются, лимиты можно поднять до сотен)
+    vertex_normal_workers: int = Field(default=16)
+    vertex_normal_concurrency: int = Field(default=16)
+    vertex_pro_workers: int = Field(default=8)
+    vertex_pro_concurrency: int = Field(default=8)
+    
+    # Vertex AI: регионы-кандидаты normal-режима (через запятую) и доля запросов
+    # в случайный регион для обновления статистики. По умолчанию - только текущий регион;
+    # дополнительные (например, VERTEX_NORMAL_LOCATIONS=europe-west4,europe-west1) включаются
+    # явно в окружении деплоя с учётом размещения данных, квот и задержек
+    vertex_normal_locations: str = Field(default="europe-west4")
+    vertex_route_exploration: float = Field(default=0.05)
+    
+    # Vertex AI: квота на стороне клиента (token bucket на модель в каждом регионе, общий
+    # для процесса); запрос ждёт квоту в очереди не дольше quota_wait_seconds, затем энергия
+    # возвращается. Лимиты - региональная квота проекта из консоли GCP (0 - без ограничения),
+    # поэтому регулятор включается явно вместе с ними
+    vertex_quota_enabled: bool = Field(default=False)
+    vertex_normal_rpm: int = Field(default=300)
+    vertex_normal_tpm: int = Field(default=1_000_000)
+    vertex_pro_rpm: int = Field(default=60)
+    vertex_pro_tpm: int = Field(default=400_000)
+    vertex_quota_wait_seconds: float = Field(default=60.0)
+    
+    # Vertex AI: хеджирование - второй запрос, если первый не ответил за перцентиль
+    # недавних задержек модели; budget - максимальная доля хеджированных вызовов
+    vertex_hedge_enabled: bool = Field(default=False)
+    vertex_hedge_percentile: float = Field(default=0.95)
+    vertex_hedge_budget: float = Field(default=0.1)
+    
+    # Vertex AI: предохранитель на (модель, location) - открывается при доле ошибок
+    # или медленных (дольше slow_seconds) вызовов, пробный запрос через open_seconds
+    vertex_breaker_enabled: bool = Field(default=True)
+    vertex_breaker_error_rate: float = Field(default=0.5)
+    vertex_breaker_slow_seconds: float = Field(default=60.0)
+    vertex_breaker_open_seconds: float = Field(default=15.0)
+    
+    # Vertex AI: context caching промптов стилей - модели с поддержкой кэша (через запятую),
+    # минимальный размер промпта в токенах и TTL кэша; модели генерации изображений
+    # кэш пока не поддерживают, поэтому по умолчанию список пуст
+    vertex_context_cache_models: str = Field(default="")
+    vertex_context_cache_min_tokens: int = Field(default=1024)
+    vertex_context_cache_ttl_seconds: int = Field(default=3600)
+    
+    # Кэш результатов генерации (0 / пустая строка - уровень отключен)
+    result_cache_memory_mb: int = Field(default=64)
+    result_cache_dir: str = Field(default="")
+    result_cache_disk_mb: int = Field(default=512)
+    result_cache_ttl: int = Field(default=24 * 3600)
+    
+    # Пул процессов для обработки изображений (Pillow)
+    image_process_workers: int = Field(default=2)
+    
+    # Подготовка входного фото: длинная сторона по режимам и лимит размера JPEG
+    photo_ingest_enabled: bool = Field(default=True)
+    photo_target_side_normal: int = Field(default=1024)
+    photo_target_side_pro: int = Field(default=1536)
+    photo_max_bytes: int = Field(default=1024 * 1024)
+    
+    # Проверка качества фото до списания энергии: минимальная короткая сторона,
+    # максимальные пропорции, допустимая средняя яркость, доля провалов/пересветов
+    # и минимальная резкость (дисперсия лапласиана на копии 512px)
+    photo_quality_enabled: bool = Field(default=True)
+    photo_quality_min_side: int = Field(default=256)
+    photo_quality_max_aspect_ratio: float = Field(default=2.0)
+    photo_quality_min_brightness: float = Field(default=25.0)
+    photo_quality_max_brightness: float = Field(default=235.0)
+    photo_quality_max_clipped_fraction: float = Field(default=0.6)
+    photo_quality_min_sharpness: float = Field(default=8.0)
+    
+    # Перекодирование результата перед отправкой в Telegram (JPEG или WEBP)
+    result_output_format: str = Field(default="JPEG")
+    result_max_side: int = Field(default=2560)
+    result_max_bytes: int = Field(default=5 * 1024 * 1024)
+
+    # Ожидаемый максимум чтений данных пользователя из Firestore на апдейт (пользователь,
+    # pending selection, транзакция списания); превышение логируется и считается в /stats,
+    # 0 - не проверять
+    user_context_read_budget: int = Field(default=3)
+
+
+_settings: Optional[Settings] = None
+
+
+def _resolve_bot_token(settings: Settings):
+    """If bot_token is empty, try to get from Secret Manager (blocking call)"""
+    if settings.bot_token:
+        return
+    try:
+        from bot.secrets import get_bot_token
+        object.__setattr__(settings, 'bot_token', get_bot_token())
+    except Exception as e:
+        print(f"Warning: Could not get bot token from Secret Manager: {e}")
+
+
+def _resolve_gcp_config(settings: Settings):
+    """If gcp_project_id is empty, try to detect it from the metadata server (blocking call)"""
+    if settings.gcp_project_id:
+        return
+    try:
+        from bot.secrets import get_gcp_config
+        config = get_gcp_config()
+        object.__setattr__(settings, 'gcp_project_id', config["project_id"])
+        object.__setattr__(settings, 'gcp_location', config["location"])
+    except Exception as e:
+        print(f"Warning: Could not get GCP config: {e}")
 
 
-@lru_cache()
 def get_settings() -> Settings:
     """
     Get settings from environment variables or Secret Manager.
     In Cloud Run, secrets come from mounted volumes or Secret Manager API.
     """
-    settings = Settings()
-    
-    # If bot_token is empty, try to get from Secret Manager
-    if not settings.bot_token:
-        try:
-            from bot.secrets import get_bot_token
-            object.__setattr__(settings, 'bot_token', get_bot_token())
-        except Exception as e:
-            print(f"Warning: Could not get bot token from Secret Manager: {e}")
-    
-    # If gcp_project_id is empty, try to detect it
-    if not settings.gcp_project_id:
-        try:
-            from bot.secrets import get_gcp_config
-            config = get_gcp_config()
-            object.__setattr__(settings, 'gcp_project_id', config["project_id"])
-            object.__setattr__(settings, 'gcp_location', config["location"])
-        except Exception as e:
-            print(f"Warning: Could not get GCP config: {e}")
-    
-    return settings
+    global _settings
+    if _settings is None:
+        settings = Settings()
+        _resolve_bot_token(settings)
+        _resolve_gcp_config(settings)
+        _settings = settings
+    return _settings
+
+
+async def load_settings() -> Settings:
+    """
+    Same as get_settings, for startup: Secret Manager and the metadata server
+    are queried concurrently in threads, without blocking the event loop.
+    """
+    global _settings
+    if _settings is None:
+        settings = Settings()
+        await asyncio.gather(
+            asyncio.to_thread(_resolve_bot_token, settings),
+            asyncio.to_thread(_resolve_gcp_config, settings)
+        )
+        _settings = settings
+    return _settings
@@ -1,10 +1,15 @@
 """
 Firestore client for bot - minimal operations for pending style selections
 """
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 from google.cloud.firestore_v1 import AsyncClient
-from typing import Optional, Dict, Any
-from datetime import datetime
+from google.cloud.firestore_v1 import _helpers as firestore_helpers
+from typing import Optional, Dict, Any, Iterator, List
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,10 +26,38 @@ def get_db() -> AsyncClient:
     return _db
 
 
+# Счётчики чтений документов по коллекциям в текущем контексте (апдейт и созданные из него задачи);
+# вложенные track_reads учитывают чтение во всех открытых счётчиках
+_read_counters: ContextVar[tuple] = ContextVar("firestore_reads", default=())
+
+
+@contextmanager
+def track_reads() -> Iterator[Counter]:
+    """
+    Считать чтения Firestore внутри блока:
+        with track_reads() as reads:
+            await dp.feed_update(bot, update)
+        assert sum(reads.values()) <= 3
+    """
+    counter: Counter = Counter()
+    token = _read_counters.set(_read_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _read_counters.reset(token)
+
+
+def record_read(collection: str):
+    """Учесть чтение документа коллекции (вне track_reads - ничего не делает)"""
+    for counter in _read_counters.get():
+        counter[collection] += 1
+
+
 async def get_pending_style_selection(telegram_id: int) -> Optional[Dict[str, Any]]:
     """Get pending style selection for a user"""
     try:
         db = get_db()
+        record_read("pending_selections")
         doc = await db.collection("pending_selections").document(str(telegram_id)).get()
         
         if doc.exists:
@@ -35,12 +68,20 @@ async def get_pending_style_selection(telegram_id: int) -> Optional[Dict[str, An
         return None
 
 
-async def clear_pending_style_selection(telegram_id: int) -> bool:
-    """Clear pending style selection for a user"""
+async def clear_pending_style_selection(telegram_id: int, known_exists: bool = False) -> bool:
+    """
+    Clear pending style selection for a user
+    known_exists - документ уже прочитан вызывающим, удаляем без повторного чтения
+    """
     try:
         db = get_db()
         doc_ref = db.collection("pending_selections").document(str(telegram_id))
         
+        if known_exists:
+            await doc_ref.delete()
+            return True
+        
+        record_read("pending_selections")
         doc = await doc_ref.get()
         if doc.exists:
             await doc_ref.delete()
@@ -57,6 +98,7 @@ async def get_user(telegram_id: int) -> Optional[Dict[str, Any]]:
     """Get user by telegram_id"""
     try:
         db = get_db()
+        record_read("users")
         doc = await db.collection("users").document(str(telegram_id)).get()
         if doc.exists:
             data = doc.to_dict()
@@ -80,6 +122,7 @@ async def update_user_balance(telegram_id: int, amount: int) -> Optional[Dict[st
         # Use transaction for atomic update
         @firestore.async_transactional
         async def update_in_transaction(transaction, doc_ref):
+            record_read("users")
             doc = await doc_ref.get(transaction=transaction)
             if not doc.exists:
                 return None
@@ -117,6 +160,7 @@ async def deduct_energy(telegram_id: int, amount: int) -> Optional[Dict[str, Any
         
         @firestore.async_transactional
         async def deduct_in_transaction(transaction, doc_ref):
+            record_read("users")
             doc = await doc_ref.get(transaction=transaction)
             if not doc.exists:
                 return None
@@ -140,61 +184,65 @@ async def deduct_energy(telegram_id: int, amount: int) -> Optional[Dict[str, Any
         return None
 
 
-async def increment_successful_generations(telegram_id: int) -> Optional[int]:
-    """
-    Атомарное увеличение счётчика успешных генераций
-    Returns new count or None on error
-    """
-    try:
-        db = get_db()
-        doc_ref = db.collection("users").document(str(telegram_id))
-        
-        @firestore.async_transactional
-        async def increment_in_transaction(transaction, doc_ref):
-            doc = await doc_ref.get(transaction=transaction)
-            if not doc.exists:
-                return None
-            
-            current_count = doc.get("successful_generations") or 0
-            new_count = current_count + 1
-            transaction.update(doc_ref, {"successful_generations": new_count})
-            return new_count
-        
-        transaction = db.transaction()
-        return await increment_in_transaction(transaction, doc_ref)
-    except Exception as e:
-        logger.error(f"Error incrementing successful_generations: {e}")
-        return None
-
-
-async def set_user_flag(telegram_id: int, flag_name: str, value: bool) -> bool:
+async def set_user_timestamp(telegram_id: int, field: str, value: datetime) -> bool:
     """
-    Установить флаг пользователя (например m9_shown, m7_1_sent и т.д.)
+    Установить timestamp поля пользователя (например started_at, template_selected_at и т.д.)
     Returns True on success, False on error
     """
     try:
         db = get_db()
         doc_ref = db.collection("users").document(str(telegram_id))
-        await doc_ref.update({flag_name: value})
+        await doc_ref.update({field: value})
         return True
     except Exception as e:
-        logger.error(f"Error setting user flag {flag_name}: {e}")
+        logger.error(f"Error setting user timestamp {field}: {e}")
         return False
 
 
-async def set_user_timestamp(telegram_id: int, field: str, value: datetime) -> bool:
+async def apply_user_bookkeeping(
+    telegram_id: int,
+    increments: Optional[Dict[str, int]] = None,
+    fields: Optional[Dict[str, Any]] = None,
+    generation_id: Optional[str] = None,
+    generation_fields: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, int]]:
     """
-    Установить timestamp поля пользователя (например started_at, template_selected_at и т.д.)
-    Returns True on success, False on error
+    Применить изменения пользователя одной атомарной batch-записью:
+    счётчики (successful_generations, balance) - серверным Increment,
+    флаги и timestamps - значениями, плюс (опционально) статус задачи генерации бота.
+    
+    Returns новые значения счётчиков {field: value} или None при ошибке
     """
     try:
         db = get_db()
-        doc_ref = db.collection("users").document(str(telegram_id))
-        await doc_ref.update({field: value})
-        return True
+        increments = increments or {}
+        
+        user_update = dict(fields or {})
+        for field, delta in increments.items():
+            user_update[field] = firestore.Increment(delta)
+        
+        batch = db.batch()
+        user_ref = db.collection("users").document(str(telegram_id))
+        batch.update(user_ref, user_update)
+        if generation_id:
+            generation_ref = db.collection(GENERATION_JOBS_COLLECTION).document(generation_id)
+            batch.update(generation_ref, {
+                **(generation_fields or {}),
+                "updated_at": datetime.utcnow()
+            })
+        
+        results = await batch.commit()
+        
+        # Результаты Increment возвращаются в порядке путей полей
+        transform_results = list(results[0].transform_results)
+        counters = {}
+        if len(transform_results) == len(increments):
+            for field, value in zip(sorted(increments), transform_results):
+                counters[field] = firestore_helpers.decode_value(value, db)
+        return counters
     except Exception as e:
-        logger.error(f"Error setting user timestamp {field}: {e}")
-        return False
+        logger.error(f"Error applying bookkeeping for user {telegram_id}: {e}")
+        return None
 
 
 async def ensure_user_exists(telegram_id: int, username: Optional[str] = None) -> Dict[str, Any]:
@@ -205,6 +253,7 @@ async def ensure_user_exists(telegram_id: int, username: Optional[str] = None) -
     try:
         db = get_db()
         doc_ref = db.collection("users").document(str(telegram_id))
+        record_read("users")
         doc = await doc_ref.get()
         
         if doc.exists:
@@ -244,3 +293,221 @@ async def ensure_user_exists(telegram_id: int, username: Optional[str] = None) -
     except Exception as e:
         logger.error(f"Error ensuring user exists: {e}")
         return None
+
+
+# ==================== Generation Jobs ====================
+
+# Задачи генерации бота хранятся в своей коллекции: в generations пишет backend
+# (/api/generate), и бот не должен ни подбирать, ни менять его записи.
+# Статусы задачи: pending -> processing -> completed | failed
+GENERATION_JOBS_COLLECTION = "bot_generation_jobs"
+GENERATION_ACTIVE_STATUSES = ["pending", "processing"]
+
+
+async def create_generation_job(
+    job: Dict[str, Any],
+    owner: Optional[str] = None,
+    lease_seconds: int = 0
+) -> Optional[str]:
+    """
+    Создать запись генерации в статусе pending
+    owner - инстанс, поставивший задачу в свою локальную очередь: пока не истекла
+    аренда lease_seconds, другие инстансы задачу не подбирают и не захватывают
+    Returns id документа или None при ошибке
+    """
+    try:
+        db = get_db()
+        now = datetime.now(timezone.utc)
+        generation_data = {
+            **job,
+            "user_id": str(job["telegram_id"]),
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now,
+        }
+        if owner:
+            generation_data["worker_id"] = owner
+            generation_data["lease_expires_at"] = now + timedelta(seconds=lease_seconds)
+        _, doc_ref = await db.collection(GENERATION_JOBS_COLLECTION).add(generation_data)
+        return doc_ref.id
+    except Exception as e:
+        logger.error(f"Error creating generation job: {e}")
+        return None
+
+
+async def claim_generation_job(
+    job_id: str,
+    worker_id: str,
+    lease_seconds: int,
+    max_attempts: int = 0,
+    instance_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Атомарно захватить задачу генерации воркером (pending -> processing).
+    Задачу в processing можно перехватить только после истечения lease
+    (инстанс, который её обрабатывал, упал или был остановлен). Так же pending-задачу
+    из локальной очереди другого инстанса (create_generation_job с owner) захватывает
+    только этот инстанс (instance_id), пока не истекла его аренда.
+    Задача, захваченная уже max_attempts раз (например, роняет инстанс), вместо
+    повторного запуска закрывается как failed - её возвращают со status "failed",
+    и вызвавший отвечает за возврат энергии (0 - без ограничения).
+    Returns данные задачи или None, если задача уже занята/завершена
+    """
+    try:
+        db = get_db()
+        doc_ref = db.collection(GENERATION_JOBS_COLLECTION).document(job_id)
+        
+        @firestore.async_transactional
+        async def claim_in_transaction(transaction, doc_ref):
+            doc = await doc_ref.get(transaction=transaction)
+            if not doc.exists:
+                return None
+            
+            data = doc.to_dict()
+            status = data.get("status")
+            now = datetime.now(timezone.utc)
+            
+            if status not in GENERATION_ACTIVE_STATUSES:
+                return None
+            lease_expires_at = data.get("lease_expires_at")
+            if lease_expires_at and lease_expires_at > now:
+                if status == "processing":
+                    return None  # Задача в работе у другого воркера
+                if data.get("worker_id") != instance_id:
+                    return None  # Задача ждёт в очереди другого инстанса
+            
+            attempts = data.get("attempts") or 0
+            if max_attempts and attempts >= max_attempts:
+                transaction.update(doc_ref, {
+                    "status": "failed",
+                    "error": f"gave up after {attempts} attempts",
+                    "worker_id": worker_id,
+                    "lease_expires_at": None,
+                    "updated_at": now,
+                })
+                data["status"] = "failed"
+                data["id"] = doc.id
+                return data
+            
+            attempts += 1
+            transaction.update(doc_ref, {
+                "status": "processing",
+                "worker_id": worker_id,
+                "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                "attempts": attempts,
+                "updated_at": now,
+            })
+            
+            data["status"] = "processing"
+            data["attempts"] = attempts
+            data["id"] = doc.id
+            return data
+        
+        transaction = db.transaction()
+        return await claim_in_transaction(transaction, doc_ref)
+    except Exception as e:
+        logger.error(f"Error claiming generation job {job_id}: {e}")
+        return None
+
+
+async def release_generation_job(job_id: str, worker_id: str) -> Optional[bool]:
+    """
+    Вернуть захваченную задачу в pending (воркер остановлен, не закончив её).
+    Прерванная попытка не засчитывается в attempts - задача не виновата в остановке.
+    Так же снимается аренда pending-задачи, ждущей в очереди инстанса worker_id.
+    Задача, уже завершённая или перехваченная другим воркером, не меняется.
+    Returns True - возвращена, False - не наша или уже не в работе, None при ошибке
+    """
+    try:
+        db = get_db()
+        doc_ref = db.collection(GENERATION_JOBS_COLLECTION).document(job_id)
+        
+        @firestore.async_transactional
+        async def release_in_transaction(transaction, doc_ref):
+            doc = await doc_ref.get(transaction=transaction)
+            if not doc.exists:
+                return False
+            data = doc.to_dict()
+            status = data.get("status")
+            if status not in GENERATION_ACTIVE_STATUSES or data.get("worker_id") != worker_id:
+                return False
+            fields = {
+                "status": "pending",
+                "worker_id": None,
+                "lease_expires_at": None,
+                "updated_at": datetime.now(timezone.utc),
+            }
+            if status == "processing":
+                fields["attempts"] = max((data.get("attempts") or 0) - 1, 0)
+            transaction.update(doc_ref, fields)
+            return True
+        
+        transaction = db.transaction()
+        return await release_in_transaction(transaction, doc_ref)
+    except Exception as e:
+        logger.error(f"Error releasing generation job {job_id}: {e}")
+        return None
+
+
+async def update_generation_job(job_id: str, fields: Dict[str, Any]) -> bool:
+    """
+    Обновить поля задачи генерации (status, error и т.д.)
+    Returns True on success, False on error
+    """
+    try:
+        db = get_db()
+        doc_ref = db.collection(GENERATION_JOBS_COLLECTION).document(job_id)
+        await doc_ref.update({**fields, "updated_at": datetime.utcnow()})
+        return True
+    except Exception as e:
+        logger.error(f"Error updating generation job {job_id}: {e}")
+        return False
+
+
+async def list_active_generation_jobs(limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    Получить незавершённые задачи генерации (для восстановления после рестарта)
+    """
+    try:
+        db = get_db()
+        query = (
+            db.collection(GENERATION_JOBS_COLLECTION)
+            .where("status", "in", GENERATION_ACTIVE_STATUSES)
+            .limit(limit)
+        )
+        docs = await query.get()
+        
+        jobs = []
+        for doc in docs:
+            data = doc.to_dict()
+            data["id"] = doc.id
+            jobs.append(data)
+        return jobs
+    except Exception as e:
+        logger.error(f"Error listing active generation jobs: {e}")
+        return []
+
+
+# ==================== Update De-duplication ====================
+
+async def claim_update(update_id: int, instance_id: str, ttl_seconds: int) -> Optional[bool]:
+    """
+    Атомарно занять update_id для обработки (create падает, если документ уже есть)
+    Returns True - апдейт наш, False - уже обработан другим инстансом, None при ошибке
+    """
+    try:
+        db = get_db()
+        now = datetime.utcnow()
+        await db.collection("processed_updates").document(str(update_id)).create({
+            "instance": instance_id,
+            "created_at": now,
+            # Поле для TTL-политики Firestore
+            "expires_at": now + timedelta(seconds=ttl_seconds),
+        })
+        return True
+    except AlreadyExists:
+        return False
+    except Exception as e:
+        logger.error(f"Error claiming update {update_id}: {e}")
+        return None
@@ -5,7 +5,7 @@ import logging
 
 from bot.keyboards import kb_balance, kb_menu
 from bot.messages import m13_main_menu, m14_balance
-from bot.firestore import get_user
+from bot.middlewares import UserContext
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -66,14 +66,14 @@ async def handle_buy_downsell(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "show_menu")
-async def handle_show_menu(callback: CallbackQuery):
+async def handle_show_menu(callback: CallbackQuery, user_context: UserContext):
     """Обработчик кнопки "Главное меню" - показывает m13"""
     await callback.answer()
     
     telegram_id = callback.from_user.id
     
     # Получаем данные пользователя
-    user = await get_user(telegram_id)
+    user = await user_context.get_user()
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Используйте /start")
         return
@@ -92,7 +92,7 @@ async def handle_show_menu(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("show_balance:"))
-async def handle_show_balance(callback: CallbackQuery):
+async def handle_show_balance(callback: CallbackQuery, user_context: UserContext):
     """Обработчик кнопки "Пополнить баланс" - показывает m14"""
     await callback.answer()
     
@@ -100,7 +100,7 @@ async def handle_show_balance(callback: CallbackQuery):
     back_target = callback.data.split(":", 1)[1]
     
     # Получаем данные пользователя
-    user = await get_user(telegram_id)
+    user = await user_context.get_user()
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Используйте /start")
         return
@@ -119,14 +119,14 @@ async def handle_show_balance(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("back:"))
-async def handle_back(callback: CallbackQuery):
+async def handle_back(callback: CallbackQuery, user_context: UserContext):
     """Обработчик кнопки "Назад" - возвращает к предыдущему экрану"""
     await callback.answer()
     
     telegram_id = callback.from_user.id
     target = callback.data.split(":", 1)[1]
     
-    user = await get_user(telegram_id)
+    user = await user_context.get_user()
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Используйте /start")
         return
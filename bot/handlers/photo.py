@@ -1,9 +1,10 @@
-from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram import Router, F, Bot
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
-import aiohttp
 import asyncio
 import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
 
 from bot.states import UserState
 from bot.keyboards import (
@@ -14,7 +15,8 @@ from bot.keyboards import (
     kb_starter_pack,
     kb_insufficient,
     kb_config_normal,
-    kb_config_pro
+    kb_config_pro,
+    VARIANT_OPTIONS
 )
 from bot.messages import (
     m6_generating,
@@ -25,20 +27,28 @@ from bot.messages import (
     m9_starter_pack,
     m11_insufficient_energy,
     m4_1_config_normal,
-    m4_2_config_pro
+    m4_2_config_pro,
+    variants_failed_note,
+    generation_failed,
+    photo_rejected
 )
-from bot.services.vertex_ai import get_vertex_service
+from bot.services.generation_queue import get_generation_queue
+from bot.services.photo_ingest import IngestedPhoto, get_photo_ingestor
+from bot.services.photo_quality import get_photo_quality_gate
+from bot.services.photo_postprocess import get_result_postprocessor
+from bot.services.http_client import get_telegram_file_client
+from bot.services.progress import get_progress_scheduler
+from bot.services.pipeline import StageTimings
+from bot.services.generation_trace import GenerationOutcome, GenerationTrace
+from bot.services.deadline import Deadline, DeadlineExceeded
 from bot.config import get_settings
 from bot.firestore import (
-    get_pending_style_selection,
-    clear_pending_style_selection,
     deduct_energy,
     update_user_balance,
-    get_user,
-    increment_successful_generations,
-    set_user_flag,
-    set_user_timestamp
+    apply_user_bookkeeping,
+    update_generation_job
 )
+from bot.middlewares import UserContext
 from datetime import datetime
 
 router = Router()
@@ -47,25 +57,82 @@ logger = logging.getLogger(__name__)
 # Moon phase emoji for m6 animation (Plan 2)
 MOON_PHASES = "🌑🌘🌗🌖🌕🌔🌓🌒"
 
+# Флаги отправки m7.x по номеру успешной генерации
+M7_FLAGS = {1: "m7_1_sent", 2: "m7_2_sent", 3: "m7_3_sent"}
 
-async def animate_moon_emoji(message: Message, stop_event: asyncio.Event):
+
+def render_moon_progress(step: int, queue_position: int = 0) -> str:
     """
-    Анимация смены фаз луны в сообщении m6 (Plan 2)
-    Цикл выполняется пока stop_event не установлен
+    Кадр анимации смены фаз луны в сообщении m6 (Plan 2)
+    Обновлением сообщения управляет общий планировщик (bot.services.progress)
     """
-    i = 0
-    base_text = "Генерируем ваше фото…\n\n⏱️ Будет готово через 10–30 секунд"
-    
-    while not stop_event.is_set():
-        phase = MOON_PHASES[i % len(MOON_PHASES)]
-        try:
-            await message.edit_text(f"{phase} {base_text}", parse_mode="HTML")
-        except Exception as e:
-            # Игнорируем ошибки редактирования (например, если сообщение уже удалено)
-            logger.debug(f"Moon animation edit error: {e}")
-            break
-        i += 1
-        await asyncio.sleep(1)
+    phase = MOON_PHASES[step % len(MOON_PHASES)]
+    if queue_position:
+        # Квота модели исчерпана - запрос ждёт своей очереди
+        return f"{phase} Генерируем ваше фото…\n\n⏳ Много желающих, вы в очереди: {queue_position}"
+    return f"{phase} Генерируем ваше фото…\n\n⏱️ Будет готово через 10–30 секунд"
+
+
+def render_generation_progress(trace: GenerationTrace):
+    """Кадры анимации m6 с местом в очереди за квотой модели"""
+    def render(step: int) -> str:
+        return render_moon_progress(step, trace.queue_position)
+    return render
+
+
+def render_variants_progress(done: List[int], total: int, trace: GenerationTrace):
+    """Кадры анимации m6 для генерации нескольких вариантов: фаза луны + сколько уже готово"""
+    def render(step: int) -> str:
+        phase = MOON_PHASES[step % len(MOON_PHASES)]
+        queue = f"⏳ Много желающих, вы в очереди: {trace.queue_position}\n" if trace.queue_position else ""
+        return (
+            f"{phase} Генерируем варианты…\n\n"
+            f"Готово: {done[0]} из {total}\n"
+            f"{queue}"
+            "⏱️ Будет готово через 20–60 секунд"
+        )
+    return render
+
+
+def result_message(
+    flag: Optional[str],
+    style_name: str,
+    balance: int,
+    style_id: str,
+    job_id: str
+):
+    """Текст и клавиатура результата по флагу m7.x (None - m8)"""
+    if flag == "m7_1_sent":
+        # m7.1: первая генерация
+        return m7_1_result_first(style_name, balance), kb_result_m71(style_id, job_id)
+    if flag == "m7_2_sent":
+        # m7.2: вторая генерация
+        return m7_2_result_second(style_name, balance), kb_result_m72(style_id, job_id)
+    if flag == "m7_3_sent":
+        # m7.3: третья генерация
+        return m7_3_result_third(style_name, balance), kb_result_m73(style_id, job_id)
+    # m8: обычный результат
+    return m8_result_regular(style_name, balance), kb_result_m8(style_id, job_id)
+
+
+# Лимит одновременных генераций вариантов на пользователя: telegram_id -> [семафор, кол-во задач]
+_user_variant_slots: Dict[int, List[Any]] = {}
+
+
+@asynccontextmanager
+async def user_variant_slots(telegram_id: int):
+    """Общий семафор генераций всех задач пользователя в режиме вариантов"""
+    entry = _user_variant_slots.get(telegram_id)
+    if entry is None:
+        limit = get_settings_instance().variants_per_user_concurrency
+        entry = _user_variant_slots[telegram_id] = [asyncio.Semaphore(limit), 0]
+    entry[1] += 1
+    try:
+        yield entry[0]
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _user_variant_slots.pop(telegram_id, None)
 
 
 def get_settings_instance():
@@ -75,246 +142,745 @@ def get_settings_instance():
 
 def get_ai_service():
     """Get Vertex AI service instance"""
+    # vertexai импортируется при первой генерации, а не при старте бота
+    from bot.services.vertex_ai import get_vertex_service
     settings = get_settings_instance()
     return get_vertex_service(
         project_id=settings.gcp_project_id
     )
 
 
+async def cancel_task(task: Optional[asyncio.Task]):
+    """Отменить фоновый этап, который больше не нужен"""
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
 @router.message(UserState.awaiting_photo, F.photo)
-async def handle_photo(message: Message, state: FSMContext):
-    """Обработчик фото в состоянии ожидания"""
-    telegram_id = message.from_user.id
-    
-    # Получаем данные из состояния
-    data = await state.get_data()
-    style_id = data.get("style_id")
-    style_name = data.get("style_name")
-    mode = data.get("mode", "normal")
-    
-    if not style_id:
-        await message.answer("❌ Не выбран стиль. Пожалуйста, сначала выберите стиль.")
-        await state.set_state(UserState.idle)
-        return
-    
-    # Рассчитываем стоимость: PRO = 6 энергии, normal = 1
-    cost = 6 if mode == "pro" else 1
-    
-    # Проверяем баланс пользователя
-    user = await get_user(telegram_id)
-    if not user:
-        await message.answer("❌ Пользователь не найден. Используйте /start для регистрации.")
-        await state.set_state(UserState.idle)
-        return
+async def handle_photo(message: Message, state: FSMContext, user_context: UserContext):
+    """
+    Обработчик фото в состоянии ожидания.
+    Списывает энергию и ставит задачу генерации в очередь - сама генерация
+    и доставка результата выполняются воркерами (process_generation_job).
     
-    current_balance = user.get("balance", 0)
-    successful_generations = user.get("successful_generations", 0)
-    is_new_user = user.get("is_new_user", True)
-    m9_shown = user.get("m9_shown", False)
-    
-    # Проверка недостаточного баланса
-    if current_balance < cost:
-        # m9 или m11
-        if is_new_user and successful_generations >= 1 and not m9_shown:
-            # Отправляем m9: стартер-пак
+    Граф этапов:
+        download (getFile + скачивание) -> quality ─┐
+        user (user_context) ────────────────────────┴-> deduct ∥ status (m6) -> enqueue(download)
+    """
+    telegram_id = message.from_user.id
+    timings = StageTimings("photo_handler")
+    try:
+        # Срок генерации отсчитывается с момента получения фото
+        deadline = Deadline(get_settings_instance().generation_deadline_seconds)
+        
+        # Получаем данные из состояния
+        data = await state.get_data()
+        style_id = data.get("style_id")
+        style_name = data.get("style_name")
+        mode = data.get("mode", "normal")
+        
+        if not style_id:
+            await message.answer("❌ Не выбран стиль. Пожалуйста, сначала выберите стиль.")
+            await state.set_state(UserState.idle)
+            return
+        
+        # Берём наименьший размер фото, достаточный для модели режима,
+        # и сразу начинаем его скачивать - параллельно с проверкой баланса
+        photo = get_photo_ingestor().select_size(message.photo, mode)
+        download_task = timings.start(
+            "download",
+            get_telegram_file_client().download_by_file_id(message.bot, photo.file_id)
+        )
+        
+        # Рассчитываем стоимость: PRO = 6 энергии, normal = 1 (за каждый вариант)
+        variants = data.get("variants", 1)
+        if variants not in VARIANT_OPTIONS:
+            variants = 1
+        unit_cost = 6 if mode == "pro" else 1
+        cost = unit_cost * variants
+        
+        # Проверяем баланс пользователя и параллельно - качество фото
+        # (фото, на котором модель заведомо не справится, не должно стоить энергии)
+        quality_gate = get_photo_quality_gate()
+        largest = max(message.photo, key=lambda size: size.width * size.height)
+        user, rejection = await asyncio.gather(
+            timings.measure("user", user_context.get_user()),
+            timings.measure(
+                "quality",
+                quality_gate.check(telegram_id, largest.width, largest.height, download_task)
+            ) if quality_gate is not None else asyncio.sleep(0)
+        )
+        if not user:
+            await cancel_task(download_task)
+            await message.answer("❌ Пользователь не найден. Используйте /start для регистрации.")
+            await state.set_state(UserState.idle)
+            return
+        
+        current_balance = user.get("balance", 0)
+        successful_generations = user.get("successful_generations", 0)
+        is_new_user = user.get("is_new_user", True)
+        m9_shown = user.get("m9_shown", False)
+        
+        # Проверка недостаточного баланса
+        if current_balance < cost:
+            await cancel_task(download_task)
+        
+            # m9 или m11
+            if is_new_user and successful_generations >= 1 and not m9_shown:
+                # Отправляем m9: стартер-пак
+                await message.answer(
+                    text=m9_starter_pack(current_balance, cost),
+                    reply_markup=kb_starter_pack(),
+                    parse_mode="HTML"
+                )
+                # Флаг и timestamp показа m9 (Plan 2) - одной записью
+                m9_fields = {"m9_shown": True, "m9_sent_at": datetime.utcnow()}
+                if await apply_user_bookkeeping(telegram_id, fields=m9_fields) is not None:
+                    user_context.update_user(m9_fields)
+            else:
+                # Отправляем m11: обычное сообщение о недостатке энергии
+                await message.answer(
+                    text=m11_insufficient_energy(current_balance, cost),
+                    reply_markup=kb_insufficient(),
+                    parse_mode="HTML"
+                )
+        
+            await state.set_state(UserState.idle)
+            return
+        
+        if rejection:
+            # Остаёмся в ожидании фото - пользователь может сразу прислать другое
+            await cancel_task(download_task)
+            await message.answer(text=photo_rejected(rejection), parse_mode="HTML")
+            return
+        
+        # Списываем энергию ДО генерации (атомарная операция) и параллельно
+        # отправляем m6: "Генерируем..." (анимацию запускает воркер)
+        deduct_result, status_message = await asyncio.gather(
+            timings.measure("deduct", deduct_energy(telegram_id, cost)),
+            timings.measure("status", message.answer(text=m6_generating(), parse_mode="HTML")),
+            return_exceptions=True
+        )
+        if isinstance(status_message, Exception):
+            logger.warning(f"Failed to send status message: {status_message}")
+            status_message = None
+        if isinstance(deduct_result, Exception):
+            logger.error(f"Error deducting energy: {deduct_result}")
+            deduct_result = None
+        
+        if not deduct_result:
+            await cancel_task(download_task)
+            if status_message:
+                try:
+                    await status_message.delete()
+                except Exception:
+                    pass
             await message.answer(
-                text=m9_starter_pack(current_balance, cost),
-                reply_markup=kb_starter_pack(),
-                parse_mode="HTML"
+                f"❌ Не удалось списать энергию. Возможно, баланс изменился.\n"
+                f"Попробуйте еще раз."
             )
-            await set_user_flag(telegram_id, "m9_shown", True)
-            # Записываем timestamp показа m9 (Plan 2)
-            await set_user_timestamp(telegram_id, "m9_sent_at", datetime.utcnow())
-        else:
-            # Отправляем m11: обычное сообщение о недостатке энергии
+            await state.set_state(UserState.idle)
+            return
+        
+        user_context.set_user(deduct_result)
+        new_balance = deduct_result.get("balance", 0)
+        logger.info(f"Energy deducted for user {telegram_id}: {cost} ⚡, new balance: {new_balance}")
+        
+        # Ставим задачу в очередь. В задаче сохраняем всё, что нужно воркеру
+        # для генерации и выбора сообщения с результатом (m7.x/m8)
+        job = {
+            "telegram_id": telegram_id,
+            "chat_id": message.chat.id,
+            "file_id": photo.file_id,
+            "file_unique_id": photo.file_unique_id,
+            "style_id": style_id,
+            "style_name": style_name,
+            "mode": mode,
+            "cost": cost,
+            "unit_cost": unit_cost,
+            "variants": variants,
+            "balance": new_balance,
+            "successful_generations": deduct_result.get("successful_generations", successful_generations),
+            "m7_1_sent": deduct_result.get("m7_1_sent", False),
+            "m7_2_sent": deduct_result.get("m7_2_sent", False),
+            "m7_3_sent": deduct_result.get("m7_3_sent", False),
+            "status_message_id": status_message.message_id if status_message else None,
+        }
+        # Уже начатое скачивание передаём воркеру (только в памяти этого инстанса)
+        job_id = await timings.measure(
+            "enqueue",
+            get_generation_queue().submit(job, local={"download_task": download_task, "deadline": deadline})
+        )
+        
+        if not job_id:
+            # Не удалось поставить задачу - сразу возвращаем энергию
+            logger.error(f"Failed to enqueue generation for user {telegram_id}")
+            await cancel_task(download_task)
+            if status_message:
+                try:
+                    await status_message.delete()
+                except Exception:
+                    pass
+            refunded = await update_user_balance(telegram_id, cost)
+            if refunded:
+                user_context.set_user(refunded)
             await message.answer(
-                text=m11_insufficient_energy(current_balance, cost),
-                reply_markup=kb_insufficient(),
-                parse_mode="HTML"
+                f"❌ Произошла ошибка при генерации.\n"
+                f"Энергия возвращена: +{cost} ⚡\n\n"
+                "Попробуйте ещё раз позже."
             )
         
+        # Возвращаем в idle состояние
         await state.set_state(UserState.idle)
+    finally:
+        # Замеры учитываются на любом выходе, включая отказы и ошибки
+        timings.finish()
+
+
+def job_deadline(job: Dict[str, Any]) -> Deadline:
+    """Дедлайн задачи из handle_photo (после рестарта - новый)"""
+    deadline = job.get("deadline")
+    if deadline is None:
+        deadline = Deadline(get_settings_instance().generation_deadline_seconds)
+    return deadline
+
+
+async def load_job_photo(
+    bot: Bot,
+    job: Dict[str, Any],
+    timings: StageTimings,
+    deadline: Deadline
+) -> IngestedPhoto:
+    """Скачать фото задачи (или дождаться скачивания, начатого в handle_photo) и подготовить для модели"""
+    download_task = job.get("download_task")
+    if download_task is not None:
+        photo_bytes = await deadline.run("download", download_task)
+    else:
+        photo_bytes = await timings.measure("download", deadline.run(
+            "download",
+            get_telegram_file_client().download_by_file_id(bot, job["file_id"])
+        ))
+    logger.info(f"Downloaded photo: {len(photo_bytes)} bytes")
+    
+    # Поворот по EXIF, уменьшение и перекодирование в JPEG (в пуле процессов)
+    return await timings.measure("ingest", deadline.run(
+        "ingest",
+        get_photo_ingestor().ingest(photo_bytes, job.get("mode", "normal"))
+    ))
+
+
+def failure_outcome(trace: GenerationTrace, error: Optional[Exception] = None) -> Optional[str]:
+    """Итог неудачной генерации для сообщения пользователю"""
+    if isinstance(error, DeadlineExceeded):
+        return GenerationOutcome.DEADLINE
+    if error is not None and trace.outcome == GenerationOutcome.SUCCESS:
+        # Модель ответила, ошибка случилась позже (обработка, отправка)
+        return None
+    return trace.outcome
+
+
+async def abandon_generation_job(bot: Bot, job: Dict[str, Any]):
+    """
+    Задача закрыта очередью после max_attempts захватов (каждый запуск обрывался,
+    например падением инстанса): возвращаем энергию и сообщаем пользователю.
+    Статус failed уже записан при захвате, поэтому сюда задача попадает один раз.
+    """
+    job_id = job["id"]
+    telegram_id = job["telegram_id"]
+    chat_id = job["chat_id"]
+    cost = job["cost"]
+    
+    counters = await apply_user_bookkeeping(
+        telegram_id,
+        increments={"balance": cost},
+        generation_id=job_id,
+        generation_fields={"refunded": True}
+    )
+    if counters is None:
+        logger.error(f"Error refunding energy for abandoned job {job_id} of user {telegram_id}")
         return
+    logger.info(f"Energy refunded for abandoned job {job_id} of user {telegram_id}: {cost} ⚡")
     
-    # Списываем энергию ДО генерации (атомарная операция)
-    deduct_result = await deduct_energy(telegram_id, cost)
-    if not deduct_result:
-        await message.answer(
-            f"❌ Не удалось списать энергию. Возможно, баланс изменился.\n"
-            f"Попробуйте еще раз."
-        )
-        await state.set_state(UserState.idle)
+    status_message_id = job.get("status_message_id")
+    try:
+        if status_message_id:
+            await bot.delete_message(chat_id=chat_id, message_id=status_message_id)
+    except Exception:
+        pass
+    try:
+        await bot.send_message(chat_id=chat_id, text=generation_failed(None, cost))
+    except Exception as e:
+        logger.warning(f"Failed to notify user {telegram_id} about abandoned job {job_id}: {e}")
+
+
+async def process_generation_job(bot: Bot, job: Dict[str, Any]):
+    """
+    Выполнение задачи генерации воркером очереди.
+    
+    Граф этапов:
+        download -> ingest -> generate -> ┬ status_delete
+                                          ├ postprocess -> upload ─┐
+                                          └ bookkeeping ───────────┴ done
+    При ошибке - возврат энергии одной batch-записью.
+    """
+    if job.get("variants", 1) > 1:
+        await process_variants_job(bot, job)
         return
     
-    new_balance = deduct_result.get("balance", 0)
-    logger.info(f"Energy deducted for user {telegram_id}: {cost} ⚡, new balance: {new_balance}")
+    job_id = job["id"]
+    telegram_id = job["telegram_id"]
+    chat_id = job["chat_id"]
+    style_id = job["style_id"]
+    style_name = job.get("style_name")
+    mode = job.get("mode", "normal")
+    cost = job["cost"]
+    new_balance = job.get("balance", 0)
+    successful_generations = job.get("successful_generations", 0)
+    status_message_id = job.get("status_message_id")
+    timings = StageTimings("generation")
+    # Регионы и попытки вызова модели - сохраняются в документ генерации
+    trace = GenerationTrace()
+    deadline = job_deadline(job)
     
-    # Переводим в состояние генерации
-    await state.set_state(UserState.generating)
+    # Запускаем анимацию луны через общий планировщик
+    progress = get_progress_scheduler()
+    progress_handle = None
+    if status_message_id:
+        progress_handle = progress.register(chat_id, status_message_id, render_generation_progress(trace))
     
-    # Отправляем m6: "Генерируем..." с анимацией луны (Plan 2)
-    status_message = await message.answer(
-        text=m6_generating(),
-        parse_mode="HTML"
-    )
+    async def delete_status_message():
+        """Останавливаем анимацию и удаляем статусное сообщение"""
+        if progress_handle:
+            await progress.finish(progress_handle)
+        if status_message_id:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=status_message_id)
+            except Exception:
+                pass
     
-    # Запускаем фоновую анимацию луны
-    stop_animation = asyncio.Event()
-    animation_task = asyncio.create_task(animate_moon_emoji(status_message, stop_animation))
+    status_task: Optional[asyncio.Task] = None
+    
+    def stop_status_message() -> asyncio.Task:
+        """Удаление статусного сообщения идёт параллельно с остальными этапами"""
+        nonlocal status_task
+        if status_task is None:
+            status_task = timings.start("status_delete", delete_status_message())
+        return status_task
+    
+    # Запись об успешной генерации уже применена (нужно откатить счётчик при ошибке отправки)
+    success_recorded = False
+    # Задача прервана остановкой инстанса и будет запущена снова
+    interrupted = False
+    
+    async def refund(error: Optional[str] = None) -> bool:
+        """Вернуть энергию и закрыть задачу одной batch-записью"""
+        increments = {"balance": cost}
+        if success_recorded:
+            increments["successful_generations"] = -1
+        generation_fields = {"status": "failed", "refunded": True, "trace": trace.to_dict()}
+        if error:
+            generation_fields["error"] = error
+        if deadline.expired_stage:
+            # Этап, на котором вышло время
+            generation_fields["deadline_stage"] = deadline.expired_stage
+        counters = await apply_user_bookkeeping(
+            telegram_id,
+            increments=increments,
+            generation_id=job_id,
+            generation_fields=generation_fields
+        )
+        return counters is not None
+    
+    async def record_success(fields: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """Счётчик, timestamp (Plan 2), флаг m7.x и статус задачи - одной записью"""
+        nonlocal success_recorded
+        counters = await apply_user_bookkeeping(
+            telegram_id,
+            increments={"successful_generations": 1},
+            fields=fields,
+            generation_id=job_id,
+            generation_fields={"status": "completed", "trace": trace.to_dict()}
+        )
+        success_recorded = counters is not None
+        return counters
     
     try:
-        settings = get_settings_instance()
-        
-        # Получаем файл фото (берём самое большое качество)
-        photo = message.photo[-1]
-        file = await message.bot.get_file(photo.file_id)
-        file_path = file.file_path
-        
-        # Скачиваем фото
-        file_url = f"https://api.telegram.org/file/bot{settings.bot_token}/{file_path}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status != 200:
-                    raise Exception(f"Failed to download photo: {response.status}")
-                photo_bytes = await response.read()
-        
-        logger.info(f"Downloaded photo: {len(photo_bytes)} bytes")
+        ingested = await load_job_photo(bot, job, timings, deadline)
         
         # Генерируем изображение через Vertex AI
         vertex_service = get_ai_service()
-        result_bytes = await vertex_service.generate_single(
-            photo_bytes=photo_bytes,
+        result_bytes = await timings.measure("generate", vertex_service.generate_single(
+            photo_bytes=ingested.data,
             style_id=style_id,
-            mode=mode
-        )
-        
-        # Останавливаем анимацию и удаляем статусное сообщение
-        stop_animation.set()
-        try:
-            await animation_task
-        except Exception:
-            pass
+            mode=mode,
+            photo_key=job.get("file_unique_id"),
+            mime_type=ingested.mime_type,
+            trace=trace,
+            deadline=deadline
+        ))
         
-        try:
-            await status_message.delete()
-        except Exception:
-            pass
+        stop_status_message()
         
         # Отправляем результат
         if result_bytes:
             logger.info(f"Generated image successfully for user {telegram_id}")
             
-            # Увеличиваем счётчик успешных генераций
-            new_count = await increment_successful_generations(telegram_id)
-            if new_count is None:
-                new_count = successful_generations + 1  # fallback
-            
-            # Записываем timestamp последней успешной генерации (Plan 2)
-            await set_user_timestamp(telegram_id, "last_generation_at", datetime.utcnow())
-            
-            logger.info(f"User {telegram_id} now has {new_count} successful generations")
+            # Счётчик увеличивается до выбора сообщения: номер генерации (и флаг m7.x)
+            # берётся из ответа Firestore, поэтому параллельные генерации одного
+            # пользователя не получат один номер. Запись идёт параллельно с перекодированием
+            bookkeeping_task = timings.start(
+                "bookkeeping",
+                record_success({"last_generation_at": datetime.utcnow()})
+            )
             
-            # Отправляем фото с правильным сообщением
+            # Перекодируем результат (в пуле процессов)
+            processed = await timings.measure(
+                "postprocess",
+                get_result_postprocessor().process(result_bytes)
+            )
             input_file = BufferedInputFile(
-                result_bytes,
-                filename="result.jpg"
+                processed.photo,
+                filename=processed.filename
             )
             
-            # Определяем какое сообщение и клавиатуру отправить
-            if new_count == 1 and not user.get("m7_1_sent", False):
-                # m7.1: первая генерация
-                text = m7_1_result_first(style_name, new_balance)
-                sent_msg = await message.answer_photo(
-                    photo=input_file,
-                    caption=text,
-                    parse_mode="HTML"
-                )
-                keyboard = kb_result_m71(style_id, str(sent_msg.message_id))
-                await sent_msg.edit_reply_markup(reply_markup=keyboard)
-                await set_user_flag(telegram_id, "m7_1_sent", True)
-                
-            elif new_count == 2 and not user.get("m7_2_sent", False):
-                # m7.2: вторая генерация
-                text = m7_2_result_second(style_name, new_balance)
-                sent_msg = await message.answer_photo(
-                    photo=input_file,
-                    caption=text,
-                    parse_mode="HTML"
-                )
-                keyboard = kb_result_m72(style_id, str(sent_msg.message_id))
-                await sent_msg.edit_reply_markup(reply_markup=keyboard)
-                await set_user_flag(telegram_id, "m7_2_sent", True)
-                
-            elif new_count == 3 and not user.get("m7_3_sent", False):
-                # m7.3: третья генерация
-                text = m7_3_result_third(style_name, new_balance)
-                sent_msg = await message.answer_photo(
-                    photo=input_file,
-                    caption=text,
-                    parse_mode="HTML"
-                )
-                keyboard = kb_result_m73(style_id, str(sent_msg.message_id))
-                await sent_msg.edit_reply_markup(reply_markup=keyboard)
-                await set_user_flag(telegram_id, "m7_3_sent", True)
-                
+            counters = await bookkeeping_task
+            if counters and "successful_generations" in counters:
+                new_count = counters["successful_generations"]
+                logger.info(f"User {telegram_id} now has {new_count} successful generations")
             else:
-                # m8: обычный результат
-                text = m8_result_regular(style_name, new_balance)
-                sent_msg = await message.answer_photo(
-                    photo=input_file,
-                    caption=text,
-                    parse_mode="HTML"
+                # Запись не удалась - номер по снимку пользователя при списании
+                new_count = successful_generations + 1
+            flag = M7_FLAGS.get(new_count)
+            if flag and job.get(flag, False):
+                flag = None
+            
+            # Определяем какое сообщение и клавиатуру отправить
+            text, keyboard = result_message(flag, style_name, new_balance, style_id, job_id)
+            
+            # Отправка результата (с клавиатурой сразу) имеет приоритет над анимацией других генераций чата;
+            # флаг m7.x записывается параллельно
+            async with progress.priority(chat_id):
+                upload_result, _ = await asyncio.gather(
+                    timings.measure("upload", deadline.run(
+                        "upload",
+                        bot.send_photo(
+                            chat_id=chat_id,
+                            photo=input_file,
+                            caption=text,
+                            reply_markup=keyboard,
+                            parse_mode="HTML"
+                        ),
+                        # Готовый результат отправляем, даже если общий срок почти вышел
+                        min_budget=get_settings_instance().generation_upload_min_seconds
+                    )),
+                    timings.measure("flags", apply_user_bookkeeping(telegram_id, fields={flag: True}))
+                    if flag else asyncio.sleep(0),
+                    return_exceptions=True
                 )
-                keyboard = kb_result_m8(style_id, str(sent_msg.message_id))
-                await sent_msg.edit_reply_markup(reply_markup=keyboard)
+            if isinstance(upload_result, Exception):
+                raise upload_result
         else:
             logger.warning(f"No results from generation for user {telegram_id}")
             
             # Возвращаем энергию при ошибке генерации
-            await update_user_balance(telegram_id, cost)
+            await timings.measure("refund", refund())
             logger.info(f"Energy refunded for user {telegram_id}: {cost} ⚡")
             
-            await message.answer(
-                "❌ К сожалению, не удалось сгенерировать изображение.\n"
-                f"Энергия возвращена: +{cost} ⚡\n\n"
-                "Попробуйте ещё раз или выберите другой стиль."
+            await bot.send_message(
+                chat_id=chat_id,
+                text=generation_failed(failure_outcome(trace), cost)
             )
         
+    except asyncio.CancelledError:
+        # Остановка инстанса: GenerationQueue вернёт задачу в pending, энергия
+        # остаётся списанной за повторный запуск (завершённая задача не меняется)
+        interrupted = not success_recorded
+        raise
+    
     except Exception as e:
-        logger.error(f"Error in photo handler: {e}", exc_info=True)
+        logger.error(f"Error in generation job {job_id}: {e}", exc_info=True)
         
         # Останавливаем анимацию при ошибке
-        stop_animation.set()
-        try:
-            await animation_task
-        except Exception:
-            pass
-        
-        try:
-            await status_message.delete()
-        except Exception:
-            pass
+        stop_status_message()
         
         # Возвращаем энергию при ошибке
-        try:
-            await update_user_balance(telegram_id, cost)
+        if await timings.measure("refund", refund(str(e))):
             logger.info(f"Energy refunded after error for user {telegram_id}: {cost} ⚡")
-            
-            await message.answer(
-                f"❌ Произошла ошибка при генерации.\n"
-                f"Энергия возвращена: +{cost} ⚡\n\n"
+            await bot.send_message(chat_id=chat_id, text=generation_failed(failure_outcome(trace, e), cost))
+        else:
+            logger.error(f"Error refunding energy for user {telegram_id}")
+            await update_generation_job(job_id, {"status": "failed", "error": str(e)})
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ Произошла ошибка при генерации.\n"
                 "Попробуйте ещё раз позже."
             )
-        except Exception as refund_error:
-            logger.error(f"Error refunding energy: {refund_error}")
-            await message.answer(
-                f"❌ Произошла ошибка при генерации.\n"
+    
+    finally:
+        if interrupted and status_task is None:
+            # Статусное сообщение подхватит повторный запуск - только останавливаем анимацию
+            if progress_handle:
+                await progress.finish(progress_handle)
+        else:
+            await stop_status_message()
+        timings.finish()
+
+
+async def process_variants_job(bot: Bot, job: Dict[str, Any]):
+    """
+    Генерация нескольких вариантов одного фото.
+    
+    Варианты генерируются параллельно (не больше variants_per_user_concurrency
+    на пользователя), статус обновляется по мере готовности, результат
+    отправляется одним альбомом (sendMediaGroup). Энергия за неудавшиеся
+    варианты возвращается, за удавшиеся - списывается.
+    """
+    job_id = job["id"]
+    telegram_id = job["telegram_id"]
+    chat_id = job["chat_id"]
+    style_id = job["style_id"]
+    style_name = job.get("style_name")
+    mode = job.get("mode", "normal")
+    cost = job["cost"]
+    variants = job["variants"]
+    unit_cost = job.get("unit_cost", cost // variants)
+    new_balance = job.get("balance", 0)
+    successful_generations = job.get("successful_generations", 0)
+    status_message_id = job.get("status_message_id")
+    timings = StageTimings("variants")
+    trace = GenerationTrace()
+    deadline = job_deadline(job)
+    
+    # Готовые варианты - счётчик в кадре анимации
+    done = [0]
+    progress = get_progress_scheduler()
+    progress_handle = None
+    if status_message_id:
+        progress_handle = progress.register(
+            chat_id, status_message_id, render_variants_progress(done, variants, trace)
+        )
+    
+    async def delete_status_message():
+        """Останавливаем анимацию и удаляем статусное сообщение"""
+        if progress_handle:
+            await progress.finish(progress_handle)
+        if status_message_id:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=status_message_id)
+            except Exception:
+                pass
+    
+    status_task: Optional[asyncio.Task] = None
+    
+    def stop_status_message() -> asyncio.Task:
+        nonlocal status_task
+        if status_task is None:
+            status_task = timings.start("status_delete", delete_status_message())
+        return status_task
+    
+    # Уже применённые записи (нужно откатить при ошибке отправки)
+    refunded = 0
+    recorded_successes = 0
+    # Задача прервана остановкой инстанса и будет запущена снова
+    interrupted = False
+    
+    async def refund(error: Optional[str] = None) -> bool:
+        """Вернуть оставшуюся энергию и закрыть задачу одной batch-записью"""
+        increments = {"balance": cost - refunded}
+        if recorded_successes:
+            increments["successful_generations"] = -recorded_successes
+        generation_fields = {"status": "failed", "refunded": True, "trace": trace.to_dict()}
+        if error:
+            generation_fields["error"] = error
+        if deadline.expired_stage:
+            # Этап, на котором вышло время
+            generation_fields["deadline_stage"] = deadline.expired_stage
+        counters = await apply_user_bookkeeping(
+            telegram_id,
+            increments=increments,
+            generation_id=job_id,
+            generation_fields=generation_fields
+        )
+        return counters is not None
+    
+    async def record_success(successes: int, fields: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """Счётчик успешных, возврат за неудавшиеся варианты, флаги и статус - одной записью"""
+        nonlocal refunded, recorded_successes
+        failed = variants - successes
+        increments = {"successful_generations": successes}
+        if failed:
+            increments["balance"] = unit_cost * failed
+        counters = await apply_user_bookkeeping(
+            telegram_id,
+            increments=increments,
+            fields=fields,
+            generation_id=job_id,
+            generation_fields={
+                "status": "completed",
+                "variants_succeeded": successes,
+                "trace": trace.to_dict()
+            }
+        )
+        if counters is not None:
+            refunded = unit_cost * failed
+            recorded_successes = successes
+        return counters
+    
+    try:
+        ingested = await load_job_photo(bot, job, timings, deadline)
+        
+        # Генерируем варианты параллельно, результаты приходят по мере готовности
+        vertex_service = get_ai_service()
+        results: Dict[int, bytes] = {}
+        postprocess_tasks: Dict[int, asyncio.Task] = {}
+        async with timings.stage("generate"), user_variant_slots(telegram_id) as slots:
+            async for index, result_bytes in vertex_service.iter_batch(
+                ingested.data,
+                style_id,
+                count=variants,
+                mode=mode,
+                mime_type=ingested.mime_type,
+                limiter=slots,
+                trace=trace,
+                deadline=deadline
+            ):
+                if result_bytes is None:
+                    continue
+                results[index] = result_bytes
+                done[0] += 1
+                # Перекодирование готового варианта идёт, пока генерируются остальные
+                postprocess_tasks[index] = asyncio.create_task(
+                    get_result_postprocessor().process(result_bytes)
+                )
+        
+        stop_status_message()
+        successes = len(results)
+        logger.info(f"Generated {successes}/{variants} variants for user {telegram_id}")
+        
+        if successes:
+            failed = variants - successes
+            balance = new_balance + unit_cost * failed
+            
+            # Счётчик увеличивается до выбора сообщения: пройденные номера генераций
+            # (и флаги m7.x) берутся из ответа Firestore, поэтому параллельные генерации
+            # одного пользователя не получат одни номера. Запись идёт параллельно с перекодированием
+            bookkeeping_task = timings.start(
+                "bookkeeping",
+                record_success(successes, {"last_generation_at": datetime.utcnow()})
+            )
+            
+            order = sorted(results)
+            processed = await timings.measure(
+                "postprocess",
+                asyncio.gather(*(postprocess_tasks[index] for index in order))
+            )
+            media = [
+                InputMediaPhoto(media=BufferedInputFile(image.photo, filename=image.filename))
+                for image in processed
+            ]
+            
+            counters = await bookkeeping_task
+            if counters and "successful_generations" in counters:
+                total = counters["successful_generations"]
+                logger.info(f"User {telegram_id} now has {total} successful generations")
+            else:
+                # Запись не удалась - номера по снимку пользователя при списании
+                total = successful_generations + successes
+            
+            # Флаги m7.x за все пройденные номера генераций, сообщение - по первому из них
+            crossed = [
+                M7_FLAGS[count]
+                for count in range(total - successes + 1, total + 1)
+                if count in M7_FLAGS and not job.get(M7_FLAGS[count], False)
+            ]
+            flag = crossed[0] if crossed else None
+            
+            text, keyboard = result_message(flag, style_name, balance, style_id, job_id)
+            if failed:
+                text += variants_failed_note(failed, unit_cost * failed)
+            
+            # Альбом не поддерживает inline-клавиатуру: одиночный вариант - обычным фото,
+            # иначе альбом + сообщение с клавиатурой
+            async def upload():
+                if len(media) == 1:
+                    return [await bot.send_photo(
+                        chat_id=chat_id,
+                        photo=media[0].media,
+                        caption=text,
+                        reply_markup=keyboard,
+                        parse_mode="HTML"
+                    )]
+                messages = await bot.send_media_group(chat_id=chat_id, media=media)
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=text,
+                    reply_markup=keyboard,
+                    parse_mode="HTML"
+                )
+                return messages
+            
+            # Флаги m7.x записываются параллельно с отправкой
+            async with progress.priority(chat_id):
+                upload_result, _ = await asyncio.gather(
+                    timings.measure("upload", deadline.run(
+                        "upload",
+                        upload(),
+                        min_budget=get_settings_instance().generation_upload_min_seconds
+                    )),
+                    timings.measure(
+                        "flags",
+                        apply_user_bookkeeping(telegram_id, fields=dict.fromkeys(crossed, True))
+                    ) if crossed else asyncio.sleep(0),
+                    return_exceptions=True
+                )
+            if isinstance(upload_result, Exception):
+                raise upload_result
+        else:
+            logger.warning(f"No variants generated for user {telegram_id}")
+            
+            # Возвращаем всю энергию
+            await timings.measure("refund", refund())
+            logger.info(f"Energy refunded for user {telegram_id}: {cost} ⚡")
+            
+            await bot.send_message(
+                chat_id=chat_id,
+                text=generation_failed(failure_outcome(trace), cost)
+            )
+    
+    except asyncio.CancelledError:
+        # Остановка инстанса: GenerationQueue вернёт задачу в pending, энергия
+        # остаётся списанной за повторный запуск (завершённая задача не меняется)
+        interrupted = not recorded_successes
+        raise
+    
+    except Exception as e:
+        logger.error(f"Error in variants job {job_id}: {e}", exc_info=True)
+        
+        # Останавливаем анимацию при ошибке
+        stop_status_message()
+        
+        # Возвращаем энергию (за вычетом уже возвращённой)
+        if await timings.measure("refund", refund(str(e))):
+            logger.info(f"Energy refunded after error for user {telegram_id}: {cost - refunded} ⚡")
+            await bot.send_message(chat_id=chat_id, text=generation_failed(failure_outcome(trace, e), cost - refunded))
+        else:
+            logger.error(f"Error refunding energy for user {telegram_id}")
+            await update_generation_job(job_id, {"status": "failed", "error": str(e)})
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ Произошла ошибка при генерации.\n"
                 "Попробуйте ещё раз позже."
             )
     
-    # Возвращаем в idle состояние
-    await state.set_state(UserState.idle)
+    finally:
+        if interrupted and status_task is None:
+            # Статусное сообщение подхватит повторный запуск - только останавливаем анимацию
+            if progress_handle:
+                await progress.finish(progress_handle)
+        else:
+            await stop_status_message()
+        timings.finish()
 
 
 @router.message(UserState.awaiting_photo)
@@ -327,15 +893,13 @@ async def handle_not_photo(message: Message, state: FSMContext):
 
 
 @router.message(F.photo)
-async def handle_photo_with_pending_selection(message: Message, state: FSMContext):
+async def handle_photo_with_pending_selection(message: Message, state: FSMContext, user_context: UserContext):
     """
     Fallback обработчик фото - проверяет pending selection в Firestore.
     Срабатывает когда FSM состояние не awaiting_photo, но есть pending selection.
     """
-    telegram_id = message.from_user.id
-    
     # Проверяем, есть ли pending selection в Firestore
-    pending = await get_pending_style_selection(telegram_id)
+    pending = await user_context.get_pending()
     
     if not pending:
         # Нет pending selection - просим выбрать стиль
@@ -352,23 +916,24 @@ async def handle_photo_with_pending_selection(message: Message, state: FSMContex
     
     logger.info(f"Processing photo with pending selection: style={style_id}, mode={mode}")
     
-    # Очищаем pending selection
-    await clear_pending_style_selection(telegram_id)
+    # Очищаем pending selection (документ уже прочитан - без повторного чтения)
+    await user_context.clear_pending()
     
     # Устанавливаем данные в FSM и перенаправляем на основной обработчик
     await state.update_data(
         style_id=style_id,
         style_name=style_name,
-        mode=mode
+        mode=mode,
+        variants=1
     )
     await state.set_state(UserState.awaiting_photo)
     
     # Вызываем основной обработчик фото
-    await handle_photo(message, state)
+    await handle_photo(message, state, user_context)
 
 
 @router.callback_query(F.data.startswith("repeat:"))
-async def handle_repeat(callback: CallbackQuery, state: FSMContext):
+async def handle_repeat(callback: CallbackQuery, state: FSMContext, user_context: UserContext):
     """Обработчик кнопки "Повторить" - возвращает в режим выбора фото"""
     await callback.answer()
     
@@ -385,7 +950,7 @@ async def handle_repeat(callback: CallbackQuery, state: FSMContext):
     style_name = style["name"]
     
     # Получаем пользователя для проверки кол-ва генераций
-    user = await get_user(telegram_id)
+    user = await user_context.get_user()
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Используйте /start")
         return
@@ -396,7 +961,8 @@ async def handle_repeat(callback: CallbackQuery, state: FSMContext):
     await state.update_data(
         style_id=style_id,
         style_name=style_name,
-        mode="normal"
+        mode="normal",
+        variants=1
     )
     await state.set_state(UserState.awaiting_photo)
     
@@ -434,12 +1000,11 @@ async def handle_download(callback: CallbackQuery):
         file_id = callback.message.photo[-1].file_id
         
         # Скачиваем фото из Telegram
-        file = await callback.bot.get_file(file_id)
-        file_data = await callback.bot.download_file(file.file_path)
+        file_data = await get_telegram_file_client().download_by_file_id(callback.bot, file_id)
         
         # Отправляем как документ для полного качества
         input_file = BufferedInputFile(
-            file_data.read(),
+            file_data,
             filename="seeyay_result.jpg"
         )
         
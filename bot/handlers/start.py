@@ -8,7 +8,8 @@ from bot.keyboards import kb_template_grid, kb_menu
 from bot.messages import m1_welcome, m13_main_menu
 from bot.states import UserState
 from bot.config import get_settings
-from bot.firestore import ensure_user_exists, get_user, set_user_timestamp
+from bot.firestore import set_user_timestamp
+from bot.middlewares import UserContext
 from datetime import datetime
 
 router = Router()
@@ -16,21 +17,19 @@ logger = logging.getLogger(__name__)
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user_context: UserContext):
     """Обработчик команды /start - отправляет m1"""
     telegram_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name or "пользователь"
     
-    # Проверяем, существует ли пользователь
-    user = await get_user(telegram_id)
-    is_new_user = user is None
-    
     # Создаём пользователя если не существует
-    await ensure_user_exists(telegram_id, username)
+    user, is_new_user = await user_context.ensure_user(username)
     
     # Для новых пользователей записываем started_at (Plan 2)
     if is_new_user:
-        await set_user_timestamp(telegram_id, "started_at", datetime.utcnow())
+        started_at = datetime.utcnow()
+        if await set_user_timestamp(telegram_id, "started_at", started_at):
+            user_context.update_user({"started_at": started_at})
         logger.info(f"New user {telegram_id}, set started_at timestamp")
     
     # Сбрасываем состояние
@@ -48,12 +47,12 @@ async def cmd_start(message: Message, state: FSMContext):
 
 
 @router.message(Command("menu"))
-async def cmd_menu(message: Message, state: FSMContext):
+async def cmd_menu(message: Message, state: FSMContext, user_context: UserContext):
     """Обработчик команды /menu - отправляет m13"""
     telegram_id = message.from_user.id
     
     # Получаем данные пользователя
-    user = await get_user(telegram_id)
+    user = await user_context.get_user()
     if not user:
         # Если пользователь не найден, редирект на /start
         await message.answer("Пожалуйста, сначала используйте /start")
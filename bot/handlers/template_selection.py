@@ -8,7 +8,8 @@ from bot.keyboards import (
     kb_config_onboarding, 
     kb_config_normal, 
     kb_config_pro,
-    kb_template_grid
+    kb_template_grid,
+    VARIANT_OPTIONS
 )
 from bot.messages import (
     m3_config_onboarding,
@@ -17,7 +18,8 @@ from bot.messages import (
 )
 from bot.states import UserState
 from bot.styles_data import get_style_by_id
-from bot.firestore import get_user, set_user_timestamp
+from bot.firestore import set_user_timestamp
+from bot.middlewares import UserContext
 from datetime import datetime
 
 router = Router()
@@ -25,7 +27,7 @@ logger = logging.getLogger(__name__)
 
 
 @router.callback_query(F.data.startswith("tpl:"))
-async def handle_template_selection(callback: CallbackQuery, state: FSMContext):
+async def handle_template_selection(callback: CallbackQuery, state: FSMContext, user_context: UserContext):
     """Обработчик выбора шаблона по кнопке"""
     await callback.answer()
     
@@ -47,7 +49,7 @@ async def handle_template_selection(callback: CallbackQuery, state: FSMContext):
     style_name = style["name"]
     
     # Получаем пользователя
-    user = await get_user(telegram_id)
+    user = await user_context.get_user()
     if not user:
         await callback.message.answer("❌ Пользователь не найден. Используйте /start")
         return
@@ -58,12 +60,15 @@ async def handle_template_selection(callback: CallbackQuery, state: FSMContext):
     await state.update_data(
         style_id=style_id,
         style_name=style_name,
-        mode="normal"
+        mode="normal",
+        variants=1
     )
     await state.set_state(UserState.awaiting_photo)
     
     # Записываем timestamp выбора шаблона (Plan 2)
-    await set_user_timestamp(telegram_id, "template_selected_at", datetime.utcnow())
+    selected_at = datetime.utcnow()
+    if await set_user_timestamp(telegram_id, "template_selected_at", selected_at):
+        user_context.update_user({"template_selected_at": selected_at})
     
     # Определяем какое сообщение отправить
     if successful_generations == 0:
@@ -117,10 +122,11 @@ async def handle_toggle_pro(callback: CallbackQuery, state: FSMContext):
         mode="pro"
     )
     await state.set_state(UserState.awaiting_photo)
+    variants = (await state.get_data()).get("variants", 1)
     
     # Отправляем m4.2
-    text = m4_2_config_pro(style_name, 6)
-    keyboard = kb_config_pro(style_id)
+    text = m4_2_config_pro(style_name, 6 * variants, variants)
+    keyboard = kb_config_pro(style_id, variants)
     
     await callback.message.edit_text(
         text=text,
@@ -154,10 +160,11 @@ async def handle_toggle_normal(callback: CallbackQuery, state: FSMContext):
         mode="normal"
     )
     await state.set_state(UserState.awaiting_photo)
+    variants = (await state.get_data()).get("variants", 1)
     
     # Отправляем m4.1
-    text = m4_1_config_normal(style_name, 1)
-    keyboard = kb_config_normal(style_id)
+    text = m4_1_config_normal(style_name, variants, variants)
+    keyboard = kb_config_normal(style_id, variants)
     
     await callback.message.edit_text(
         text=text,
@@ -168,8 +175,54 @@ async def handle_toggle_normal(callback: CallbackQuery, state: FSMContext):
     logger.info(f"User {telegram_id} toggled to normal mode for {style_id}")
 
 
+@router.callback_query(F.data.startswith("variants:"))
+async def handle_toggle_variants(callback: CallbackQuery, state: FSMContext):
+    """Переключение количества вариантов (1 → 2 → 4)"""
+    await callback.answer()
+    
+    telegram_id = callback.from_user.id
+    _, style_id, variants = callback.data.split(":", 2)
+    variants = int(variants) if variants.isdigit() else 1
+    if variants not in VARIANT_OPTIONS:
+        variants = 1
+    
+    # Получаем стиль
+    style = get_style_by_id(style_id)
+    if not style:
+        await callback.message.answer("❌ Шаблон не найден")
+        return
+    
+    style_name = style["name"]
+    mode = (await state.get_data()).get("mode", "normal")
+    
+    # Обновляем FSM - режим не меняется
+    await state.update_data(
+        style_id=style_id,
+        style_name=style_name,
+        mode=mode,
+        variants=variants
+    )
+    await state.set_state(UserState.awaiting_photo)
+    
+    # Стоимость за все варианты
+    if mode == "pro":
+        text = m4_2_config_pro(style_name, 6 * variants, variants)
+        keyboard = kb_config_pro(style_id, variants)
+    else:
+        text = m4_1_config_normal(style_name, variants, variants)
+        keyboard = kb_config_normal(style_id, variants)
+    
+    await callback.message.edit_text(
+        text=text,
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    
+    logger.info(f"User {telegram_id} selected {variants} variants for {style_id}")
+
+
 @router.message(F.web_app_data)
-async def handle_webapp_data(message: Message, state: FSMContext):
+async def handle_webapp_data(message: Message, state: FSMContext, user_context: UserContext):
     """Обработчик данных из Mini App"""
     try:
         data = json.loads(message.web_app_data.data)
@@ -182,7 +235,7 @@ async def handle_webapp_data(message: Message, state: FSMContext):
         logger.info(f"Received webapp data: user={telegram_id}, style={style_id}, mode={mode}")
         
         # Получаем пользователя
-        user = await get_user(telegram_id)
+        user = await user_context.get_user()
         if not user:
             await message.answer("❌ Пользователь не найден. Используйте /start")
             return
@@ -193,12 +246,15 @@ async def handle_webapp_data(message: Message, state: FSMContext):
         await state.update_data(
             style_id=style_id,
             style_name=style_name,
-            mode=mode
+            mode=mode,
+            variants=1
         )
         await state.set_state(UserState.awaiting_photo)
         
         # Записываем timestamp выбора шаблона (Plan 2)
-        await set_user_timestamp(telegram_id, "template_selected_at", datetime.utcnow())
+        selected_at = datetime.utcnow()
+        if await set_user_timestamp(telegram_id, "template_selected_at", selected_at):
+            user_context.update_user({"template_selected_at": selected_at})
         
         # Определяем стоимость
         cost = 6 if mode == "pro" else 1
@@ -51,23 +51,44 @@ def kb_config_onboarding(style_id: str) -> InlineKeyboardMarkup:
     return keyboard
 
 
-def kb_config_normal(style_id: str) -> InlineKeyboardMarkup:
+# Количество вариантов за одну генерацию (кнопка переключает по кругу)
+VARIANT_OPTIONS = (1, 2, 4)
+
+
+def next_variants(variants: int) -> int:
+    """Следующее значение кнопки «Вариантов»"""
+    if variants not in VARIANT_OPTIONS:
+        return VARIANT_OPTIONS[0]
+    return VARIANT_OPTIONS[(VARIANT_OPTIONS.index(variants) + 1) % len(VARIANT_OPTIONS)]
+
+
+def _variants_button(style_id: str, variants: int) -> InlineKeyboardButton:
+    """Кнопка выбора количества вариантов"""
+    return InlineKeyboardButton(
+        text=f"🖼 Вариантов: {variants}",
+        callback_data=f"variants:{style_id}:{next_variants(variants)}"
+    )
+
+
+def kb_config_normal(style_id: str, variants: int = 1) -> InlineKeyboardMarkup:
     """Клавиатура конфигурации в обычном режиме (m4.1)"""
     settings = get_settings()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💎 Использовать PRO-режим", callback_data=f"toggle_pro:{style_id}")],
+        [_variants_button(style_id, variants)],
         [_create_webapp_button("🎭 Сменить шаблон", settings.mini_app_url)]
     ])
     return keyboard
 
 
-def kb_config_pro(style_id: str) -> InlineKeyboardMarkup:
+def kb_config_pro(style_id: str, variants: int = 1) -> InlineKeyboardMarkup:
     """Клавиатура конфигурации в PRO режиме (m4.2)"""
     settings = get_settings()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Использовать обычный режим", callback_data=f"toggle_normal:{style_id}")],
+        [_variants_button(style_id, variants)],
         [_create_webapp_button("🎭 Сменить шаблон", settings.mini_app_url)]
     ])
     return keyboard
@@ -1,3 +1,6 @@
+import asyncio
+import hmac
+import importlib
 import logging
 import os
 import sys
@@ -15,6 +18,7 @@ logger = logging.getLogger(__name__)
 bot = None
 dp = None
 bot_initialized = False
+warm_up_task = None
 
 
 async def health_check(request):
@@ -22,6 +26,23 @@ async def health_check(request):
     return web.Response(text="OK", status=200)
 
 
+async def stats_handler(request):
+    """
+    Метрики сервисов бота (очереди, пулы, лимиты)
+    Сервис публичный, поэтому endpoint отвечает только с токеном STATS_TOKEN
+    в заголовке X-Stats-Token; без настроенного токена его как бы нет (404)
+    """
+    from bot.config import get_settings
+    expected = get_settings().stats_token
+    if not expected:
+        return web.Response(text="Not Found", status=404)
+    if not hmac.compare_digest(request.headers.get("X-Stats-Token", ""), expected):
+        return web.Response(text="Forbidden", status=403)
+    
+    from bot.services.metrics import collect_stats
+    return web.json_response(collect_stats())
+
+
 async def webhook_handler(request):
     """Обработчик webhook запросов от Telegram"""
     global bot, dp, bot_initialized
@@ -31,110 +52,225 @@ async def webhook_handler(request):
     
     try:
         from aiogram.types import Update
-        import json
         data = await request.json()
-        
-        # region agent log  
-        try:
-            with open(r'c:\PetProjects\Seeyay.ai\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                callback_data = data.get('callback_query', {}).get('data') if 'callback_query' in data else None
-                f.write(json.dumps({"sessionId":"debug-session","runId":"post-fix","hypothesisId":"F","location":"main.py:webhook","message":"Webhook received","data":{"update_type":"callback_query" if 'callback_query' in data else "message","callback_data":callback_data},"timestamp":__import__('time').time()*1000})+'\n')
-        except:
-            pass
-        # endregion
-        
         update = Update(**data)
-        await dp.feed_update(bot=bot, update=update)
-        return web.Response(text="OK", status=200)
     except Exception as e:
-        logger.error(f"Error processing update: {e}")
+        logger.error(f"Invalid update: {e}")
         return web.Response(text="Error", status=500)
-
+    
+    # Отвечаем сразу: апдейт обработают воркеры своей полосы
+    from bot.services.update_dispatcher import get_update_dispatcher
+    if not get_update_dispatcher().submit(update):
+        # Очередь переполнена или идёт остановка - Telegram повторит доставку
+        return web.Response(text="Busy", status=503)
+    return web.Response(text="OK", status=200)
 
 
 async def init_bot(app):
-    """Инициализация бота при запуске приложения"""
-    global bot, dp, bot_initialized
+    """
+    Инициализация бота при запуске приложения
+    До готовности выполняется только то, без чего нельзя принять апдейт; клиенты
+    Vertex AI, пул процессов и установка webhook прогреваются в фоне (warm_up_bot).
+    Длительность этапов логируется и попадает в /stats (pipeline: startup.*).
+    """
+    global bot, dp, bot_initialized, warm_up_task
+    
+    from bot.services.pipeline import StageTimings
+    startup = StageTimings("startup")
     
     try:
         logger.info("=== Initializing bot ===")
         sys.stdout.flush()
         
-        logger.info("Importing aiogram...")
-        sys.stdout.flush()
-        from aiogram import Bot, Dispatcher
-        from aiogram.fsm.storage.memory import MemoryStorage
-        from aiogram.client.default import DefaultBotProperties
-        from aiogram.enums import ParseMode
-        
-        logger.info("Importing bot.config...")
-        sys.stdout.flush()
-        from bot.config import get_settings
+        # Secret Manager и metadata server - в потоках, параллельно с импортами
+        from bot.config import load_settings
+        settings_task = startup.start("settings", load_settings())
+        await asyncio.sleep(0)
         
-        logger.info("Importing bot.handlers...")
-        sys.stdout.flush()
-        from bot.handlers import (
-            start_router,
-            template_selection_router,
-            energy_router,
-            photo_router,
-            dev_commands_router  # DEV ONLY - REMOVE BEFORE PROD
-        )
-        logger.info("All imports successful!")
-        sys.stdout.flush()
+        async with startup.stage("imports"):
+            logger.info("Importing aiogram...")
+            sys.stdout.flush()
+            from aiogram import Bot, Dispatcher
+            from aiogram.client.default import DefaultBotProperties
+            from aiogram.enums import ParseMode
+            
+            logger.info("Importing bot.handlers...")
+            sys.stdout.flush()
+            from bot.handlers import (
+                start_router,
+                template_selection_router,
+                energy_router,
+                photo_router,
+                dev_commands_router  # DEV ONLY - REMOVE BEFORE PROD
+            )
+            logger.info("All imports successful!")
+            sys.stdout.flush()
         
-        settings = get_settings()
+        settings = await settings_task
         logger.info(f"Got settings, token present: {bool(settings.bot_token)}")
         sys.stdout.flush()
         
-        # Создаём бота
-        logger.info("Creating bot instance...")
-        sys.stdout.flush()
-        bot = Bot(
-            token=settings.bot_token,
-            default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-        )
+        async with startup.stage("dispatcher"):
+            # Создаём бота
+            bot = Bot(
+                token=settings.bot_token,
+                default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+            )
+            
+            # Создаём диспетчер с хранилищем состояний
+            from bot.services.fsm_storage import create_fsm_storage
+            dp = Dispatcher(storage=create_fsm_storage())
+            
+            # Пользователь и pending selection - не больше одного чтения за апдейт
+            from bot.middlewares import create_user_context_middleware
+            dp.update.outer_middleware(create_user_context_middleware())
+            
+            # Регистрируем роутеры (порядок важен!)
+            dp.include_router(start_router)
+            dp.include_router(template_selection_router)
+            dp.include_router(energy_router)
+            dp.include_router(photo_router)
+            dp.include_router(dev_commands_router)  # DEV ONLY - REMOVE BEFORE PROD
+            logger.info("All routers registered!")
+            sys.stdout.flush()
         
-        # Создаём диспетчер с хранилищем состояний
-        logger.info("Creating dispatcher...")
-        sys.stdout.flush()
-        dp = Dispatcher(storage=MemoryStorage())
+        async with startup.stage("services"):
+            # Общий HTTP-клиент для файлов Telegram (keep-alive на всё время жизни приложения)
+            from bot.services.http_client import get_telegram_file_client
+            await get_telegram_file_client().start()
+            
+            # Планировщик анимации статусных сообщений
+            from bot.services.progress import get_progress_scheduler
+            await get_progress_scheduler().start(bot)
         
-        # Регистрируем роутеры (порядок важен!)
-        logger.info("Registering routers...")
-        sys.stdout.flush()
-        dp.include_router(start_router)
-        dp.include_router(template_selection_router)
-        dp.include_router(energy_router)
-        dp.include_router(photo_router)
-        dp.include_router(dev_commands_router)  # DEV ONLY - REMOVE BEFORE PROD
-        logger.info("All routers registered!")
+        # Запускаем воркеры очереди генераций
+        logger.info("Starting generation workers...")
         sys.stdout.flush()
+        async with startup.stage("generation_queue"):
+            from bot.services.generation_queue import get_generation_queue
+            from bot.handlers.photo import abandon_generation_job, process_generation_job
+            # Незавершённые задачи подхватываются в warm_up_bot
+            await get_generation_queue().start(
+                bot,
+                process_generation_job,
+                recover=False,
+                on_abandoned=abandon_generation_job
+            )
         
-        # Устанавливаем webhook
-        webhook_url = os.environ.get("WEBHOOK_URL")
-        if webhook_url:
-            logger.info(f"Setting webhook to {webhook_url}/webhook...")
-            sys.stdout.flush()
-            await bot.set_webhook(f"{webhook_url}/webhook")
-            logger.info(f"Webhook set successfully!")
-            sys.stdout.flush()
-        else:
-            logger.warning("WEBHOOK_URL not set!")
-            sys.stdout.flush()
+        # Фоновая обработка апдейтов (interactive / heavy)
+        from bot.services.update_dispatcher import get_update_dispatcher
+        get_update_dispatcher().start(dp, bot)
         
         bot_initialized = True
         logger.info("=== Bot initialized successfully! ===")
+        startup.finish()
         sys.stdout.flush()
         
+        warm_up_task = asyncio.create_task(warm_up_bot(settings))
+        
     except Exception as e:
         logger.error(f"=== FAILED to initialize bot: {e} ===", exc_info=True)
         sys.stdout.flush()
 
 
+async def warm_up_bot(settings):
+    """Прогрев после готовности: webhook, Vertex AI, пул процессов и незавершённые генерации - параллельно"""
+    from bot.services.pipeline import StageTimings
+    timings = StageTimings("warm_up")
+    
+    async def set_webhook():
+        webhook_url = os.environ.get("WEBHOOK_URL")
+        if not webhook_url:
+            logger.warning("WEBHOOK_URL not set!")
+            return
+        logger.info(f"Setting webhook to {webhook_url}/webhook...")
+        await bot.set_webhook(f"{webhook_url}/webhook")
+        logger.info("Webhook set successfully!")
+    
+    async def warm_up_vertex():
+        # Импорт vertexai (секунды) - в потоке, чтобы не блокировать обработку апдейтов
+        await asyncio.to_thread(importlib.import_module, "bot.services.vertex_ai")
+        from bot.services.vertex_ai import get_vertex_service
+        await get_vertex_service(settings.gcp_project_id).warm_up()
+    
+    async def warm_up_pool():
+        # Процессы пула обработки изображений (проверка качества фото - до списания энергии)
+        from bot.services.process_pool import warm_up_process_pool
+        await warm_up_process_pool()
+    
+    async def recover_jobs():
+        # Клиент Firestore при создании ищет учётные данные синхронно - в потоке
+        from bot.firestore import get_db
+        await asyncio.to_thread(get_db)
+        from bot.services.generation_queue import get_generation_queue
+        await get_generation_queue().recover()
+    
+    stages = {
+        "webhook": set_webhook(),
+        "vertex": warm_up_vertex(),
+        "process_pool": warm_up_pool(),
+        "recover_jobs": recover_jobs(),
+    }
+    results = await asyncio.gather(
+        *(timings.measure(name, stage) for name, stage in stages.items()),
+        return_exceptions=True
+    )
+    for stage_name, result in zip(stages, results):
+        if isinstance(result, Exception):
+            logger.error(f"Warm-up stage '{stage_name}' failed: {result}")
+    timings.finish()
+
+
 async def cleanup_bot(app):
     """Очистка при остановке"""
     global bot
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+    
+    try:
+        # Сначала дорабатываем принятые апдейты - они могут ставить задачи генерации
+        from bot.services.update_dispatcher import get_update_dispatcher
+        await get_update_dispatcher().stop()
+    except Exception as e:
+        logger.error(f"Error stopping update dispatcher: {e}")
+    
+    try:
+        from bot.services.generation_queue import get_generation_queue
+        await get_generation_queue().stop()
+    except Exception as e:
+        logger.error(f"Error stopping generation workers: {e}")
+    
+    try:
+        from bot.services.progress import get_progress_scheduler
+        await get_progress_scheduler().stop()
+    except Exception as e:
+        logger.error(f"Error stopping progress scheduler: {e}")
+    
+    # Сервис не создавался (быстрая остановка, прерванный прогрев) - не импортируем
+    # vertexai/aiplatform (секунды) в окне остановки Cloud Run
+    if "bot.services.vertex_ai" in sys.modules:
+        try:
+            from bot.services.vertex_ai import reset_vertex_service
+            reset_vertex_service()
+        except Exception as e:
+            logger.error(f"Error stopping Vertex AI executors: {e}")
+    
+    from bot.services.process_pool import shutdown_process_pool
+    shutdown_process_pool()
+    
+    if dp:
+        try:
+            # Дописываем отложенные изменения состояний FSM
+            await dp.storage.close()
+        except Exception as e:
+            logger.error(f"Error closing FSM storage: {e}")
+    
+    try:
+        from bot.services.http_client import get_telegram_file_client
+        await get_telegram_file_client().close()
+    except Exception as e:
+        logger.error(f"Error closing Telegram file client: {e}")
+    
     if bot:
         try:
             await bot.session.close()
@@ -155,6 +291,7 @@ def main():
     # Health check endpoints (всегда работают)
     app.router.add_get("/", health_check)
     app.router.add_get("/health", health_check)
+    app.router.add_get("/stats", stats_handler)
     
     # Webhook endpoint
     app.router.add_post("/webhook", webhook_handler)
@@ -41,24 +41,29 @@ def m3_config_onboarding(template_name: str, energy: int) -> str:
 📸 Пришли фото хорошего качества"""
 
 
-def m4_1_config_normal(template_name: str, energy: int) -> str:
+def _variants_line(variants: int) -> str:
+    """Строка с количеством вариантов (только если их больше одного)"""
+    return f"Вариантов: {variants}\n" if variants > 1 else ""
+
+
+def m4_1_config_normal(template_name: str, energy: int, variants: int = 1) -> str:
     """m4.1: Конфигурация генерации в обычном режиме (>=1 успешная генерация)"""
     return f"""<b>Выбран шаблон: {template_name}</b>
 
 Режим: обычный
-Стоимость: {energy}<b>⚡️</b>
+{_variants_line(variants)}Стоимость: {energy}<b>⚡️</b>
 
 <i>Для лучшей генерации:</i> используй PRO-режим (больше деталей и качества), сделай селфи с ровным светом, без фильтров
 
 📸 Пришли фото хорошего качества"""
 
 
-def m4_2_config_pro(template_name: str, energy: int) -> str:
+def m4_2_config_pro(template_name: str, energy: int, variants: int = 1) -> str:
     """m4.2: Конфигурация генерации в PRO-режиме (>=1 успешная генерация)"""
     return f"""<b>Выбран шаблон: {template_name}</b>
 
 Режим: 💎 PRO
-Стоимость: {energy}<b>⚡️</b>
+{_variants_line(variants)}Стоимость: {energy}<b>⚡️</b>
 
 <i>Для лучшей генерации:</i> сделай селфи с ровным светом, без фильтров
 
@@ -113,6 +118,59 @@ def m8_result_regular(template_name: str, balance: int) -> str:
 Баланс: {balance}<b>⚡️</b>"""
 
 
+def variants_failed_note(failed: int, refunded: int) -> str:
+    """Дополнение к результату, если часть вариантов не получилась"""
+    return f"""
+
+⚠️ Не получилось вариантов: {failed}
+Энергия возвращена: +{refunded}<b>⚡️</b>"""
+
+
+# Причина неудачи по итогу генерации (GenerationOutcome)
+_GENERATION_FAILED_REASONS = {
+    "blocked": "🚫 Фото или результат не прошли фильтры безопасности модели.",
+    "quota": "⏳ Сейчас слишком много желающих — модель перегружена.",
+    "malformed": "❌ Модель не смогла обработать это фото.",
+    "deadline": "⌛ Генерация заняла слишком много времени.",
+}
+
+# Что посоветовать пользователю
+_GENERATION_FAILED_HINTS = {
+    "blocked": "Попробуйте другое фото или выберите другой стиль.",
+    "malformed": "Попробуйте другое фото или выберите другой стиль.",
+}
+
+
+def generation_failed(outcome: str, refunded: int) -> str:
+    """Сообщение о неудачной генерации с возвратом энергии"""
+    reason = _GENERATION_FAILED_REASONS.get(outcome, "❌ К сожалению, не удалось сгенерировать изображение.")
+    hint = _GENERATION_FAILED_HINTS.get(outcome, "Попробуйте ещё раз позже.")
+    return f"""{reason}
+Энергия возвращена: +{refunded} ⚡
+
+{hint}"""
+
+
+# Подсказки при отклонении фото (PhotoRejection)
+_PHOTO_REJECTED_HINTS = {
+    "too_small": "Фото слишком маленькое — лицо не получится передать точно. Пришлите фото в лучшем качестве.",
+    "bad_aspect": "Похоже на скриншот или панораму. Пришлите обычное фото, где хорошо видно лицо.",
+    "too_dark": "Фото слишком тёмное. Сфотографируйтесь при хорошем освещении.",
+    "too_bright": "Фото пересвечено. Попробуйте снимок без яркого света в кадр.",
+    "blurred": "Фото размыто. Пришлите чёткий снимок — лицо должно быть в фокусе.",
+}
+
+
+def photo_rejected(reason: str) -> str:
+    """Фото не подходит для генерации (энергия не списана)"""
+    hint = _PHOTO_REJECTED_HINTS.get(reason, "Пришлите другое фото.")
+    return f"""📷 <b>Это фото не подойдёт для генерации</b>
+
+{hint}
+
+Энергия не списана."""
+
+
 def m9_starter_pack(current_balance: int, needed_energy: int) -> str:
     """m9: Стартер-пак для новых пользователей (1 раз)"""
     return f"""😯 <b>Не хватает энергии для генерации. Продолжим?</b>
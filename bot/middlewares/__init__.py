@@ -0,0 +1,7 @@
+from .user_context import UserContext, UserContextMiddleware, create_user_context_middleware
+
+__all__ = [
+    "UserContext",
+    "UserContextMiddleware",
+    "create_user_context_middleware"
+]
@@ -0,0 +1,175 @@
+"""
+Request-scoped user context
+Документ пользователя и pending selection читаются из Firestore не больше одного
+раза за апдейт: outer middleware кладёт в данные хендлера UserContext, который
+загружает их при первом обращении и запоминает. Хендлер, изменивший пользователя
+(списание энергии, флаги, timestamps), обновляет копию в контексте - следующие
+обращения в том же апдейте видят новые значения без повторного чтения.
+Middleware считает чтения Firestore за апдейт (track_reads) и отмечает апдейты,
+превысившие бюджет. Состояние FSM читается раньше (FSMContextMiddleware aiogram)
+и кэшируется своим хранилищем - в счётчик не входит.
+"""
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from bot.firestore import (
+    clear_pending_style_selection,
+    ensure_user_exists,
+    get_pending_style_selection,
+    get_user,
+    track_reads
+)
+from bot.services.hedging import LatencyTracker
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class _Memo:
+    """Значение, загружаемое один раз (одновременные обращения ждут одну загрузку)"""
+
+    def __init__(self, load: Callable[[], Awaitable[Any]]):
+        self._load = load
+        self._task: Optional[asyncio.Future] = None
+        self.loaded = False
+        self.value: Any = None
+
+    async def get(self) -> Any:
+        if not self.loaded:
+            if self._task is None:
+                self._task = asyncio.ensure_future(self._load())
+            value = await asyncio.shield(self._task)
+            # Пока читали, значение могли заменить (set) - локальная версия новее
+            if not self.loaded:
+                self.set(value)
+        return self.value
+
+    def set(self, value: Any):
+        self.value = value
+        self.loaded = True
+
+
+class UserContext:
+    """Данные пользователя в пределах одного апдейта"""
+
+    def __init__(self, telegram_id: int, reads: Optional[Counter] = None):
+        """
+        Args:
+            telegram_id: Пользователь апдейта
+            reads: Счётчик чтений Firestore апдейта (track_reads)
+        """
+        self.telegram_id = telegram_id
+        self.reads = reads if reads is not None else Counter()
+        self._user = _Memo(lambda: get_user(telegram_id))
+        self._pending = _Memo(lambda: get_pending_style_selection(telegram_id))
+
+    @property
+    def read_count(self) -> int:
+        return sum(self.reads.values())
+
+    async def get_user(self) -> Optional[Dict[str, Any]]:
+        """Документ пользователя (None - не найден или ошибка чтения)"""
+        return await self._user.get()
+
+    async def ensure_user(self, username: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """Пользователь, созданный при необходимости; второй элемент - создан ли он сейчас"""
+        user = await self.get_user()
+        if user is not None:
+            return user, False
+        user = await ensure_user_exists(self.telegram_id, username)
+        self._user.set(user)
+        return user, user is not None
+
+    def set_user(self, user: Optional[Dict[str, Any]]):
+        """Заменить пользователя актуальной версией (например, результатом транзакции)"""
+        self._user.set(user)
+
+    def update_user(self, fields: Dict[str, Any]):
+        """Применить к загруженному пользователю поля, успешно записанные в Firestore"""
+        if self._user.loaded and self._user.value is not None:
+            self._user.value.update(fields)
+
+    async def get_pending(self) -> Optional[Dict[str, Any]]:
+        """Pending selection из Mini App (None - нет)"""
+        return await self._pending.get()
+
+    async def clear_pending(self) -> bool:
+        """Удалить pending selection (уже прочитанный документ удаляется без чтения)"""
+        known_exists = self._pending.loaded and self._pending.value is not None
+        cleared = await clear_pending_style_selection(self.telegram_id, known_exists=known_exists)
+        self._pending.set(None)
+        return cleared
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Outer middleware апдейтов: UserContext в данных хендлера и учёт чтений Firestore"""
+
+    def __init__(self, read_budget: int = 3):
+        """
+        Args:
+            read_budget: Ожидаемый максимум чтений Firestore на апдейт; превышение
+                логируется и считается в /stats (0 - не проверять)
+        """
+        self.read_budget = read_budget
+
+        self._updates = 0
+        self._reads: Counter = Counter()
+        self._max_reads = 0
+        self._over_budget = 0
+        self._per_update = LatencyTracker(window=1000)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        with track_reads() as reads:
+            context = UserContext(user.id, reads)
+            data["user_context"] = context
+            try:
+                return await handler(event, data)
+            finally:
+                self._record(event, context)
+
+    def _record(self, event: TelegramObject, context: UserContext):
+        count = context.read_count
+        self._updates += 1
+        self._reads.update(context.reads)
+        self._max_reads = max(self._max_reads, count)
+        self._per_update.record(count)
+        if self.read_budget and count > self.read_budget:
+            self._over_budget += 1
+            logger.warning(
+                f"Update {getattr(event, 'update_id', '?')} for user {context.telegram_id}: "
+                f"{count} Firestore reads (budget {self.read_budget}): {dict(context.reads)}"
+            )
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = sum(self._reads.values())
+        return {
+            "updates": self._updates,
+            "reads": dict(self._reads),
+            "avg_reads": round(total / self._updates, 2) if self._updates else 0.0,
+            "p95_reads": self._per_update.percentile(0.95),
+            "max_reads": self._max_reads,
+            "read_budget": self.read_budget,
+            "over_budget": self._over_budget,
+        }
+
+
+def create_user_context_middleware() -> UserContextMiddleware:
+    """Middleware контекста пользователя по настройкам"""
+    from bot.config import get_settings
+    middleware = UserContextMiddleware(read_budget=get_settings().user_context_read_budget)
+    register_stats_provider("user_context", middleware.get_stats)
+    return middleware
@@ -1,3 +1,10 @@
-from .vertex_ai import VertexAIService, get_vertex_service
-
+# vertex_ai тянет vertexai/aiplatform (секунды на импорт) - импортируем при первом обращении,
+# чтобы импорт лёгких сервисов (и процессы пула изображений) его не оплачивали
 __all__ = ["VertexAIService", "get_vertex_service"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import vertex_ai
+        return getattr(vertex_ai, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,194 @@
+"""
+Circuit breaker for model endpoints
+Предохранитель на пару (модель, location): при высокой доле ошибок или медленных
+ответов вызовы сразу отклоняются (энергия возвращается без ожидания retry),
+через паузу пропускается пробный запрос; пауза растёт экспоненциально,
+пока пробные запросы не проходят.
+"""
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён: предохранитель открыт"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit {name} is open (retry in {retry_in:.0f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Предохранитель одного endpoint"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = 30.0,
+        min_calls: int = 5,
+        error_rate: float = 0.5,
+        slow_call_seconds: float = 60.0,
+        slow_rate: float = 0.5,
+        open_seconds: float = 15.0,
+        max_open_seconds: float = 300.0,
+        half_open_calls: int = 1
+    ):
+        """
+        Args:
+            name: Имя endpoint (для логов и метрик)
+            window_seconds: Окно, по которому считаются доли ошибок и медленных вызовов
+            min_calls: Минимум вызовов в окне для срабатывания
+            error_rate: Доля ошибок, при которой предохранитель открывается
+            slow_call_seconds: Вызов дольше этого считается медленным
+            slow_rate: Доля медленных вызовов, при которой предохранитель открывается
+            open_seconds: Начальная пауза перед пробным запросом
+            max_open_seconds: Максимальная пауза (после неудачных проб пауза удваивается)
+            half_open_calls: Сколько пробных запросов пропускать одновременно
+        """
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.half_open_calls = half_open_calls
+
+        self.state = self.CLOSED
+        # (время, ошибка, медленный)
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._opened_at = 0.0
+        self._open_for = open_seconds
+        self._trials = 0
+
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Можно ли сделать вызов (в half-open - пробный)"""
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self._open_for:
+                self.rejected += 1
+                return False
+            self._transition(self.HALF_OPEN)
+
+        if self._trials >= self.half_open_calls:
+            self.rejected += 1
+            return False
+        self._trials += 1
+        return True
+
+    def retry_in(self) -> float:
+        """Через сколько секунд будет пробный запрос"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(self._opened_at + self._open_for - time.monotonic(), 0.0)
+
+    def record_success(self, latency: float):
+        slow = latency >= self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            self._trials = max(self._trials - 1, 0)
+            if slow:
+                self._reopen()
+            else:
+                self._open_for = self.open_seconds
+                self._transition(self.CLOSED)
+            return
+        self._record(False, slow)
+
+    def record_failure(self):
+        if self.state == self.HALF_OPEN:
+            self._trials = max(self._trials - 1, 0)
+            self._reopen()
+            return
+        self._record(True, False)
+
+    def release(self):
+        """Пробный вызов отменён без результата"""
+        if self.state == self.HALF_OPEN:
+            self._trials = max(self._trials - 1, 0)
+
+    def _record(self, error: bool, slow: bool):
+        now = time.monotonic()
+        self._calls.append((now, error, slow))
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+        if self.state != self.CLOSED or len(self._calls) < self.min_calls:
+            return
+        errors, slows = self._rates()
+        if errors >= self.error_rate or slows >= self.slow_rate:
+            logger.warning(
+                f"Circuit {self.name} opened: error rate {errors:.0%}, slow rate {slows:.0%}"
+            )
+            self._open()
+
+    def _rates(self) -> Tuple[float, float]:
+        if not self._calls:
+            return 0.0, 0.0
+        total = len(self._calls)
+        errors = sum(1 for _, error, _ in self._calls if error)
+        slows = sum(1 for _, _, slow in self._calls if slow)
+        return errors / total, slows / total
+
+    def _open(self):
+        self.opened += 1
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self._transition(self.OPEN)
+
+    def _reopen(self):
+        """Пробный запрос не прошёл - пауза удваивается (с разбросом)"""
+        self._open_for = min(
+            self._open_for * 2 * random.uniform(0.8, 1.2),
+            self.max_open_seconds
+        )
+        logger.warning(f"Circuit {self.name} probe failed, next probe in {self._open_for:.0f}s")
+        self._open()
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.info(f"Circuit {self.name}: {self.state} -> {state}")
+            self.state = state
+            self._trials = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        errors, slows = self._rates()
+        return {
+            "state": self.state,
+            "error_rate": round(errors, 3),
+            "slow_rate": round(slows, 3),
+            "calls_in_window": len(self._calls),
+            "retry_in_s": round(self.retry_in(), 1),
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreakerRegistry:
+    """Предохранители по endpoint (создаются при первом обращении)"""
+
+    def __init__(self, **breaker_options):
+        self._options = breaker_options
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        if name not in self._breakers:
+            self._breakers[name] = CircuitBreaker(name, **self._options)
+        return self._breakers[name]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {name: breaker.get_stats() for name, breaker in self._breakers.items()}
@@ -0,0 +1,69 @@
+"""
+End-to-end deadline for a generation
+Один дедлайн на генерацию передаётся через все этапы (скачивание, вызовы
+модели, повторы, отправка); каждый этап получает оставшееся время.
+Когда время вышло, этап отменяется, а этап, на котором это случилось,
+запоминается для записи в документ генерации.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Optional
+
+
+class DeadlineExceeded(Exception):
+    """Время генерации вышло"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded at stage '{stage}'")
+        self.stage = stage
+
+
+class Deadline:
+    """Абсолютный срок выполнения генерации"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.expires_at = self.started + timeout
+        self.expired_stage: Optional[str] = None
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def _expire(self, stage: str) -> DeadlineExceeded:
+        if self.expired_stage is None:
+            self.expired_stage = stage
+        return DeadlineExceeded(stage)
+
+    def check(self, stage: str):
+        """Не начинать этап, если время уже вышло"""
+        if self.expired:
+            raise self._expire(stage)
+
+    async def run(self, stage: str, awaitable: Awaitable, min_budget: float = 0.0) -> Any:
+        """
+        Выполнить этап в пределах оставшегося времени.
+        min_budget - гарантированное время этапа, даже если общий срок почти вышел
+        (например, чтобы отправить уже готовый результат).
+        """
+        budget = max(self.remaining(), min_budget)
+        if budget <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            elif isinstance(awaitable, asyncio.Future):
+                awaitable.cancel()
+            raise self._expire(stage)
+        try:
+            return await asyncio.wait_for(awaitable, budget)
+        except asyncio.TimeoutError:
+            raise self._expire(stage) from None
+
+    async def sleep(self, stage: str, delay: float):
+        """Пауза между попытками, не дольше оставшегося времени"""
+        if delay >= self.remaining():
+            raise self._expire(stage)
+        await asyncio.sleep(delay)
@@ -0,0 +1,265 @@
+"""
+Shared FSM storage on Firestore
+Состояние и данные FSM хранятся в коллекции fsm_states, поэтому апдейт
+пользователя может обработать любой инстанс Cloud Run. Чтения идут через
+локальный LRU-кэш с коротким TTL (фильтры, хендлер и update_data одного апдейта
+читают документ один раз), записи одного ключа за flush_delay объединяются
+в одну (update_data + set_state - одна запись). Неудачная запись повторяется
+с паузой; незаписанное состояние остаётся в кэше и дописывается следующим flush.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    """Состояние одного ключа в локальном кэше"""
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+        self.loaded_at = time.monotonic()
+        # Изменён локально и ещё не записан в Firestore
+        self.dirty = False
+        self.flush_task: Optional[asyncio.Task] = None
+
+
+class FirestoreStorage(BaseStorage):
+    """FSM storage на Firestore с локальным read-through кэшем и объединением записей"""
+
+    COLLECTION = "fsm_states"
+
+    def __init__(
+        self,
+        cache_ttl: float = 5.0,
+        max_entries: int = 10000,
+        flush_delay: float = 0.05,
+        state_ttl_days: int = 30,
+        flush_retries: int = 3,
+        flush_backoff: float = 0.5
+    ):
+        """
+        Args:
+            cache_ttl: Сколько секунд доверять локальной копии (столько же может
+                жить чужое изменение, сделанное другим инстансом)
+            max_entries: Максимум ключей в локальном кэше (LRU)
+            flush_delay: Окно объединения записей одного ключа (сек)
+            state_ttl_days: Срок хранения документа после последнего изменения
+                (поле expires_at для TTL-политики Firestore)
+            flush_retries: Сколько раз повторить неудачную запись
+            flush_backoff: Пауза перед первым повтором (сек), дальше удваивается
+        """
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.flush_delay = flush_delay
+        self.state_ttl_days = state_ttl_days
+        self.flush_retries = flush_retries
+        self.flush_backoff = flush_backoff
+        self._records: "OrderedDict[str, _Record]" = OrderedDict()
+        # Чтения одного ключа, идущие одновременно, ждут один запрос
+        self._loading: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.reads = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.retries = 0
+
+    @staticmethod
+    def _doc_id(key: StorageKey) -> str:
+        parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(str(key.thread_id))
+        if key.destiny != "default":
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    def _collection(self):
+        from bot.firestore import get_db
+        return get_db().collection(self.COLLECTION)
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        doc_id = self._doc_id(key)
+        record = self._records.get(doc_id)
+        if record is not None and (
+            record.dirty or time.monotonic() - record.loaded_at < self.cache_ttl
+        ):
+            self.hits += 1
+            self._records.move_to_end(doc_id)
+            return record
+
+        loading = self._loading.get(doc_id)
+        if loading is not None:
+            self.hits += 1
+            return await asyncio.shield(loading)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[doc_id] = future
+        try:
+            record = await self._load(doc_id)
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._loading.pop(doc_id, None)
+        future.set_result(record)
+        return record
+
+    async def _load(self, doc_id: str) -> _Record:
+        self.reads += 1
+        try:
+            doc = await self._collection().document(doc_id).get()
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error reading FSM state {doc_id}: {e}")
+            stale = self._records.get(doc_id)
+            # Лучше устаревшее состояние этого инстанса, чем потерянное
+            return stale if stale is not None else _Record()
+
+        stored = doc.to_dict() if doc.exists else {}
+        record = self._records.get(doc_id)
+        if record is not None and record.dirty:
+            # Пока читали, состояние изменили локально - локальная версия новее
+            return record
+        record = _Record(stored.get("state"), stored.get("data") or {})
+        self._put(doc_id, record)
+        return record
+
+    def _put(self, doc_id: str, record: _Record):
+        self._records[doc_id] = record
+        self._records.move_to_end(doc_id)
+        # Вытесняем самые старые записанные ключи (незаписанные дождутся flush)
+        while len(self._records) > self.max_entries:
+            oldest_id = next(
+                (candidate for candidate, candidate_record in self._records.items()
+                 if not candidate_record.dirty),
+                None
+            )
+            if oldest_id is None:
+                break
+            del self._records[oldest_id]
+
+    def _mark_dirty(self, doc_id: str, record: _Record):
+        record.loaded_at = time.monotonic()
+        flushing = record.flush_task is not None and not record.flush_task.done()
+        if record.dirty and flushing:
+            self.coalesced += 1
+            return
+        record.dirty = True
+        # Запись, не дописанная после всех повторов, уходит вместе со следующим изменением
+        if not flushing:
+            record.flush_task = asyncio.create_task(self._flush_later(doc_id, record))
+
+    async def _flush_later(self, doc_id: str, record: _Record):
+        await asyncio.sleep(self.flush_delay)
+        await self._flush(doc_id, record)
+
+    async def _flush(self, doc_id: str, record: _Record) -> bool:
+        """Записать изменения ключа; False - запись не удалась после всех повторов"""
+        attempt = 0
+        while record.dirty:
+            record.dirty = False
+            state, data = record.state, dict(record.data)
+            doc_ref = self._collection().document(doc_id)
+            self.writes += 1
+            try:
+                if state is None and not data:
+                    await doc_ref.delete()
+                else:
+                    now = datetime.utcnow()
+                    await doc_ref.set({
+                        "state": state,
+                        "data": data,
+                        "updated_at": now,
+                        "expires_at": now + timedelta(days=self.state_ttl_days),
+                    })
+            except Exception as e:
+                self.errors += 1
+                # Изменение не записано - запись остаётся dirty и не вытесняется из кэша
+                record.dirty = True
+                if attempt >= self.flush_retries:
+                    logger.error(f"Error writing FSM state {doc_id}, giving up after {attempt + 1} attempts: {e}")
+                    return False
+                delay = self.flush_backoff * 2 ** attempt
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Error writing FSM state {doc_id}, retry in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+        return True
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(self._doc_id(key), record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(self._doc_id(key), record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_record(key)).data.copy()
+
+    async def close(self) -> None:
+        """Дописать отложенные изменения (RuntimeError - часть состояний не записана)"""
+        # Сначала дожидаемся идущих flush, чтобы не писать один документ дважды
+        await asyncio.gather(*(
+            record.flush_task
+            for record in self._records.values()
+            if record.flush_task is not None and not record.flush_task.done()
+        ), return_exceptions=True)
+        pending = [
+            (doc_id, record)
+            for doc_id, record in self._records.items()
+            if record.dirty
+        ]
+        results = await asyncio.gather(*(self._flush(doc_id, record) for doc_id, record in pending))
+        lost = [doc_id for (doc_id, _), written in zip(pending, results) if not written]
+        if lost:
+            raise RuntimeError(f"{len(lost)} FSM states not written: {', '.join(lost[:10])}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._records),
+            "dirty": sum(1 for record in self._records.values() if record.dirty),
+            "hits": self.hits,
+            "reads": self.reads,
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "retries": self.retries,
+        }
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище FSM по настройкам (memory - только для локального запуска)"""
+    from bot.config import get_settings
+    settings = get_settings()
+    if settings.fsm_storage == "memory":
+        from aiogram.fsm.storage.memory import MemoryStorage
+        return MemoryStorage()
+
+    storage = FirestoreStorage(
+        cache_ttl=settings.fsm_cache_ttl_seconds,
+        max_entries=settings.fsm_cache_max_entries,
+        flush_delay=settings.fsm_flush_delay_seconds,
+        state_ttl_days=settings.fsm_state_ttl_days,
+        flush_retries=settings.fsm_flush_retries,
+        flush_backoff=settings.fsm_flush_backoff_seconds
+    )
+    register_stats_provider("fsm_storage", storage.get_stats)
+    return storage
@@ -0,0 +1,291 @@
+"""
+Durable generation job queue
+Задачи хранятся в коллекции bot_generation_jobs (Firestore), а локальный asyncio.Queue
+раздаёт их ограниченному пулу воркеров. Webhook-обработчик только ставит задачу
+в очередь и сразу возвращает ответ Telegram.
+Задача, прерванная остановкой инстанса, возвращается в pending; задачи с истёкшей
+арендой (инстанс упал) периодически подбираются заново (sweep). Задача, исчерпавшая
+max_attempts захватов, закрывается обработчиком отказа (возврат энергии).
+Поставленная задача арендована инстансом, в чьей локальной очереди она ждёт
+(там же уже начатое скачивание и срок) - sweep других инстансов её не трогает.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from bot.services.metrics import register_stats_provider
+from bot.firestore import (
+    create_generation_job,
+    claim_generation_job,
+    release_generation_job,
+    update_generation_job,
+    list_active_generation_jobs
+)
+
+logger = logging.getLogger(__name__)
+
+# processor(bot, job) - выполняет генерацию и доставку результата.
+# Отвечает за финальный статус задачи (completed/failed) и возврат энергии.
+# Тем же типом задаётся обработчик задачи, закрытой после max_attempts (возврат энергии).
+JobProcessor = Callable[[Any, Dict[str, Any]], Awaitable[None]]
+
+
+class GenerationQueue:
+    """Очередь задач генерации с пулом асинхронных воркеров"""
+
+    # Сколько секунд задача считается занятой воркером
+    LEASE_SECONDS = 300
+
+    def __init__(
+        self,
+        workers: int = 8,
+        lease_seconds: int = LEASE_SECONDS,
+        sweep_interval: float = 60.0,
+        max_attempts: int = 3
+    ):
+        """
+        Args:
+            workers: Число воркеров
+            lease_seconds: Аренда задачи воркером; после неё задачу может перехватить другой
+            sweep_interval: Как часто подбирать незавершённые задачи с истёкшей арендой (0 - только при старте)
+            max_attempts: Сколько раз задачу можно захватить; дальше она закрывается как failed (0 - без ограничения)
+        """
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.sweep_interval = sweep_interval
+        self.max_attempts = max_attempts
+        self.instance_id = os.environ.get("K_REVISION", socket.gethostname()) + f"-{os.getpid()}"
+
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._payloads: Dict[str, Dict[str, Any]] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+        self._sweep_task: Optional[asyncio.Task] = None
+        self._processor: Optional[JobProcessor] = None
+        self._on_abandoned: Optional[JobProcessor] = None
+        self._bot = None
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._requeued = 0
+        self._recovered = 0
+        self._abandoned = 0
+
+        logger.info(f"GenerationQueue created: workers={workers}, instance={self.instance_id}")
+
+    @property
+    def running(self) -> bool:
+        return bool(self._worker_tasks)
+
+    async def start(
+        self,
+        bot,
+        processor: JobProcessor,
+        recover: bool = True,
+        on_abandoned: Optional[JobProcessor] = None
+    ):
+        """
+        Запустить воркеры и подхватить незавершённые задачи (recover=False - подхватить позже через recover()).
+        on_abandoned(bot, job) вызывается для задачи, закрытой после max_attempts захватов.
+        """
+        if self.running:
+            return
+
+        self._bot = bot
+        self._processor = processor
+        self._on_abandoned = on_abandoned
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(i), name=f"generation-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} generation workers")
+        if self.sweep_interval > 0:
+            self._sweep_task = asyncio.create_task(self._sweep(), name="generation-sweep")
+
+        if recover:
+            await self.recover()
+
+    async def stop(self):
+        """
+        Остановить воркеры. Задачи в работе возвращаются в pending, с задач из
+        локальной очереди снимается аренда - их сразу подхватит другой инстанс.
+        """
+        tasks = list(self._worker_tasks)
+        if self._sweep_task is not None:
+            tasks.append(self._sweep_task)
+            self._sweep_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+            self._queue.task_done()
+        for job_id in queued:
+            for value in self._payloads.pop(job_id, {}).values():
+                if isinstance(value, asyncio.Task):
+                    value.cancel()
+        if queued:
+            await asyncio.gather(*(
+                release_generation_job(job_id, self.instance_id) for job_id in queued
+            ))
+            logger.info(f"Released {len(queued)} queued generation jobs")
+        logger.info("Generation workers stopped")
+
+    async def submit(
+        self,
+        job: Dict[str, Any],
+        local: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        """
+        Сохранить задачу в Firestore и поставить в локальную очередь
+        
+        Args:
+            job: Поля задачи (сохраняются в Firestore)
+            local: Данные только для этого инстанса (например, уже начатое
+                скачивание фото) - после рестарта их не будет
+        
+        Returns id задачи или None, если сохранить не удалось
+        """
+        job_id = await create_generation_job(job, owner=self.instance_id, lease_seconds=self.lease_seconds)
+        if not job_id:
+            return None
+
+        self._payloads[job_id] = {**job, **(local or {})}
+        self._queue.put_nowait(job_id)
+        logger.info(f"Generation job {job_id} queued (depth: {self._queue.qsize()})")
+        return job_id
+
+    async def recover(self):
+        """
+        Поставить в очередь незавершённые задачи из Firestore, кроме арендованных:
+        в работе у воркера или в локальной очереди другого живого инстанса
+        """
+        jobs = await list_active_generation_jobs()
+        now = datetime.now(timezone.utc)
+        recovered = 0
+        for job in jobs:
+            if job["id"] in self._payloads:
+                continue
+            lease_expires_at = job.get("lease_expires_at")
+            if lease_expires_at and lease_expires_at > now:
+                continue
+            self._payloads[job["id"]] = {}
+            self._queue.put_nowait(job["id"])
+            recovered += 1
+
+        self._recovered += recovered
+        if recovered:
+            logger.info(f"Recovered {recovered} unfinished generation jobs")
+
+    async def _sweep(self):
+        """Периодически подбирать задачи, брошенные упавшими или остановленными инстансами"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.recover()
+            except Exception as e:
+                logger.error(f"Generation jobs sweep failed: {e}")
+
+    async def _worker(self, index: int):
+        """Цикл воркера: захват задачи -> обработка"""
+        worker_id = f"{self.instance_id}/{index}"
+
+        while True:
+            job_id = await self._queue.get()
+            payload = self._payloads.pop(job_id, {})
+            try:
+                job = await claim_generation_job(
+                    job_id,
+                    worker_id,
+                    self.lease_seconds,
+                    self.max_attempts,
+                    instance_id=self.instance_id
+                )
+                if job and job.get("status") == "failed":
+                    # Задача раз за разом не доходит до конца (роняет инстанс) - больше не запускаем
+                    self._abandoned += 1
+                    logger.error(f"Generation job {job_id} abandoned after {job.get('attempts')} attempts")
+                    if self._on_abandoned is not None:
+                        await self._on_abandoned(self._bot, job)
+                    continue
+                if not job:
+                    logger.info(f"Generation job {job_id} already taken or finished, skipping")
+                    # Начатые для задачи фоновые этапы больше не нужны
+                    for value in payload.values():
+                        if isinstance(value, asyncio.Task):
+                            value.cancel()
+                    continue
+
+                # Локальные поля (не сохраняемые в Firestore) имеют приоритет
+                job.update(payload)
+                job["id"] = job_id
+
+                self._in_flight += 1
+                started = time.monotonic()
+                try:
+                    await self._processor(self._bot, job)
+                    self._processed += 1
+                except asyncio.CancelledError:
+                    # Остановка инстанса: незавершённую задачу сразу отдаём другим
+                    # воркерам, не дожидаясь истечения аренды
+                    if await release_generation_job(job_id, worker_id):
+                        self._requeued += 1
+                        logger.info(f"Generation job {job_id} interrupted, returned to pending")
+                    raise
+                finally:
+                    self._in_flight -= 1
+
+                logger.info(f"Generation job {job_id} done in {time.monotonic() - started:.1f}s")
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._failed += 1
+                logger.error(f"Generation job {job_id} crashed: {e}", exc_info=True)
+                await update_generation_job(job_id, {"status": "failed", "error": str(e)})
+            finally:
+                self._queue.task_done()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние очереди для мониторинга"""
+        return {
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize(),
+            "in_flight": self._in_flight,
+            "processed": self._processed,
+            "failed": self._failed,
+            "requeued": self._requeued,
+            "recovered": self._recovered,
+            "abandoned": self._abandoned,
+        }
+
+
+# Синглтон для переиспользования
+_generation_queue: Optional[GenerationQueue] = None
+
+
+def get_generation_queue() -> GenerationQueue:
+    """Получить инстанс очереди генераций (синглтон)"""
+    global _generation_queue
+    if _generation_queue is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        _generation_queue = GenerationQueue(
+            workers=settings.generation_workers,
+            sweep_interval=settings.generation_sweep_seconds,
+            max_attempts=settings.generation_max_attempts
+        )
+        register_stats_provider("generation_queue", _generation_queue.get_stats)
+    return _generation_queue
+
+
+def reset_generation_queue():
+    """Сбросить синглтон (для тестирования)"""
+    global _generation_queue
+    _generation_queue = None
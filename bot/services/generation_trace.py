@@ -0,0 +1,73 @@
+"""
+Generation trace
+Что происходило с запросом к модели: в какие регионы он уходил, сколько
+ждал и чем закончилась каждая попытка. Сохраняется в документ генерации,
+чтобы сравнивать регионы.
+"""
+from typing import Any, Dict, List, Optional
+
+
+class GenerationOutcome:
+    """Итог генерации (по ответу модели или классу ошибки)"""
+
+    SUCCESS = "success"
+    # Временная ошибка (5xx, обрыв соединения, пустой ответ) - имеет смысл повторить
+    TRANSIENT = "transient"
+    # 429 / квота не освободилась
+    QUOTA = "quota"
+    # Фильтры безопасности: запрос или ответ заблокирован - повтор даст то же самое
+    BLOCKED = "blocked"
+    # Ответ без изображения или некорректный запрос - повтор не поможет
+    MALFORMED = "malformed"
+    # Вышел общий срок генерации
+    DEADLINE = "deadline"
+
+    RETRYABLE = frozenset({TRANSIENT})
+
+
+class GenerationTrace:
+    """Попытки вызова модели в рамках одной генерации"""
+
+    def __init__(self):
+        self.attempts: List[Dict[str, Any]] = []
+        self.cache_hit = False
+        # Итог (GenerationOutcome) и подробность (finish_reason, класс ошибки)
+        self.outcome: Optional[str] = None
+        self.outcome_detail: Optional[str] = None
+        # Текущее место в очереди за квотой модели (0 - не ждёт)
+        self.queue_position = 0
+        self.max_queue_position = 0
+
+    def add_attempt(self, model: str, location: str, latency: Optional[float], outcome: str):
+        self.attempts.append({
+            "model": model,
+            "location": location,
+            "latency_ms": round(latency * 1000) if latency is not None else None,
+            "outcome": outcome,
+        })
+
+    def set_outcome(self, outcome: str, detail: Optional[str] = None):
+        self.outcome = outcome
+        self.outcome_detail = detail
+
+    def set_queue_position(self, position: int):
+        self.queue_position = position
+        self.max_queue_position = max(self.max_queue_position, position)
+
+    @property
+    def location(self) -> Optional[str]:
+        """Регион, который вернул ответ"""
+        for attempt in reversed(self.attempts):
+            if attempt["outcome"] == "ok":
+                return attempt["location"]
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "location": self.location,
+            "outcome": self.outcome,
+            "outcome_detail": self.outcome_detail,
+            "cache_hit": self.cache_hit,
+            "max_queue_position": self.max_queue_position,
+            "attempts": self.attempts,
+        }
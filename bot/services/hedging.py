@@ -0,0 +1,241 @@
+"""
+Hedged requests to the model
+Если вызов не вернулся за перцентиль недавних задержек модели, запускается
+второй такой же запрос; побеждает первый ответ, проигравший отменяется.
+Доля хеджированных вызовов ограничена бюджетом на режим.
+Перцентиль считается по длительности самих вызовов модели (record_latency) -
+ожидание квоты и слота в него не входит, иначе очередь сдвигала бы порог.
+Хедж не запускается, если у режима нет свободного слота (has_capacity).
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(values, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных вызовов одной модели"""
+
+    def __init__(self, window: int = 500):
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float):
+        self._latencies.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def percentile(self, q: float) -> float:
+        return _percentile(self._latencies, q)
+
+
+class HedgeStats:
+    """Метрики хеджирования одного режима: выигрыш по хвосту против лишних вызовов"""
+
+    WINDOW = 1000
+
+    def __init__(self):
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self.capacity_denied = 0
+        # Задержка первого запроса (для отменённых - нижняя граница)
+        self._primary: Deque[float] = deque(maxlen=self.WINDOW)
+        # Задержка, которую увидел пользователь
+        self._effective: Deque[float] = deque(maxlen=self.WINDOW)
+
+    def record(self, primary_latency: float, effective_latency: float):
+        self._primary.append(primary_latency)
+        self._effective.append(effective_latency)
+
+    def get_stats(self) -> Dict[str, Any]:
+        primary_p99 = _percentile(self._primary, 0.99)
+        effective_p99 = _percentile(self._effective, 0.99)
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "capacity_denied": self.capacity_denied,
+            # Лишние вызовы модели относительно всех
+            "extra_spend": round(self.hedged / self.calls, 3) if self.calls else 0.0,
+            "primary_p99_ms": round(primary_p99 * 1000, 1),
+            "effective_p99_ms": round(effective_p99 * 1000, 1),
+            "p99_saved_ms": round((primary_p99 - effective_p99) * 1000, 1),
+        }
+
+
+class HedgePolicy:
+    """Политика хеджирования вызовов модели"""
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        budget: float = 0.1,
+        min_samples: int = 20,
+        min_delay: float = 1.0,
+        cancel_loser: bool = True
+    ):
+        """
+        Args:
+            percentile: Перцентиль задержек модели, после которого запускается второй запрос
+            budget: Максимальная доля хеджированных вызовов в режиме
+            min_samples: Сколько замеров нужно, прежде чем начать хеджировать
+            min_delay: Нижняя граница задержки перед вторым запросом (сек)
+            cancel_loser: Отменять проигравший запрос. Вызов в пуле потоков
+                отменить нельзя - такой запрос дорабатывает, и его задержка
+                попадает в метрики как задержка без хеджирования
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.cancel_loser = cancel_loser
+
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._stats: Dict[str, HedgeStats] = {}
+
+    def _tracker(self, model: str) -> LatencyTracker:
+        if model not in self._trackers:
+            self._trackers[model] = LatencyTracker()
+        return self._trackers[model]
+
+    def _mode_stats(self, mode: str) -> HedgeStats:
+        if mode not in self._stats:
+            self._stats[mode] = HedgeStats()
+        return self._stats[mode]
+
+    def record_latency(self, model: str, latency: float):
+        """Длительность успешного вызова модели (без ожидания квоты и слота)"""
+        self._tracker(model).record(latency)
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """Через сколько секунд запускать второй запрос (None - пока не хеджируем)"""
+        tracker = self._tracker(model)
+        if len(tracker) < self.min_samples:
+            return None
+        return max(tracker.percentile(self.percentile), self.min_delay)
+
+    def _try_spend(self, stats: HedgeStats) -> bool:
+        """Не больше budget хеджированных вызовов от всех вызовов режима"""
+        if stats.hedged + 1 > stats.calls * self.budget:
+            stats.budget_denied += 1
+            return False
+        stats.hedged += 1
+        return True
+
+    async def run(
+        self,
+        mode: str,
+        model: str,
+        call: Callable[[], Awaitable[Any]],
+        has_capacity: Optional[Callable[[], bool]] = None
+    ) -> Any:
+        """
+        Выполнить вызов с хеджированием.
+        call() создаёт новый запрос к модели при каждом вызове;
+        has_capacity() - есть ли у режима свободный слот для второго запроса
+        (без него хедж только встал бы в ту же очередь).
+        Задержки для перцентиля сообщает вызывающий (record_latency).
+        """
+        stats = self._mode_stats(mode)
+        stats.calls += 1
+        started = time.monotonic()
+
+        primary = asyncio.create_task(call())
+        try:
+            delay = self.hedge_delay(model)
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done and has_capacity is not None and not has_capacity():
+                    stats.capacity_denied += 1
+                elif not done and self._try_spend(stats):
+                    logger.info(f"Hedging {mode} call to {model} after {delay:.1f}s")
+                    return await self._race(stats, model, started, primary, asyncio.create_task(call()))
+
+            result = await primary
+        except BaseException:
+            # Отмена вызывающего (дедлайн, потребитель iter_batch) в том числе во время
+            # ожидания хеджа: запрос не должен дорабатывать, занимая слот и квоту
+            # (хедж-запрос отменяет _race)
+            primary.cancel()
+            raise
+        latency = time.monotonic() - started
+        stats.record(latency, latency)
+        return result
+
+    async def _race(
+        self,
+        stats: HedgeStats,
+        model: str,
+        started: float,
+        primary: asyncio.Task,
+        hedge: asyncio.Task
+    ) -> Any:
+        """Первый успешный ответ побеждает; ошибка одного запроса не отменяет второй"""
+        pending = {primary, hedge}
+        first_error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        first_error = first_error or task.exception()
+                        continue
+
+                    elapsed = time.monotonic() - started
+                    if task is primary:
+                        stats.record(elapsed, elapsed)
+                    else:
+                        stats.hedge_wins += 1
+                        if primary in pending and not self.cancel_loser:
+                            # Первый запрос дорабатывает - его задержка и есть выигрыш хеджа
+                            pending.discard(primary)
+                            primary.add_done_callback(
+                                lambda task: self._record_loser(stats, model, started, elapsed, task)
+                            )
+                        else:
+                            # Отменённый запрос: известна только нижняя граница задержки
+                            stats.record(elapsed, elapsed)
+                    return task.result()
+            raise first_error
+        finally:
+            # Проигравший запрос больше не нужен
+            for task in pending:
+                task.cancel()
+
+    def _record_loser(
+        self,
+        stats: HedgeStats,
+        model: str,
+        started: float,
+        effective: float,
+        task: asyncio.Task
+    ):
+        """Задержка доработавшего первого запроса - хвост, который срезал хедж"""
+        if task.cancelled() or task.exception() is not None:
+            stats.record(effective, effective)
+            return
+        latency = time.monotonic() - started
+        stats.record(latency, effective)
+
+    def get_stats(self) -> Dict[str, Any]:
+        delays = {}
+        for model in self._trackers:
+            delay = self.hedge_delay(model)
+            delays[model] = round(delay * 1000, 1) if delay is not None else None
+        return {
+            "modes": {mode: mode_stats.get_stats() for mode, mode_stats in self._stats.items()},
+            "hedge_delay_ms": delays,
+        }
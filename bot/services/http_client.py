@@ -0,0 +1,123 @@
+"""
+Shared HTTP client for Telegram file transfers
+Одна aiohttp-сессия на всё время жизни приложения: keep-alive соединения
+к api.telegram.org переиспользуются, DNS кэшируется, TLS handshake не повторяется.
+"""
+import logging
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramFileClient:
+    """Скачивание файлов из Telegram через общий пул соединений"""
+
+    API_BASE = "https://api.telegram.org"
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        bot_token: str,
+        limit: int = 100,
+        limit_per_host: int = 32,
+        keepalive_timeout: int = 30,
+        total_timeout: int = 60,
+        connect_timeout: int = 5
+    ):
+        self.bot_token = bot_token
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_read=total_timeout
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self._downloads = 0
+        self._bytes = 0
+
+    async def start(self):
+        """Создать сессию (вызывается при старте приложения)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            logger.info("Telegram file client session started")
+
+    async def close(self):
+        """Закрыть сессию (вызывается при остановке приложения)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Telegram file client session closed")
+        self._session = None
+
+    async def download(self, file_path: str, size_hint: Optional[int] = None) -> bytes:
+        """
+        Скачать файл по file_path из getFile.
+        Данные читаются потоком в заранее выделенный буфер размера файла.
+        """
+        await self.start()
+
+        url = f"{self.API_BASE}/file/bot{self.bot_token}/{file_path}"
+        async with self._session.get(url) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to download file: {response.status}")
+
+            size = response.content_length or size_hint or 0
+            buffer = bytearray(size)
+            offset = 0
+            async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                end = offset + len(chunk)
+                if end > len(buffer):
+                    # Размер оказался больше ожидаемого - расширяем буфер
+                    buffer.extend(bytes(end - len(buffer)))
+                buffer[offset:end] = chunk
+                offset = end
+
+        self._downloads += 1
+        self._bytes += offset
+        if offset != len(buffer):
+            del buffer[offset:]
+        return bytes(buffer)
+
+    async def download_by_file_id(self, bot, file_id: str) -> bytes:
+        """getFile + скачивание"""
+        file = await bot.get_file(file_id)
+        return await self.download(file.file_path, file.file_size)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "downloads": self._downloads,
+            "bytes": self._bytes,
+            "session_open": self._session is not None and not self._session.closed,
+        }
+
+
+# Синглтон для переиспользования
+_file_client: Optional[TelegramFileClient] = None
+
+
+def get_telegram_file_client() -> TelegramFileClient:
+    """Получить общий клиент для файлов Telegram (синглтон)"""
+    global _file_client
+    if _file_client is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        _file_client = TelegramFileClient(
+            settings.bot_token,
+            limit=settings.http_pool_limit,
+            limit_per_host=settings.http_pool_limit_per_host,
+            total_timeout=settings.http_download_timeout
+        )
+        register_stats_provider("telegram_files", _file_client.get_stats)
+    return _file_client
@@ -0,0 +1,146 @@
+"""
+CPU-bound image operations (Pillow)
+Функции выполняются в пуле процессов (bot.services.process_pool), поэтому модуль
+не импортирует ничего, кроме Pillow и стандартной библиотеки.
+"""
+import io
+from typing import Any, Dict, Tuple
+
+from PIL import Image, ImageFilter, ImageOps, ImageStat
+
+
+# Сигнатуры форматов для определения MIME-типа без декодирования
+_MAGIC = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def detect_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """Определить MIME-тип изображения по сигнатуре"""
+    for magic, mime_type in _MAGIC:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    """Привести к RGB (прозрачность - на белый фон)"""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def normalize_photo(
+    data: bytes,
+    max_side: int,
+    max_bytes: int,
+    quality: int = 90
+) -> Tuple[bytes, int, int]:
+    """
+    Подготовить фото пользователя для модели:
+    поворот по EXIF, уменьшение до max_side, удаление метаданных,
+    перекодирование в JPEG не больше max_bytes.
+
+    Returns (jpeg_bytes, width, height)
+    """
+    with Image.open(io.BytesIO(data)) as src:
+        # Для JPEG декодируем сразу в уменьшенном масштабе (не меньше max_side по обеим сторонам)
+        src.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(src)
+        img = _to_rgb(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        # Сохраняем без exif/icc - метаданные не попадают в запрос к модели
+        result = b""
+        for q in range(quality, 49, -10):
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=q, optimize=True)
+            result = buffer.getvalue()
+            if len(result) <= max_bytes:
+                break
+
+        return result, img.width, img.height
+
+
+# Лапласиан со смещением 128: отрицательные отклики не обрезаются в 0
+_LAPLACIAN = ImageFilter.Kernel((3, 3), (0, 1, 0, 1, -4, 1, 0, 1, 0), scale=1, offset=128)
+
+
+def assess_photo(data: bytes, analysis_side: int = 512) -> Dict[str, Any]:
+    """
+    Метрики качества фото для проверки перед генерацией:
+    размер после поворота по EXIF, средняя яркость и доли пересвеченных/провальных
+    пикселей по гистограмме, резкость (дисперсия лапласиана) на уменьшенной копии.
+    """
+    with Image.open(io.BytesIO(data)) as src:
+        # Размер до уменьшения (draft меняет src.size)
+        width, height = src.size
+        # EXIF-ориентации 5-8 меняют местами ширину и высоту
+        if src.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+        src.draft("L", (analysis_side, analysis_side))
+        gray = src.convert("L")
+        gray.thumbnail((analysis_side, analysis_side), Image.BILINEAR)
+
+        histogram = gray.histogram()
+        pixels = sum(histogram) or 1
+        mean = sum(value * count for value, count in enumerate(histogram)) / pixels
+        dark = sum(histogram[:16]) / pixels
+        bright = sum(histogram[240:]) / pixels
+        # Краевые пиксели фильтр копирует без изменений - отрезаем рамку
+        edges = gray.filter(_LAPLACIAN).crop((1, 1, gray.width - 1, gray.height - 1))
+        sharpness = ImageStat.Stat(edges).var[0]
+
+        return {
+            "width": width,
+            "height": height,
+            "brightness": round(mean, 1),
+            "dark_fraction": round(dark, 3),
+            "bright_fraction": round(bright, 3),
+            "sharpness": round(sharpness, 1),
+        }
+
+
+def postprocess_result(
+    data: bytes,
+    output_format: str,
+    max_side: int,
+    max_bytes: int,
+    quality: int = 90
+) -> Tuple[bytes, str]:
+    """
+    Подготовить результат генерации к отправке в Telegram:
+    определение формата, перекодирование в progressive JPEG или WebP
+    в пределах лимитов sendPhoto.
+
+    Returns (photo_bytes, source_format)
+    """
+    with Image.open(io.BytesIO(data)) as src:
+        source_format = (src.format or "").lower()
+        img = _to_rgb(src)
+
+        # sendPhoto: не больше 10 МБ, ширина + высота не больше 10000
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        photo = b""
+        for q in range(quality, 49, -10):
+            buffer = io.BytesIO()
+            if output_format == "WEBP":
+                img.save(buffer, format="WEBP", quality=q, method=4)
+            else:
+                img.save(buffer, format="JPEG", quality=q, optimize=True, progressive=True)
+            photo = buffer.getvalue()
+            if len(photo) <= max_bytes:
+                break
+
+        return photo, source_format
@@ -0,0 +1,29 @@
+"""
+Реестр метрик сервисов бота
+Сервисы регистрируют функцию get_stats(), а /stats endpoint собирает их в один JSON
+"""
+import logging
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+StatsProvider = Callable[[], Dict[str, Any]]
+
+_providers: Dict[str, StatsProvider] = {}
+
+
+def register_stats_provider(name: str, provider: StatsProvider):
+    """Зарегистрировать источник метрик (повторная регистрация заменяет предыдущий)"""
+    _providers[name] = provider
+
+
+def collect_stats() -> Dict[str, Any]:
+    """Собрать метрики всех зарегистрированных сервисов"""
+    stats = {}
+    for name, provider in list(_providers.items()):
+        try:
+            stats[name] = provider()
+        except Exception as e:
+            logger.error(f"Error collecting stats from {name}: {e}")
+            stats[name] = {"error": str(e)}
+    return stats
@@ -0,0 +1,135 @@
+"""
+Input photo ingestion
+Выбор подходящего размера фото из Telegram и нормализация перед отправкой в Vertex AI:
+меньше байт в запросе - меньше задержка и входных токенов.
+"""
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram.types import PhotoSize
+
+from bot.services.image_ops import detect_mime_type, normalize_photo
+from bot.services.metrics import register_stats_provider
+from bot.services.process_pool import run_in_process
+
+logger = logging.getLogger(__name__)
+
+# normalizer(data, max_side, max_bytes) -> (jpeg_bytes, width, height)
+# Должен быть picklable (функция уровня модуля), т.к. выполняется в пуле процессов
+Normalizer = Callable[[bytes, int, int], Tuple[bytes, int, int]]
+
+
+class IngestedPhoto:
+    """Фото, подготовленное для модели"""
+
+    def __init__(self, data: bytes, mime_type: str, width: int = 0, height: int = 0):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+
+
+class PhotoIngestor:
+    """Этап подготовки входного фото"""
+
+    # Целевой размер длинной стороны по режимам
+    DEFAULT_TARGET_SIDE = {"normal": 1024, "pro": 1536}
+
+    def __init__(
+        self,
+        target_side: Optional[Dict[str, int]] = None,
+        max_bytes: int = 1024 * 1024,
+        normalizer: Optional[Normalizer] = normalize_photo
+    ):
+        """
+        Args:
+            target_side: Целевой размер длинной стороны по режимам
+            max_bytes: Максимальный размер JPEG после перекодирования
+            normalizer: Функция нормализации (None - отправлять фото как есть)
+        """
+        self.target_side = {**self.DEFAULT_TARGET_SIDE, **(target_side or {})}
+        self.max_bytes = max_bytes
+        self.normalizer = normalizer
+
+        self._processed = 0
+        self._failed = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._total_time = 0.0
+
+    def get_target_side(self, mode: str) -> int:
+        return self.target_side.get(mode, self.target_side["normal"])
+
+    def select_size(self, photo_sizes: Sequence[PhotoSize], mode: str) -> PhotoSize:
+        """
+        Выбрать наименьший PhotoSize, который не меньше целевого разрешения режима.
+        Если таких нет - самый большой из доступных.
+        """
+        target = self.get_target_side(mode)
+        sizes: List[PhotoSize] = sorted(photo_sizes, key=lambda p: p.width * p.height)
+        for size in sizes:
+            if max(size.width, size.height) >= target:
+                return size
+        return sizes[-1]
+
+    async def ingest(self, photo_bytes: bytes, mode: str) -> IngestedPhoto:
+        """Нормализовать фото в пуле процессов; при ошибке - вернуть исходные байты"""
+        if self.normalizer is None:
+            return IngestedPhoto(photo_bytes, detect_mime_type(photo_bytes))
+
+        started = time.monotonic()
+        try:
+            data, width, height = await run_in_process(
+                self.normalizer,
+                photo_bytes,
+                self.get_target_side(mode),
+                self.max_bytes
+            )
+        except Exception as e:
+            self._failed += 1
+            logger.warning(f"Photo normalization failed, sending original: {e}")
+            return IngestedPhoto(photo_bytes, detect_mime_type(photo_bytes))
+
+        elapsed = time.monotonic() - started
+        self._processed += 1
+        self._bytes_in += len(photo_bytes)
+        self._bytes_out += len(data)
+        self._total_time += elapsed
+
+        logger.info(
+            f"Photo ingested: {len(photo_bytes)} -> {len(data)} bytes, "
+            f"{width}x{height}, {elapsed * 1000:.0f} ms"
+        )
+        return IngestedPhoto(data, "image/jpeg", width, height)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "processed": self._processed,
+            "failed": self._failed,
+            "bytes_in": self._bytes_in,
+            "bytes_out": self._bytes_out,
+            "avg_ms": round(self._total_time / self._processed * 1000, 1) if self._processed else 0.0,
+        }
+
+
+# Синглтон для переиспользования
+_photo_ingestor: Optional[PhotoIngestor] = None
+
+
+def get_photo_ingestor() -> PhotoIngestor:
+    """Получить инстанс этапа подготовки фото (синглтон)"""
+    global _photo_ingestor
+    if _photo_ingestor is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        _photo_ingestor = PhotoIngestor(
+            target_side={
+                "normal": settings.photo_target_side_normal,
+                "pro": settings.photo_target_side_pro,
+            },
+            max_bytes=settings.photo_max_bytes,
+            normalizer=normalize_photo if settings.photo_ingest_enabled else None
+        )
+        register_stats_provider("photo_ingest", _photo_ingestor.get_stats)
+    return _photo_ingestor
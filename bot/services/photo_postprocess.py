@@ -0,0 +1,122 @@
+"""
+Output post-processing of generated images
+Vertex возвращает PNG/JPEG произвольного размера; перед отправкой в Telegram
+результат перекодируется в компактный JPEG/WebP.
+"""
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from bot.services.image_ops import detect_mime_type, postprocess_result
+from bot.services.metrics import register_stats_provider
+from bot.services.process_pool import run_in_process
+
+logger = logging.getLogger(__name__)
+
+# Расширение файла по MIME-типу
+_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+
+class ProcessedImage:
+    """Результат генерации, подготовленный к отправке"""
+
+    def __init__(
+        self,
+        photo: bytes,
+        filename: str,
+    ):
+        self.photo = photo
+        self.filename = filename
+
+
+class ResultPostprocessor:
+    """Этап перекодирования результата генерации"""
+
+    # Лимит sendPhoto - 10 МБ; Telegram всё равно уменьшает фото до 2560 px
+    TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+    def __init__(
+        self,
+        output_format: str = "JPEG",
+        max_side: int = 2560,
+        max_bytes: int = 5 * 1024 * 1024
+    ):
+        if output_format not in ("JPEG", "WEBP"):
+            raise ValueError(f"Unsupported output format: {output_format}")
+
+        self.output_format = output_format
+        self.max_side = max_side
+        self.max_bytes = min(max_bytes, self.TELEGRAM_PHOTO_MAX_BYTES)
+
+        self._processed = 0
+        self._failed = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._total_time = 0.0
+
+    async def process(self, data: bytes) -> ProcessedImage:
+        """Перекодировать результат в пуле процессов; при ошибке - отправить как есть"""
+        mime_type = detect_mime_type(data)
+        started = time.monotonic()
+        try:
+            photo, source_format = await run_in_process(
+                postprocess_result,
+                data,
+                self.output_format,
+                self.max_side,
+                self.max_bytes
+            )
+        except Exception as e:
+            self._failed += 1
+            logger.warning(f"Result post-processing failed, sending original: {e}")
+            return ProcessedImage(
+                photo=data,
+                filename=f"result.{_EXTENSIONS.get(mime_type, 'jpg')}"
+            )
+
+        elapsed = time.monotonic() - started
+        self._processed += 1
+        self._bytes_in += len(data)
+        self._bytes_out += len(photo)
+        self._total_time += elapsed
+
+        logger.info(
+            f"Result post-processed: {source_format} {len(data)} -> "
+            f"{self.output_format.lower()} {len(photo)} bytes, {elapsed * 1000:.0f} ms"
+        )
+        extension = "webp" if self.output_format == "WEBP" else "jpg"
+        return ProcessedImage(photo=photo, filename=f"result.{extension}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "processed": self._processed,
+            "failed": self._failed,
+            "bytes_in": self._bytes_in,
+            "bytes_out": self._bytes_out,
+            "avg_ms": round(self._total_time / self._processed * 1000, 1) if self._processed else 0.0,
+        }
+
+
+# Синглтон для переиспользования
+_result_postprocessor: Optional[ResultPostprocessor] = None
+
+
+def get_result_postprocessor() -> ResultPostprocessor:
+    """Получить инстанс этапа перекодирования результата (синглтон)"""
+    global _result_postprocessor
+    if _result_postprocessor is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        _result_postprocessor = ResultPostprocessor(
+            output_format=settings.result_output_format.upper(),
+            max_side=settings.result_max_side,
+            max_bytes=settings.result_max_bytes
+        )
+        register_stats_provider("result_postprocess", _result_postprocessor.get_stats)
+    return _result_postprocessor
+
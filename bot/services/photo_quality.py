@@ -0,0 +1,164 @@
+"""
+Pre-flight photo quality gate
+Дешёвая проверка фото до списания энергии: слишком маленькие, тёмные/пересвеченные,
+размытые фото и скриншоты (по пропорциям) отклоняются с подсказкой, не занимая
+воркер на полный вызов модели. Размер и пропорции проверяются по PhotoSize без
+скачивания, яркость и резкость - по скачанному фото в пуле процессов.
+Каждое решение логируется, счётчики причин доступны в /stats.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Awaitable, Dict, Optional
+
+from bot.services.image_ops import assess_photo
+from bot.services.metrics import register_stats_provider
+from bot.services.process_pool import run_in_process
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoRejection:
+    """Причины отклонения фото"""
+
+    TOO_SMALL = "too_small"
+    BAD_ASPECT = "bad_aspect"
+    TOO_DARK = "too_dark"
+    TOO_BRIGHT = "too_bright"
+    BLURRED = "blurred"
+
+
+class PhotoQualityGate:
+    """Проверка фото перед генерацией"""
+
+    def __init__(
+        self,
+        min_side: int = 256,
+        max_aspect_ratio: float = 2.0,
+        min_brightness: float = 25.0,
+        max_brightness: float = 235.0,
+        max_clipped_fraction: float = 0.6,
+        min_sharpness: float = 8.0,
+        timeout: float = 3.0
+    ):
+        """
+        Args:
+            min_side: Минимальная короткая сторона самого большого PhotoSize
+            max_aspect_ratio: Максимальное отношение длинной стороны к короткой
+                (скриншоты телефонов - около 2.2)
+            min_brightness: Минимальная средняя яркость (0-255)
+            max_brightness: Максимальная средняя яркость (0-255)
+            max_clipped_fraction: Максимальная доля почти чёрных или почти белых пикселей
+            min_sharpness: Минимальная дисперсия лапласиана на копии 512px
+            timeout: Сколько ждать скачивания и анализа; дольше - фото пропускается
+        """
+        self.min_side = min_side
+        self.max_aspect_ratio = max_aspect_ratio
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped_fraction = max_clipped_fraction
+        self.min_sharpness = min_sharpness
+        self.timeout = timeout
+
+        self._checked = 0
+        self._passed = 0
+        self._rejected: Counter = Counter()
+        self._skipped = 0
+        self._total_time = 0.0
+
+    def check_size(self, width: int, height: int) -> Optional[str]:
+        """Проверка по размеру самого большого PhotoSize (без скачивания)"""
+        short_side, long_side = sorted((width, height))
+        if short_side < self.min_side:
+            return PhotoRejection.TOO_SMALL
+        if long_side / max(short_side, 1) > self.max_aspect_ratio:
+            return PhotoRejection.BAD_ASPECT
+        return None
+
+    def check_metrics(self, metrics: Dict[str, Any]) -> Optional[str]:
+        """Проверка по метрикам assess_photo"""
+        if metrics["brightness"] < self.min_brightness or (
+            metrics["dark_fraction"] > self.max_clipped_fraction
+        ):
+            return PhotoRejection.TOO_DARK
+        if metrics["brightness"] > self.max_brightness or (
+            metrics["bright_fraction"] > self.max_clipped_fraction
+        ):
+            return PhotoRejection.TOO_BRIGHT
+        if metrics["sharpness"] < self.min_sharpness:
+            return PhotoRejection.BLURRED
+        return None
+
+    async def check(
+        self,
+        telegram_id: int,
+        width: int,
+        height: int,
+        photo_bytes: Awaitable[bytes]
+    ) -> Optional[str]:
+        """
+        Причина отклонения фото или None (фото можно генерировать).
+        width/height - размер самого большого PhotoSize, photo_bytes - скачивание фото.
+        Ошибка скачивания или анализа не отклоняет фото: его обработает воркер.
+        """
+        started = time.monotonic()
+        self._checked += 1
+
+        reason = self.check_size(width, height)
+        metrics: Dict[str, Any] = {"width": width, "height": height}
+        if reason is None:
+            try:
+                data = await asyncio.wait_for(asyncio.shield(photo_bytes), self.timeout)
+                metrics = await asyncio.wait_for(run_in_process(assess_photo, data), self.timeout)
+            except Exception as e:
+                self._skipped += 1
+                logger.warning(f"Photo quality check skipped for user {telegram_id}: {e!r}")
+                return None
+            reason = self.check_metrics(metrics)
+
+        elapsed = time.monotonic() - started
+        self._total_time += elapsed
+        if reason is None:
+            self._passed += 1
+        else:
+            self._rejected[reason] += 1
+        logger.info(
+            f"Photo quality for user {telegram_id}: {reason or 'ok'} "
+            f"{metrics} in {elapsed * 1000:.0f} ms"
+        )
+        return reason
+
+    def get_stats(self) -> Dict[str, Any]:
+        analyzed = self._passed + sum(self._rejected.values())
+        return {
+            "checked": self._checked,
+            "passed": self._passed,
+            "rejected": dict(self._rejected),
+            "skipped": self._skipped,
+            "avg_ms": round(self._total_time / analyzed * 1000, 1) if analyzed else 0.0,
+        }
+
+
+# Синглтон для переиспользования
+_photo_quality_gate: Optional[PhotoQualityGate] = None
+
+
+def get_photo_quality_gate() -> Optional[PhotoQualityGate]:
+    """Получить проверку качества фото (синглтон); None - проверка отключена"""
+    global _photo_quality_gate
+    if _photo_quality_gate is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        if not settings.photo_quality_enabled:
+            return None
+        _photo_quality_gate = PhotoQualityGate(
+            min_side=settings.photo_quality_min_side,
+            max_aspect_ratio=settings.photo_quality_max_aspect_ratio,
+            min_brightness=settings.photo_quality_min_brightness,
+            max_brightness=settings.photo_quality_max_brightness,
+            max_clipped_fraction=settings.photo_quality_max_clipped_fraction,
+            min_sharpness=settings.photo_quality_min_sharpness
+        )
+        register_stats_provider("photo_quality", _photo_quality_gate.get_stats)
+    return _photo_quality_gate
@@ -0,0 +1,92 @@
+"""
+Stage timing for the photo pipeline
+Каждый этап обработки фото (скачивание, генерация, отправка и т.д.) замеряется
+относительно начала пайплайна, поэтому в логах видно, какие этапы идут
+параллельно и что лежит на критическом пути.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Deque, Dict, List, Tuple
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimings:
+    """Замеры этапов одного прохода пайплайна"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.monotonic()
+        # stage -> (смещение начала от старта пайплайна, длительность), в секундах
+        self.stages: Dict[str, Tuple[float, float]] = {}
+
+    @asynccontextmanager
+    async def stage(self, stage_name: str):
+        """Замерить этап внутри async with"""
+        offset = time.monotonic() - self.started
+        try:
+            yield
+        finally:
+            self.stages[stage_name] = (offset, time.monotonic() - self.started - offset)
+
+    async def measure(self, stage_name: str, awaitable: Awaitable) -> Any:
+        """Замерить awaitable как этап"""
+        async with self.stage(stage_name):
+            return await awaitable
+
+    def start(self, stage_name: str, awaitable: Awaitable) -> asyncio.Task:
+        """Запустить этап в фоне (параллельно с остальными)"""
+        return asyncio.create_task(self.measure(stage_name, awaitable))
+
+    @property
+    def total(self) -> float:
+        return time.monotonic() - self.started
+
+    def summary(self) -> str:
+        """Этапы в порядке старта: name@start+duration (мс)"""
+        parts = [
+            f"{name}@{offset * 1000:.0f}+{duration * 1000:.0f}"
+            for name, (offset, duration) in sorted(self.stages.items(), key=lambda item: item[1][0])
+        ]
+        return f"{self.name} total={self.total * 1000:.0f}ms: " + ", ".join(parts)
+
+    def finish(self):
+        """Залогировать и учесть замеры в общей статистике"""
+        logger.info(self.summary())
+        _stats.record(self)
+
+
+class PipelineStats:
+    """Агрегированная статистика длительностей этапов"""
+
+    WINDOW = 500
+
+    def __init__(self):
+        self._durations: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.WINDOW))
+
+    def record(self, timings: StageTimings):
+        self._durations[f"{timings.name}.total"].append(timings.total)
+        for stage_name, (_, duration) in timings.stages.items():
+            self._durations[f"{timings.name}.{stage_name}"].append(duration)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {}
+        for key, durations in self._durations.items():
+            values: List[float] = sorted(durations)
+            if not values:
+                continue
+            stats[key] = {
+                "count": len(values),
+                "avg_ms": round(sum(values) / len(values) * 1000, 1),
+                "p95_ms": round(values[int(len(values) * 0.95)] * 1000, 1),
+            }
+        return stats
+
+
+_stats = PipelineStats()
+register_stats_provider("pipeline", _stats.get_stats)
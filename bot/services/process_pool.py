@@ -0,0 +1,55 @@
+"""
+Shared process pool for CPU-bound image work
+Декодирование и перекодирование изображений не должны блокировать event loop
+и конкурировать за GIL с обработкой апдейтов.
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Получить пул процессов (синглтон)"""
+    global _pool
+    if _pool is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        # spawn: дочерние процессы не наследуют потоки gRPC/aiohttp родителя
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.image_process_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(f"Image process pool started: {settings.image_process_workers} workers")
+    return _pool
+
+
+async def run_in_process(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполнить функцию в пуле процессов (функция и аргументы должны быть picklable)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_process_pool(),
+        functools.partial(func, *args, **kwargs)
+    )
+
+
+async def warm_up_process_pool():
+    """Запустить процессы пула заранее: spawn и импорт модулей не должны попасть на первый запрос"""
+    from bot.config import get_settings
+    workers = get_settings().image_process_workers
+    await asyncio.gather(*(run_in_process(os.getpid) for _ in range(workers)))
+
+
+def shutdown_process_pool():
+    """Остановить пул процессов"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
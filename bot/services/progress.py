@@ -0,0 +1,228 @@
+"""
+Centralized progress-indicator scheduler
+Один цикл на весь процесс обновляет все статусные сообщения генераций
+в пределах глобального и per-chat бюджета запросов к Bot API.
+Сверх бюджета вместо edit_text отправляется дешёвый sendChatAction(upload_photo),
+а пока в чате идёт отправка результата - анимация этого чата ставится на паузу.
+Flood control (RetryAfter) откладывает обновления чата на указанное время.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+# render(step) -> текст статусного сообщения для шага анимации
+ProgressRenderer = Callable[[int], str]
+
+
+class ProgressHandle:
+    """Статусное сообщение одной генерации"""
+
+    def __init__(self, chat_id: int, message_id: int, render: ProgressRenderer):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.render = render
+        self.step = 0
+        self.last_update_at = 0.0
+        self.done = False
+        self._edit_task: Optional[asyncio.Task] = None
+
+
+class ProgressScheduler:
+    """Планировщик обновлений статусных сообщений"""
+
+    def __init__(
+        self,
+        tick: float = 1.0,
+        global_edits_per_tick: int = 20,
+        chat_edit_interval: float = 2.0,
+        chat_action_interval: float = 5.0
+    ):
+        """
+        Args:
+            tick: Период цикла планировщика (сек)
+            global_edits_per_tick: Сколько edit_text можно сделать за один тик на весь бот
+            chat_edit_interval: Минимальный интервал между edit_text в одном чате (сек)
+            chat_action_interval: Интервал повтора sendChatAction (действие живёт ~5 сек)
+        """
+        self.tick = tick
+        self.global_edits_per_tick = global_edits_per_tick
+        self.chat_edit_interval = chat_edit_interval
+        self.chat_action_interval = chat_action_interval
+
+        self._bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._handles: List[ProgressHandle] = []
+        self._chat_last_edit: Dict[int, float] = {}
+        self._chat_last_action: Dict[int, float] = {}
+        self._chat_retry_until: Dict[int, float] = {}
+        self._priority_chats: Counter = Counter()
+        self._action_tasks = set()
+
+        self._edits = 0
+        self._actions = 0
+        self._paused_ticks = 0
+        self._retry_after = 0
+
+    async def start(self, bot):
+        if self._task is None:
+            self._bot = bot
+            self._task = asyncio.create_task(self._run(), name="progress-scheduler")
+            logger.info("Progress scheduler started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._handles = []
+
+    def register(self, chat_id: int, message_id: int, render: ProgressRenderer) -> ProgressHandle:
+        """Начать анимацию статусного сообщения"""
+        handle = ProgressHandle(chat_id, message_id, render)
+        # Первый кадр уже отправлен вместе с сообщением
+        handle.last_update_at = time.monotonic()
+        self._handles.append(handle)
+        return handle
+
+    async def finish(self, handle: ProgressHandle):
+        """Остановить анимацию и дождаться незавершённого edit (перед удалением сообщения)"""
+        handle.done = True
+        if handle in self._handles:
+            self._handles.remove(handle)
+        if handle._edit_task is not None:
+            await asyncio.gather(handle._edit_task, return_exceptions=True)
+        self._cleanup_chat(handle.chat_id)
+
+    @asynccontextmanager
+    async def priority(self, chat_id: int):
+        """Отправка результата в чат: пока блок активен, анимация этого чата не тратит его лимит Bot API"""
+        self._priority_chats[chat_id] += 1
+        try:
+            yield
+        finally:
+            self._priority_chats[chat_id] -= 1
+            if self._priority_chats[chat_id] <= 0:
+                del self._priority_chats[chat_id]
+
+    def _cleanup_chat(self, chat_id: int):
+        if not any(h.chat_id == chat_id for h in self._handles):
+            self._chat_last_edit.pop(chat_id, None)
+            self._chat_last_action.pop(chat_id, None)
+            self._chat_retry_until.pop(chat_id, None)
+
+    def _back_off(self, chat_id: int, retry_after: float):
+        """Flood control: не обновлять чат, пока не пройдёт retry_after"""
+        self._retry_after += 1
+        self._chat_retry_until[chat_id] = time.monotonic() + retry_after
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self._schedule_tick()
+            except Exception as e:
+                logger.error(f"Progress scheduler tick error: {e}", exc_info=True)
+
+    def _schedule_tick(self):
+        if self._priority_chats:
+            self._paused_ticks += 1
+
+        now = time.monotonic()
+        budget = self.global_edits_per_tick
+        chats_in_tick = set()
+
+        # Сначала те, кто дольше всех не обновлялся
+        for handle in sorted(self._handles, key=lambda h: h.last_update_at):
+            if handle.done or (handle._edit_task and not handle._edit_task.done()):
+                continue
+            chat_id = handle.chat_id
+            if chat_id in chats_in_tick or chat_id in self._priority_chats:
+                continue
+            if now < self._chat_retry_until.get(chat_id, 0.0):
+                continue
+            if now - self._chat_last_edit.get(chat_id, 0.0) < self.chat_edit_interval:
+                continue
+
+            chats_in_tick.add(chat_id)
+            if budget > 0:
+                budget -= 1
+                handle.step += 1
+                handle.last_update_at = now
+                self._chat_last_edit[chat_id] = now
+                handle._edit_task = asyncio.create_task(self._edit(handle))
+            elif now - self._chat_last_action.get(chat_id, 0.0) >= self.chat_action_interval:
+                self._chat_last_action[chat_id] = now
+                handle.last_update_at = now
+                task = asyncio.create_task(self._send_action(chat_id))
+                self._action_tasks.add(task)
+                task.add_done_callback(self._action_tasks.discard)
+
+    async def _edit(self, handle: ProgressHandle):
+        try:
+            await self._bot.edit_message_text(
+                text=handle.render(handle.step),
+                chat_id=handle.chat_id,
+                message_id=handle.message_id,
+                parse_mode="HTML"
+            )
+            self._edits += 1
+        except TelegramRetryAfter as e:
+            # Flood control - продолжаем анимацию после паузы
+            logger.debug(f"Progress edit retry after {e.retry_after}s in chat {handle.chat_id}")
+            self._back_off(handle.chat_id, e.retry_after)
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            # Сообщение удалено, не изменилось или чат недоступен - больше не анимируем
+            logger.debug(f"Progress edit error: {e}")
+            handle.done = True
+            if handle in self._handles:
+                self._handles.remove(handle)
+        except Exception as e:
+            # Сетевая ошибка - следующий кадр попробуем в свой черёд
+            logger.debug(f"Progress edit error: {e}")
+
+    async def _send_action(self, chat_id: int):
+        try:
+            await self._bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO)
+            self._actions += 1
+        except TelegramRetryAfter as e:
+            self._back_off(chat_id, e.retry_after)
+        except Exception as e:
+            logger.debug(f"Progress chat action error: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._handles),
+            "edits": self._edits,
+            "chat_actions": self._actions,
+            "paused_ticks": self._paused_ticks,
+            "priority_ops": sum(self._priority_chats.values()),
+            "retry_after": self._retry_after,
+        }
+
+
+# Синглтон для переиспользования
+_progress_scheduler: Optional[ProgressScheduler] = None
+
+
+def get_progress_scheduler() -> ProgressScheduler:
+    """Получить планировщик статусных сообщений (синглтон)"""
+    global _progress_scheduler
+    if _progress_scheduler is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        _progress_scheduler = ProgressScheduler(
+            global_edits_per_tick=settings.progress_edits_per_second,
+            chat_edit_interval=settings.progress_chat_edit_interval
+        )
+        register_stats_provider("progress", _progress_scheduler.get_stats)
+    return _progress_scheduler
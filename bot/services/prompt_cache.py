@@ -0,0 +1,213 @@
+"""
+Prompt cache for styles
+Итоговый промпт стиля (системная инструкция + промпт) собирается один раз
+на (стиль, версия промпта). Если модель поддерживает context caching и промпт
+не меньше минимального размера кэша, промпт регистрируется в Vertex AI как
+CachedContent в каждом location, и вызов передаёт только фото со ссылкой
+на кэш. Смена промпта меняет версию: старые кэши удаляются, новые создаются
+при первом запросе.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Collection, Dict, Iterable, Optional, Tuple
+
+from bot.styles_data import get_prompt_version
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledPrompt:
+    """Собранный промпт одной версии стиля"""
+
+    # Грубая оценка для латиницы: ~4 символа на токен
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, style_id: str, version: str, system_instruction: str, prompt: str):
+        self.style_id = style_id
+        self.version = version
+        self.system_instruction = system_instruction
+        self.prompt = prompt
+        # Текст для вызова без кэша - как раньше собирался в generate_single
+        self.text = f"{system_instruction}\n\n{prompt}" if system_instruction else prompt
+        self.estimated_tokens = len(self.text) // self.CHARS_PER_TOKEN
+
+
+class _RemoteEntry:
+    """CachedContent в одном location"""
+
+    def __init__(self, version: str):
+        self.version = version
+        self.name: Optional[str] = None
+        self.expires_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+        # После ошибки создания не пытаемся снова до этого момента
+        self.retry_at = 0.0
+
+
+class PromptCache:
+    """Собранные промпты стилей и их CachedContent в Vertex AI"""
+
+    # Ссылку на кэш перестаём отдавать заранее, чтобы запрос не попал на истёкший кэш
+    EXPIRY_MARGIN = 120.0
+    # Пауза перед повторной попыткой создать кэш после ошибки
+    CREATE_RETRY_SECONDS = 300.0
+
+    def __init__(
+        self,
+        models: Collection[str] = (),
+        min_tokens: int = 1024,
+        ttl_seconds: int = 3600
+    ):
+        """
+        Args:
+            models: Модели, для которых включен context caching
+                (модели генерации изображений его пока не поддерживают)
+            min_tokens: Минимальный размер кэшируемого содержимого в токенах
+            ttl_seconds: Время жизни CachedContent
+        """
+        self.models = set(models)
+        self.min_tokens = min_tokens
+        self.ttl_seconds = ttl_seconds
+        self._compiled: Dict[str, CompiledPrompt] = {}
+        # (модель, location, стиль) -> кэш текущей версии
+        self._remote: Dict[Tuple[str, str, str], _RemoteEntry] = {}
+
+        self.compiles = 0
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.create_errors = 0
+        self.invalidated = 0
+        self.cached_tokens = 0
+
+    def compile(self, style: Dict[str, Any]) -> CompiledPrompt:
+        """Промпт стиля (пересобирается, только если изменилась версия)"""
+        version = get_prompt_version(style)
+        compiled = self._compiled.get(style["id"])
+        if compiled is not None and compiled.version == version:
+            return compiled
+
+        compiled = CompiledPrompt(
+            style["id"],
+            version,
+            style.get("system_instruction", ""),
+            style["prompt"]
+        )
+        self._compiled[style["id"]] = compiled
+        self.compiles += 1
+        logger.info(
+            f"Compiled prompt for style '{compiled.style_id}' "
+            f"(version {version}, ~{compiled.estimated_tokens} tokens)"
+        )
+        return compiled
+
+    def compile_all(self, styles: Iterable[Dict[str, Any]]):
+        """Собрать промпты всех стилей (при старте)"""
+        for style in styles:
+            if style.get("prompt") and not style.get("placeholder"):
+                self.compile(style)
+
+    def cacheable(self, model_name: str, compiled: CompiledPrompt) -> bool:
+        return model_name in self.models and compiled.estimated_tokens >= self.min_tokens
+
+    def lookup(
+        self,
+        model_name: str,
+        location: str,
+        compiled: CompiledPrompt,
+        create: Callable[[CompiledPrompt, int], Any],
+        delete: Callable[[str], Any]
+    ) -> Optional[str]:
+        """
+        Имя CachedContent для вызова или None (вызов с полным промптом).
+        Кэш создаётся в фоне: запрос, который его запустил, не ждёт создания.
+
+        Args:
+            create: create(compiled, ttl) -> имя CachedContent (синхронный вызов API)
+            delete: delete(name) - удалить CachedContent (синхронный вызов API)
+        """
+        if not self.cacheable(model_name, compiled):
+            return None
+
+        key = (model_name, location, compiled.style_id)
+        entry = self._remote.get(key)
+        if entry is not None and entry.version != compiled.version:
+            # Промпт стиля изменился - кэш старой версии больше не нужен
+            self._drop(key, delete)
+            entry = None
+
+        now = time.monotonic()
+        if entry is not None and entry.name and entry.expires_at - self.EXPIRY_MARGIN > now:
+            self.hits += 1
+            self.cached_tokens += compiled.estimated_tokens
+            return entry.name
+
+        self.misses += 1
+        if entry is None:
+            entry = self._remote[key] = _RemoteEntry(compiled.version)
+        if (entry.task is None or entry.task.done()) and entry.retry_at <= now:
+            entry.task = asyncio.create_task(self._create(key, entry, compiled, create, delete))
+        return None
+
+    async def _create(
+        self,
+        key: Tuple[str, str, str],
+        entry: _RemoteEntry,
+        compiled: CompiledPrompt,
+        create: Callable[[CompiledPrompt, int], Any],
+        delete: Callable[[str], Any]
+    ):
+        model_name, location, style_id = key
+        previous = entry.name
+        try:
+            name = await asyncio.to_thread(create, compiled, self.ttl_seconds)
+        except Exception as e:
+            self.create_errors += 1
+            entry.retry_at = time.monotonic() + self.CREATE_RETRY_SECONDS
+            logger.warning(f"Context cache for style '{style_id}' in {model_name}@{location} failed: {e}")
+            return
+
+        entry.name = name
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+        self.created += 1
+        logger.info(f"Context cache for style '{style_id}' in {model_name}@{location}: {name}")
+        if previous and previous != name:
+            # Истекающий кэш той же версии заменён новым
+            self._schedule_delete(previous, delete)
+
+    def invalidate(self, model_name: str, location: str, style_id: str):
+        """Кэш не найден на стороне Vertex AI - забыть его, следующий запрос создаст новый"""
+        if self._remote.pop((model_name, location, style_id), None) is not None:
+            self.invalidated += 1
+
+    def _drop(self, key: Tuple[str, str, str], delete: Callable[[str], Any]):
+        entry = self._remote.pop(key)
+        self.invalidated += 1
+        if entry.task is not None and not entry.task.done():
+            entry.task.cancel()
+        if entry.name:
+            self._schedule_delete(entry.name, delete)
+
+    def _schedule_delete(self, name: str, delete: Callable[[str], Any]):
+        async def run():
+            try:
+                await asyncio.to_thread(delete, name)
+            except Exception as e:
+                # Кэш всё равно истечёт по TTL
+                logger.warning(f"Failed to delete context cache {name}: {e}")
+
+        asyncio.create_task(run())
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "compiled": len(self._compiled),
+            "compiles": self.compiles,
+            "remote": sum(1 for entry in self._remote.values() if entry.name),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "create_errors": self.create_errors,
+            "invalidated": self.invalidated,
+            "cached_tokens": self.cached_tokens,
+        }
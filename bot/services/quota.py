@@ -0,0 +1,305 @@
+"""
+Client-side quota governor
+Token bucket на модель в регионе (запросы в минуту и токены в минуту; квоты Vertex AI
+региональные), общий для всех вызовов в процессе. Запросы без свободной квоты ждут
+в FIFO-очереди с видимой позицией; после 429 скорость региона снижается и затем
+плавно восстанавливается - остальные регионы модели не замедляются.
+Квота, выданная запросу, который так и не ушёл в модель (отмена, отказ до вызова),
+возвращается в бакет (refund).
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaTimeout(Exception):
+    """Квота не освободилась за отведённое время"""
+
+    def __init__(self, model: str, position: int, waited: float):
+        super().__init__(f"No quota for {model} after {waited:.0f}s (queue position {position})")
+        self.model = model
+        self.position = position
+        self.waited = waited
+
+
+class _Ticket:
+    """Место в очереди за квотой"""
+
+    def __init__(self, tokens: int, on_position: Optional[Callable[[int], None]]):
+        self.tokens = tokens
+        self.on_position = on_position
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class QuotaBucket:
+    """Квота одной модели в одном регионе"""
+
+    # После 429 скорость умножается на DECREASE, каждый успешный вызов добавляет RECOVERY
+    DECREASE = 0.5
+    RECOVERY = 0.02
+    MIN_SCALE = 0.1
+
+    def __init__(self, model: str, rpm: int, tpm: int, burst_seconds: float = 10.0):
+        """
+        Args:
+            model: Имя бакета (модель@регион)
+            rpm: Запросов в минуту (0 - без ограничения)
+            tpm: Токенов в минуту (0 - без ограничения)
+            burst_seconds: Сколько секунд квоты можно израсходовать разом
+        """
+        self.model = model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.burst_seconds = burst_seconds
+        self.scale = 1.0
+
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._updated = time.monotonic()
+        self._waiters: Deque[_Ticket] = deque()
+        self._pump_task: Optional[asyncio.Task] = None
+
+        self.granted = 0
+        self.refunded = 0
+        self.timeouts = 0
+        self.throttled = 0
+
+    @property
+    def _request_capacity(self) -> float:
+        if self.rpm <= 0:
+            return float("inf")
+        return max(self.rpm * self.burst_seconds / 60, 1.0)
+
+    @property
+    def _token_capacity(self) -> float:
+        if self.tpm <= 0:
+            return float("inf")
+        return max(self.tpm * self.burst_seconds / 60, 1.0)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self._requests + elapsed * self.rpm / 60 * self.scale, self._request_capacity)
+        self._tokens = min(self._tokens + elapsed * self.tpm / 60 * self.scale, self._token_capacity)
+
+    def _fits(self, tokens: int) -> bool:
+        # Запрос больше всей ёмкости по токенам пропускаем при полном бакете
+        return self._requests >= 1 and self._tokens >= min(tokens, self._token_capacity)
+
+    def _take(self, tokens: int):
+        self._requests -= 1
+        self._tokens -= tokens
+        self.granted += 1
+
+    def _wait_time(self, tokens: int) -> float:
+        """Через сколько секунд освободится квота для запроса"""
+        rate = self.scale / 60
+        wait = 0.01
+        if self.rpm > 0:
+            wait = max(wait, max(1 - self._requests, 0) / (self.rpm * rate))
+        if self.tpm > 0:
+            wait = max(wait, max(min(tokens, self._token_capacity) - self._tokens, 0) / (self.tpm * rate))
+        return wait
+
+    async def acquire(
+        self,
+        tokens: int,
+        timeout: float,
+        on_position: Optional[Callable[[int], None]] = None
+    ):
+        """
+        Получить квоту на один запрос.
+        Ждёт в FIFO-очереди не дольше timeout, иначе QuotaTimeout.
+        on_position(n) вызывается при изменении места в очереди (0 - квота получена).
+        """
+        self._refill()
+        if not self._waiters and self._fits(tokens):
+            self._take(tokens)
+            return
+
+        self.throttled += 1
+        ticket = _Ticket(tokens, on_position)
+        self._waiters.append(ticket)
+        self._notify_positions()
+        self._ensure_pump()
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except asyncio.TimeoutError:
+            if ticket.future.done():
+                # Квота выдана в последний момент
+                return
+            position = self._waiters.index(ticket) + 1
+            self._waiters.remove(ticket)
+            self._notify_positions()
+            self.timeouts += 1
+            raise QuotaTimeout(self.model, position, time.monotonic() - started)
+        except asyncio.CancelledError:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                self._notify_positions()
+            elif ticket.future.done() and not ticket.future.cancelled():
+                # Квота выдана, но вызывающего уже отменили - запроса не будет
+                self.refund(tokens)
+            raise
+
+    def _notify_positions(self):
+        for position, ticket in enumerate(self._waiters, start=1):
+            if ticket.on_position is not None:
+                ticket.on_position(position)
+
+    def _ensure_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        """Выдаёт квоту голове очереди по мере пополнения бакета"""
+        while self._waiters:
+            self._refill()
+            head = self._waiters[0]
+            if head.future.done():
+                self._waiters.popleft()
+                continue
+            if self._fits(head.tokens):
+                self._take(head.tokens)
+                self._waiters.popleft()
+                head.future.set_result(None)
+                if head.on_position is not None:
+                    head.on_position(0)
+                self._notify_positions()
+                continue
+            await asyncio.sleep(self._wait_time(head.tokens))
+
+    def refund(self, tokens: int):
+        """Вернуть квоту запроса, который не был отправлен в модель"""
+        self._refill()
+        self._requests = min(self._requests + 1, self._request_capacity)
+        self._tokens = min(self._tokens + tokens, self._token_capacity)
+        self.refunded += 1
+        if self._waiters:
+            # Насос спит до расчётного пополнения - перезапускаем, чтобы выдать квоту сразу
+            if self._pump_task is not None and not self._pump_task.done():
+                self._pump_task.cancel()
+            self._pump_task = asyncio.create_task(self._pump())
+
+    def adjust(self, extra_tokens: int):
+        """Поправка после ответа: фактически потрачено больше (или меньше) токенов, чем оценено"""
+        self._tokens = min(self._tokens - extra_tokens, self._token_capacity)
+
+    def on_success(self):
+        if self.scale < 1.0:
+            self.scale = min(self.scale + self.RECOVERY, 1.0)
+
+    def on_quota_error(self):
+        """429: снижаем скорость и обнуляем накопленный запас"""
+        self.scale = max(self.scale * self.DECREASE, self.MIN_SCALE)
+        self._refill()
+        if self.rpm > 0:
+            self._requests = min(self._requests, 0.0)
+        else:
+            self._tokens = min(self._tokens, 0.0)
+        logger.warning(f"Quota governor for {self.model}: rate scaled down to {self.scale:.0%}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "scale": round(self.scale, 3),
+            "queue": len(self._waiters),
+            "available_requests": round(self._requests, 1) if self.rpm > 0 else None,
+            "available_tokens": round(self._tokens) if self.tpm > 0 else None,
+            "granted": self.granted,
+            "refunded": self.refunded,
+            "throttled": self.throttled,
+            "timeouts": self.timeouts,
+        }
+
+
+class QuotaGovernor:
+    """Квоты всех моделей процесса (бакет на модель в каждом регионе)"""
+
+    def __init__(self, limits: Dict[str, Dict[str, int]], wait_timeout: float = 60.0):
+        """
+        Args:
+            limits: Лимиты региона по имени модели: {"rpm": ..., "tpm": ...}
+                (0 - без ограничения по этому измерению)
+            wait_timeout: Максимальное ожидание квоты по умолчанию (сек)
+        """
+        self.limits = {
+            model: limit for model, limit in limits.items()
+            if limit["rpm"] > 0 or limit["tpm"] > 0
+        }
+        self.wait_timeout = wait_timeout
+        self._buckets: Dict[Tuple[str, str], QuotaBucket] = {}
+
+    def bucket(self, model: str, location: str) -> Optional[QuotaBucket]:
+        """Бакет модели в регионе (None - модель без ограничения)"""
+        limit = self.limits.get(model)
+        if limit is None:
+            return None
+        key = (model, location)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = QuotaBucket(f"{model}@{location}", limit["rpm"], limit["tpm"])
+            self._buckets[key] = bucket
+        return bucket
+
+    async def acquire(
+        self,
+        model: str,
+        location: str,
+        tokens: int,
+        timeout: Optional[float] = None,
+        on_position: Optional[Callable[[int], None]] = None
+    ):
+        bucket = self.bucket(model, location)
+        if bucket is None:
+            return
+        await bucket.acquire(tokens, self.wait_timeout if timeout is None else timeout, on_position)
+
+    def refund(self, model: str, location: str, tokens: int):
+        """Вернуть квоту, полученную acquire, если запрос так и не ушёл в модель"""
+        bucket = self.bucket(model, location)
+        if bucket is not None:
+            bucket.refund(tokens)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {bucket.model: bucket.get_stats() for bucket in self._buckets.values()}
+
+
+# Синглтон для переиспользования
+_quota_governor: Optional[QuotaGovernor] = None
+
+
+def get_quota_governor() -> QuotaGovernor:
+    """Получить общий для процесса регулятор квот (синглтон)"""
+    global _quota_governor
+    if _quota_governor is None:
+        from bot.config import get_settings
+        from bot.services.vertex_ai import VertexAIService
+        settings = get_settings()
+        models = VertexAIService.MODELS
+        _quota_governor = QuotaGovernor(
+            {
+                models["normal"]["name"]: {
+                    "rpm": settings.vertex_normal_rpm,
+                    "tpm": settings.vertex_normal_tpm,
+                },
+                models["pro"]["name"]: {
+                    "rpm": settings.vertex_pro_rpm,
+                    "tpm": settings.vertex_pro_tpm,
+                },
+            },
+            wait_timeout=settings.vertex_quota_wait_seconds
+        )
+        register_stats_provider("vertex_quota", _quota_governor.get_stats)
+    return _quota_governor
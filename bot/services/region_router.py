@@ -0,0 +1,133 @@
+"""
+Latency-aware region routing
+Для модели задаётся список регионов-кандидатов. По каждому региону ведутся
+скользящие (EWMA) задержка и доля ошибок, учитываются 429; запрос уходит
+в лучший регион (взвешенный случайный выбор с исследованием остальных),
+регион с исчерпанной квотой временно исключается.
+"""
+import logging
+import random
+import time
+from typing import Any, Collection, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RegionStats:
+    """Скользящая статистика одного региона модели"""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.quota_until = 0.0
+
+    def record(self, latency: Optional[float], outcome: str):
+        self.requests += 1
+        failed = outcome != "ok"
+        if failed:
+            self.errors += 1
+        self.error_rate += self.alpha * ((1.0 if failed else 0.0) - self.error_rate)
+        if latency is not None and not failed:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "quota_errors": self.quota_errors,
+            "quota_cooldown_s": round(max(self.quota_until - time.monotonic(), 0.0), 1),
+        }
+
+
+class RegionRouter:
+    """Выбор региона для вызова модели"""
+
+    # Штраф за ошибки: при error_rate = 1 регион выглядит в (1 + ERROR_PENALTY) раз медленнее
+    ERROR_PENALTY = 4.0
+
+    def __init__(
+        self,
+        candidates: Dict[str, List[str]],
+        exploration: float = 0.05,
+        alpha: float = 0.2,
+        quota_cooldown: float = 30.0
+    ):
+        """
+        Args:
+            candidates: Регионы-кандидаты по имени модели (первый - предпочтительный)
+            exploration: Доля запросов в случайный регион (чтобы статистика не устаревала)
+            alpha: Вес нового замера в EWMA
+            quota_cooldown: На сколько секунд исключать регион после 429
+        """
+        self.candidates = candidates
+        self.exploration = exploration
+        self.alpha = alpha
+        self.quota_cooldown = quota_cooldown
+        self._stats: Dict[str, Dict[str, RegionStats]] = {
+            model: {location: RegionStats(alpha) for location in locations}
+            for model, locations in candidates.items()
+        }
+
+    def locations(self, model: str) -> List[str]:
+        return self.candidates[model]
+
+    def _score(self, stats: RegionStats, default_latency: float) -> float:
+        latency = stats.latency if stats.latency is not None else default_latency
+        return latency * (1.0 + self.ERROR_PENALTY * stats.error_rate)
+
+    def choose(self, model: str, exclude: Collection[str] = ()) -> Optional[str]:
+        """Регион для следующего запроса (None - все кандидаты исключены)"""
+        now = time.monotonic()
+        model_stats = self._stats[model]
+        available = [
+            location for location in self.candidates[model]
+            if location not in exclude and model_stats[location].quota_until <= now
+        ]
+        if not available:
+            # Все регионы на паузе после 429 - пробуем тот, чья пауза кончится раньше
+            available = sorted(
+                (location for location in self.candidates[model] if location not in exclude),
+                key=lambda location: model_stats[location].quota_until
+            )[:1]
+        if len(available) <= 1:
+            return available[0] if available else None
+
+        if random.random() < self.exploration:
+            return random.choice(available)
+
+        # Регион без замеров оцениваем как лучший из известных - он быстро наберёт статистику
+        known = [model_stats[location].latency for location in available
+                 if model_stats[location].latency is not None]
+        default_latency = min(known) if known else 1.0
+        weights = [
+            1.0 / max(self._score(model_stats[location], default_latency), 1e-3) ** 2
+            for location in available
+        ]
+        return random.choices(available, weights=weights)[0]
+
+    def record(self, model: str, location: str, latency: Optional[float], outcome: str):
+        """
+        Учесть результат вызова
+        outcome: ok, error или quota (429)
+        """
+        stats = self._stats[model][location]
+        stats.record(latency, outcome)
+        if outcome == "quota":
+            stats.quota_errors += 1
+            stats.quota_until = time.monotonic() + self.quota_cooldown
+            logger.warning(f"Quota exhausted for {model} in {location}, cooling down {self.quota_cooldown:.0f}s")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            model: {location: stats.get_stats() for location, stats in model_stats.items()}
+            for model, model_stats in self._stats.items()
+        }
@@ -0,0 +1,247 @@
+"""
+Content-addressed cache of generation results
+Ключ - хэш исходного фото + стиль + режим + версия промпта.
+Повторная отправка того же фото с тем же шаблоном отдаётся из кэша без вызова Vertex AI.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    """Базовый интерфейс хранилища кэша"""
+
+    name = "base"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = await self.get_entry(key)
+        return entry[1] if entry is not None else None
+
+    async def get_entry(self, key: str) -> Optional[Tuple[float, bytes]]:
+        """Запись вместе со временем истечения (expires_at, value)"""
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-memory LRU с бюджетом по байтам"""
+
+    name = "memory"
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._size = 0
+
+    async def get_entry(self, key: str) -> Optional[Tuple[float, bytes]]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        if item[0] < time.time():
+            self._remove(key)
+            return None
+
+        self._items.move_to_end(key)
+        return item
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        if len(value) > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._items[key] = (time.time() + ttl, value)
+        self._size += len(value)
+
+        # Вытесняем самые старые записи, пока не уложимся в бюджет
+        while self._size > self.max_bytes and self._items:
+            oldest_key = next(iter(self._items))
+            self._remove(oldest_key)
+
+    def _remove(self, key: str):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item[1])
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"items": len(self._items), "bytes": self._size, "max_bytes": self.max_bytes}
+
+
+class DiskCacheBackend(CacheBackend):
+    """
+    Файловый кэш: один файл на ключ, в начале файла - время истечения записи.
+    Файловые операции выполняются в потоке, чтобы не блокировать event loop.
+    """
+
+    name = "disk"
+    _HEADER = struct.Struct("<d")
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _read(self, key: str) -> Optional[Tuple[float, bytes]]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        (expires_at,) = self._HEADER.unpack_from(data)
+        if expires_at < time.time():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return expires_at, data[self._HEADER.size:]
+
+    def _write(self, key: str, value: bytes, ttl: float):
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self._HEADER.pack(time.time() + ttl))
+            f.write(value)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        """Удаляем самые старые файлы, если превышен бюджет"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    async def get_entry(self, key: str) -> Optional[Tuple[float, bytes]]:
+        return await asyncio.to_thread(self._read, key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await asyncio.to_thread(self._write, key, value, ttl)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"directory": self.directory, "max_bytes": self.max_bytes}
+
+
+class ResultCache:
+    """Многоуровневый кэш результатов генерации (первый backend - самый быстрый)"""
+
+    def __init__(self, backends: List[CacheBackend], ttl: int = 3600):
+        self.backends = backends
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(photo_key: str, style_id: str, mode: str, prompt_version: str) -> str:
+        """Ключ кэша: стабильный идентификатор фото + параметры генерации"""
+        raw = f"{photo_key}|{style_id}|{mode}|{prompt_version}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def hash_photo(photo_bytes: bytes) -> str:
+        return hashlib.sha256(photo_bytes).hexdigest()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        for i, backend in enumerate(self.backends):
+            try:
+                entry = await backend.get_entry(key)
+            except Exception as e:
+                logger.warning(f"Result cache {backend.name} read error: {e}")
+                continue
+
+            if entry is not None:
+                self.hits += 1
+                expires_at, value = entry
+                # Поднимаем запись в более быстрые уровни с оставшимся сроком жизни,
+                # иначе каждое поднятие продлевало бы запись заново
+                remaining = expires_at - time.time()
+                if remaining > 0:
+                    for faster in self.backends[:i]:
+                        try:
+                            await faster.set(key, value, remaining)
+                        except Exception as e:
+                            logger.warning(f"Result cache {faster.name} write error: {e}")
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: bytes):
+        for backend in self.backends:
+            try:
+                await backend.set(key, value, self.ttl)
+            except Exception as e:
+                logger.warning(f"Result cache {backend.name} write error: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "ttl": self.ttl,
+            "backends": {backend.name: backend.get_stats() for backend in self.backends},
+        }
+
+
+# Синглтон для переиспользования
+_result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    """Получить кэш результатов (None, если кэш отключен настройками)"""
+    global _result_cache
+    if _result_cache is None:
+        from bot.config import get_settings
+        settings = get_settings()
+
+        backends: List[CacheBackend] = []
+        if settings.result_cache_memory_mb > 0:
+            backends.append(MemoryCacheBackend(settings.result_cache_memory_mb * 1024 * 1024))
+        if settings.result_cache_dir:
+            backends.append(DiskCacheBackend(
+                settings.result_cache_dir,
+                settings.result_cache_disk_mb * 1024 * 1024
+            ))
+        if not backends:
+            return None
+
+        _result_cache = ResultCache(backends, ttl=settings.result_cache_ttl)
+        register_stats_provider("result_cache", _result_cache.get_stats)
+    return _result_cache
+
+
+def reset_result_cache():
+    """Сбросить синглтон (для тестирования)"""
+    global _result_cache
+    _result_cache = None
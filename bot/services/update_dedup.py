@@ -0,0 +1,104 @@
+"""
+Update de-duplication
+Telegram повторяет апдейт с тем же update_id, если ответ на webhook задержался
+или не дошёл. Повтор не должен второй раз списать энергию и запустить генерацию:
+update_id сначала проверяется в локальном LRU (повтор на тот же инстанс),
+затем занимается документом processed_updates с коротким TTL (повтор на другой инстанс).
+"""
+import logging
+import os
+import socket
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """Отсев повторно доставленных апдейтов"""
+
+    def __init__(self, ttl_seconds: int = 3600, max_local: int = 10000, shared: bool = True):
+        """
+        Args:
+            ttl_seconds: Сколько хранить отметку об апдейте в Firestore
+            max_local: Сколько последних update_id помнить локально
+            shared: Проверять повторы между инстансами (документ в Firestore)
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_local = max_local
+        self.shared = shared
+        self.instance_id = os.environ.get("K_REVISION", socket.gethostname()) + f"-{os.getpid()}"
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+
+        self.accepted = 0
+        self.duplicates_local = 0
+        self.duplicates_shared = 0
+        self.errors = 0
+
+    def seen(self, update_id: int) -> bool:
+        """Апдейт уже принят этим инстансом"""
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            self.duplicates_local += 1
+            logger.info(f"Duplicate update {update_id} suppressed (local)")
+            return True
+        return False
+
+    def remember(self, update_id: int):
+        """Отметить апдейт как принятый этим инстансом"""
+        self._seen[update_id] = None
+        while len(self._seen) > self.max_local:
+            self._seen.popitem(last=False)
+
+    async def claim(self, update_id: int) -> bool:
+        """
+        Занять апдейт для обработки между инстансами.
+        False - его уже обрабатывает другой инстанс; при ошибке Firestore апдейт обрабатывается.
+        """
+        if not self.shared:
+            self.accepted += 1
+            return True
+
+        from bot.firestore import claim_update
+        claimed = await claim_update(update_id, self.instance_id, self.ttl_seconds)
+        if claimed is False:
+            self.duplicates_shared += 1
+            logger.info(f"Duplicate update {update_id} suppressed (claimed by another instance)")
+            return False
+        if claimed is None:
+            self.errors += 1
+        self.accepted += 1
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "accepted": self.accepted,
+            "duplicates_local": self.duplicates_local,
+            "duplicates_shared": self.duplicates_shared,
+            "suppressed": self.duplicates_local + self.duplicates_shared,
+            "errors": self.errors,
+            "local_entries": len(self._seen),
+        }
+
+
+# Синглтон для переиспользования
+_update_deduplicator: Optional[UpdateDeduplicator] = None
+
+
+def get_update_deduplicator() -> Optional[UpdateDeduplicator]:
+    """Получить фильтр повторных апдейтов (синглтон); None - фильтр отключен"""
+    global _update_deduplicator
+    if _update_deduplicator is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        if not settings.updates_dedup_enabled:
+            return None
+        _update_deduplicator = UpdateDeduplicator(
+            ttl_seconds=settings.updates_dedup_ttl_seconds,
+            max_local=settings.updates_dedup_local_size,
+            shared=settings.updates_dedup_shared
+        )
+        register_stats_provider("update_dedup", _update_deduplicator.get_stats)
+    return _update_deduplicator
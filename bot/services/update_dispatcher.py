@@ -0,0 +1,249 @@
+"""
+Background update dispatch
+Webhook только проверяет апдейт, кладёт его в очередь полосы и сразу отвечает
+Telegram 200. Апдейты обрабатываются воркерами своей полосы:
+    interactive - колбэки, команды, текст (быстрые ответы на нажатия)
+    heavy       - фото (скачивание, проверка качества, постановка генерации)
+Тяжёлые апдейты не занимают воркеры интерактивной полосы. Внутри полосы у каждого
+воркера своя очередь, апдейт попадает в неё по пользователю (или чату): апдейты
+одного пользователя обрабатываются по порядку и не параллельно - иначе колбэк и
+следующая команда гонялись бы за состояние FSM. Повторно доставленные
+апдейты отсеиваются до обработки (UpdateDeduplicator). При остановке
+очереди дорабатываются в пределах drain_timeout.
+
+На Cloud Run фоновая обработка после ответа требует CPU always allocated
+(--no-cpu-throttling в cloudbuild.yaml / cloudbuild-dev.yaml).
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.types.update import UpdateTypeLookupError
+
+from bot.services.hedging import LatencyTracker
+from bot.services.update_dedup import UpdateDeduplicator, get_update_deduplicator
+from bot.services.metrics import register_stats_provider
+
+logger = logging.getLogger(__name__)
+
+
+def update_shard_key(update) -> int:
+    """Ключ порядка апдейта: пользователь, иначе чат, иначе сам апдейт"""
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return update.update_id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return update.update_id
+
+
+class UpdateLane:
+    """Полоса обработки: пул воркеров, у каждого своя ограниченная очередь (шард)"""
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        # max_queue - на всю полосу, поровну между шардами
+        shard_size = max(-(-max_queue // workers), 1)
+        self.queues: "List[asyncio.Queue[Tuple[Any, float]]]" = [
+            asyncio.Queue(maxsize=shard_size) for _ in range(workers)
+        ]
+        self.tasks: List[asyncio.Task] = []
+
+        self.busy = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.waits = LatencyTracker(window=1000)
+        self.durations = LatencyTracker(window=1000)
+
+    def shard(self, update) -> "asyncio.Queue[Tuple[Any, float]]":
+        """Очередь воркера, который обрабатывает апдейты этого пользователя"""
+        return self.queues[update_shard_key(update) % self.workers]
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "max_shard_depth": max(queue.qsize() for queue in self.queues),
+            "max_depth": self.max_depth,
+            "max_queue": self.max_queue,
+            "workers": self.workers,
+            "busy": self.busy,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_p50_ms": round(self.waits.percentile(0.5) * 1000, 1),
+            "wait_p95_ms": round(self.waits.percentile(0.95) * 1000, 1),
+            "wait_max_ms": round(self.waits.percentile(1.0) * 1000, 1),
+            "handle_p95_ms": round(self.durations.percentile(0.95) * 1000, 1),
+        }
+
+
+class UpdateDispatcher:
+    """Очереди апдейтов по полосам с фоновыми воркерами"""
+
+    INTERACTIVE = "interactive"
+    HEAVY = "heavy"
+
+    def __init__(
+        self,
+        workers: Optional[Dict[str, int]] = None,
+        max_queue: Optional[Dict[str, int]] = None,
+        drain_timeout: float = 8.0,
+        dedup: Optional[UpdateDeduplicator] = None
+    ):
+        """
+        Args:
+            workers: Число воркеров по полосам
+            max_queue: Максимальная длина очереди по полосам (переполнение - 503,
+                Telegram повторит доставку позже)
+            drain_timeout: Сколько ждать обработки очередей при остановке (сек)
+            dedup: Фильтр повторно доставленных апдейтов (None - без фильтра)
+        """
+        workers = {self.INTERACTIVE: 16, self.HEAVY: 8, **(workers or {})}
+        max_queue = {self.INTERACTIVE: 1000, self.HEAVY: 200, **(max_queue or {})}
+        self.lanes = {
+            name: UpdateLane(name, workers[name], max_queue[name])
+            for name in (self.INTERACTIVE, self.HEAVY)
+        }
+        self.drain_timeout = drain_timeout
+        self.dedup = dedup
+        self._dp = None
+        self._bot = None
+        self._accepting = False
+
+    @property
+    def running(self) -> bool:
+        return self._accepting
+
+    def classify(self, update) -> str:
+        """Полоса апдейта: фото - heavy, всё остальное - interactive"""
+        message = update.message
+        if message is not None and message.photo:
+            return self.HEAVY
+        return self.INTERACTIVE
+
+    def start(self, dp, bot):
+        """Запустить воркеры всех полос"""
+        if self._accepting:
+            return
+        self._dp = dp
+        self._bot = bot
+        for lane in self.lanes.values():
+            lane.tasks = [
+                asyncio.create_task(self._worker(lane, queue), name=f"updates-{lane.name}-{i}")
+                for i, queue in enumerate(lane.queues)
+            ]
+        self._accepting = True
+        logger.info(
+            "Update dispatcher started: " + ", ".join(
+                f"{lane.name}={lane.workers} workers" for lane in self.lanes.values()
+            )
+        )
+
+    def submit(self, update) -> bool:
+        """Поставить апдейт в очередь полосы; False - очередь переполнена или диспетчер остановлен"""
+        if not self._accepting:
+            return False
+        if self.dedup is not None and self.dedup.seen(update.update_id):
+            # Повтор уже принятого апдейта - подтверждаем, не обрабатывая
+            return True
+        lane = self.lanes[self.classify(update)]
+        try:
+            lane.shard(update).put_nowait((update, time.monotonic()))
+        except asyncio.QueueFull:
+            lane.rejected += 1
+            logger.warning(f"Update lane '{lane.name}' shard is full, update {update.update_id} rejected")
+            return False
+        if self.dedup is not None:
+            # Только принятый апдейт: отклонённый по 503 Telegram пришлёт снова
+            self.dedup.remember(update.update_id)
+        lane.max_depth = max(lane.max_depth, lane.depth)
+        return True
+
+    async def _worker(self, lane: UpdateLane, queue: "asyncio.Queue[Tuple[Any, float]]"):
+        while True:
+            update, enqueued_at = await queue.get()
+            started = time.monotonic()
+            lane.waits.record(started - enqueued_at)
+            lane.busy += 1
+            try:
+                # Повтор мог прийти на другой инстанс раньше
+                if self.dedup is not None and not await self.dedup.claim(update.update_id):
+                    continue
+                await self._dp.feed_update(bot=self._bot, update=update)
+                lane.processed += 1
+            except Exception as e:
+                lane.failed += 1
+                logger.error(f"Error processing update {update.update_id} in lane '{lane.name}': {e}", exc_info=True)
+            finally:
+                lane.busy -= 1
+                lane.durations.record(time.monotonic() - started)
+                queue.task_done()
+
+    async def stop(self):
+        """Перестать принимать апдейты, дождаться очередей (не дольше drain_timeout) и остановить воркеры"""
+        if not self._accepting:
+            return
+        self._accepting = False
+        pending = sum(lane.depth + lane.busy for lane in self.lanes.values())
+        logger.info(f"Draining update lanes: {pending} updates pending")
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(
+                    queue.join() for lane in self.lanes.values() for queue in lane.queues
+                )),
+                self.drain_timeout
+            )
+        except asyncio.TimeoutError:
+            left = sum(lane.depth + lane.busy for lane in self.lanes.values())
+            logger.warning(f"Update lanes not drained in {self.drain_timeout:.0f}s: {left} updates dropped")
+
+        tasks = [task for lane in self.lanes.values() for task in lane.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for lane in self.lanes.values():
+            lane.tasks = []
+        logger.info("Update dispatcher stopped")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {name: lane.get_stats() for name, lane in self.lanes.items()}
+
+
+# Синглтон для переиспользования
+_update_dispatcher: Optional[UpdateDispatcher] = None
+
+
+def get_update_dispatcher() -> UpdateDispatcher:
+    """Получить диспетчер апдейтов (синглтон)"""
+    global _update_dispatcher
+    if _update_dispatcher is None:
+        from bot.config import get_settings
+        settings = get_settings()
+        _update_dispatcher = UpdateDispatcher(
+            workers={
+                UpdateDispatcher.INTERACTIVE: settings.updates_interactive_workers,
+                UpdateDispatcher.HEAVY: settings.updates_heavy_workers,
+            },
+            max_queue={
+                UpdateDispatcher.INTERACTIVE: settings.updates_interactive_queue,
+                UpdateDispatcher.HEAVY: settings.updates_heavy_queue,
+            },
+            drain_timeout=settings.updates_drain_seconds,
+            dedup=get_update_deduplicator()
+        )
+        register_stats_provider("updates", _update_dispatcher.get_stats)
+    return _update_dispatcher
@@ -2,78 +2,541 @@
 Vertex AI Service for image generation using Gemini 2.5 Flash/Pro Image models
 Supports batch generation and ADC authentication
 """
+import google.auth
+from google.api_core.client_options import ClientOptions
+from google.api_core import exceptions as api_exceptions
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests
+from google.auth.transport.requests import Request
+from google.cloud.aiplatform_v1beta1.services.gen_ai_cache_service import GenAiCacheServiceClient
+from google.cloud.aiplatform_v1beta1.types import CachedContent as GapicCachedContent, Content as GapicContent, Part as GapicPart
+from google.protobuf import duration_pb2
+from google.cloud.aiplatform_v1beta1.services.prediction_service import (
+    PredictionServiceAsyncClient,
+    PredictionServiceClient,
+)
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
 import asyncio
-from typing import List, Optional
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 import logging
 import base64
+import random
+import time
 
-from bot.styles_data import get_style_by_id
+from bot.styles_data import STYLES, get_style_by_id, get_prompt_version
+from bot.services.deadline import Deadline, DeadlineExceeded
+from bot.services.generation_trace import GenerationOutcome, GenerationTrace
+from bot.services.region_router import RegionRouter
+from bot.services.circuit_breaker import CircuitBreaker, CircuitBreakerRegistry, CircuitOpenError
+from bot.services.hedging import HedgePolicy
+from bot.services.quota import QuotaGovernor, QuotaTimeout, get_quota_governor
+from bot.services.prompt_cache import CompiledPrompt, PromptCache
+from bot.services.metrics import register_stats_provider
+from bot.services.result_cache import ResultCache, get_result_cache
 
 logger = logging.getLogger(__name__)
 
 
+# finish_reason / block_reason, при которых повтор даст тот же результат
+_BLOCKED_REASONS = {
+    "SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "MODEL_ARMOR",
+    "IMAGE_SAFETY", "IMAGE_PROHIBITED_CONTENT", "IMAGE_RECITATION",
+}
+# Ответ завершился штатно, но без изображения
+_MALFORMED_REASONS = {"STOP", "MAX_TOKENS", "MALFORMED_FUNCTION_CALL", "NO_IMAGE", "IMAGE_OTHER"}
+
+# Ошибки API, которые не исправятся повтором того же запроса
+_NON_RETRYABLE_ERRORS = (
+    api_exceptions.InvalidArgument,
+    api_exceptions.FailedPrecondition,
+    api_exceptions.PermissionDenied,
+    api_exceptions.Unauthenticated,
+    api_exceptions.NotFound,
+)
+
+
+def _enum_name(value) -> str:
+    return getattr(value, "name", None) or str(value or "")
+
+
+def classify_response(response) -> Tuple[str, Optional[bytes], Optional[str]]:
+    """
+    Итог ответа модели: (GenerationOutcome, изображение, подробность).
+    Смотрит prompt_feedback, finish_reason и safety_ratings кандидата.
+    """
+    feedback = getattr(response, "prompt_feedback", None)
+    block_reason = _enum_name(getattr(feedback, "block_reason", None)) if feedback else ""
+    if block_reason and block_reason != "BLOCKED_REASON_UNSPECIFIED":
+        return GenerationOutcome.BLOCKED, None, f"prompt:{block_reason}"
+    
+    if not response.candidates:
+        return GenerationOutcome.MALFORMED, None, "no_candidates"
+    
+    candidate = response.candidates[0]
+    if candidate.content and candidate.content.parts:
+        for part in candidate.content.parts:
+            # Проверяем наличие inline_data (изображение)
+            if hasattr(part, 'inline_data') and part.inline_data:
+                image_data = part.inline_data.data
+                if isinstance(image_data, str):
+                    # Если данные в base64
+                    image_data = base64.b64decode(image_data)
+                return GenerationOutcome.SUCCESS, image_data, None
+    
+    finish_reason = _enum_name(getattr(candidate, "finish_reason", None))
+    if finish_reason in _BLOCKED_REASONS:
+        return GenerationOutcome.BLOCKED, None, finish_reason
+    for rating in getattr(candidate, "safety_ratings", None) or []:
+        if getattr(rating, "blocked", False):
+            return GenerationOutcome.BLOCKED, None, f"safety:{_enum_name(rating.category)}"
+    if finish_reason in _MALFORMED_REASONS:
+        # Например, модель ответила только текстом
+        return GenerationOutcome.MALFORMED, None, finish_reason
+    # OTHER / UNSPECIFIED без изображения - сбой на стороне модели
+    return GenerationOutcome.TRANSIENT, None, finish_reason or "empty_response"
+
+
+def classify_error(error: Exception) -> Tuple[str, str]:
+    """Итог по исключению вызова модели: (GenerationOutcome, класс ошибки)"""
+    name = type(error).__name__
+    if isinstance(error, (ResourceExhausted, TooManyRequests, QuotaTimeout)):
+        return GenerationOutcome.QUOTA, name
+    if isinstance(error, _NON_RETRYABLE_ERRORS):
+        return GenerationOutcome.MALFORMED, name
+    # 5xx, таймауты, обрывы соединения, открытый предохранитель и неизвестные ошибки
+    return GenerationOutcome.TRANSIENT, name
+
+
+class _SlotLease:
+    """Занятый слот режима и вызов модели в потоке, выполняемый под ним"""
+    
+    def __init__(self):
+        self.future: Optional[Future] = None
+
+
+class ModeExecutor:
+    """
+    Выделенный пул потоков и лимит параллельности для одного режима генерации.
+    Запросы сверх лимита ждут на семафоре (а не в скрытой очереди executor),
+    поэтому глубина очереди и время ожидания видны в метриках.
+    Отмена ожидающего (срок, проигравший hedge) не останавливает поток с вызовом
+    модели - слот освобождается, только когда поток закончит (orphaned в метриках).
+    """
+    
+    # Сколько последних ожиданий учитывать в статистике
+    WAIT_WINDOW = 500
+    
+    def __init__(self, mode: str, workers: int, concurrency: int):
+        self.mode = mode
+        self.workers = workers
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix=f"vertex-{mode}"
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+        
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        # Потоки, которые ещё выполняют вызовы уже отменённых запросов
+        self.orphaned = 0
+        self.orphaned_total = 0
+        self._waits = deque(maxlen=self.WAIT_WINDOW)
+    
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[_SlotLease]:
+        """Занять слот режима на время одного вызова модели"""
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self._waits.append(time.monotonic() - started)
+        
+        lease = _SlotLease()
+        self.active += 1
+        try:
+            yield lease
+        finally:
+            self.active -= 1
+            self.completed += 1
+            future = lease.future
+            if future is not None and not future.done():
+                # Ожидающего отменили, а поток ещё занят вызовом: слот держится до его
+                # конца, иначе следующий запрос ждал бы в скрытой очереди executor
+                self.orphaned += 1
+                self.orphaned_total += 1
+                loop = asyncio.get_running_loop()
+                future.add_done_callback(lambda _: self._release_orphan(loop))
+            else:
+                self._semaphore.release()
+    
+    def has_free_slot(self) -> bool:
+        """Есть ли свободный слот (вызов не встанет в очередь режима)"""
+        return not self._semaphore.locked()
+    
+    def _release_orphan(self, loop: asyncio.AbstractEventLoop):
+        """Поток отменённого вызова закончил (вызывается из потока пула)"""
+        def release():
+            self.orphaned -= 1
+            self._semaphore.release()
+        try:
+            loop.call_soon_threadsafe(release)
+        except RuntimeError:
+            # Event loop уже закрыт (остановка инстанса)
+            pass
+    
+    async def run(self, func: Callable[[], Any], lease: Optional[_SlotLease] = None) -> Any:
+        """Выполнить блокирующий вызов в пуле режима (lease - слот, под которым он идёт)"""
+        future = self._executor.submit(func)
+        if lease is not None:
+            lease.future = future
+        return await asyncio.wrap_future(future)
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            "workers": self.workers,
+            "concurrency": self.concurrency,
+            "waiting": self.waiting,
+            "active": self.active,
+            "completed": self.completed,
+            "orphaned": self.orphaned,
+            "orphaned_total": self.orphaned_total,
+            "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+class _CachedContentRef:
+    """Ссылка на CachedContent для GenerativeModel (SDK читает только resource_name)"""
+    
+    def __init__(self, resource_name: str):
+        self.resource_name = resource_name
+
+
+class LocationClient:
+    """
+    Клиенты Vertex AI одного location.
+    Endpoint задаётся явно, модель создаётся по полному имени ресурса -
+    глобальный vertexai.init(location=...) не используется, поэтому
+    региональные и global модели вызываются параллельно без общего состояния SDK.
+    """
+    
+    SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+    
+    def __init__(self, project_id: str, location: str, credentials, backend: str = "thread"):
+        self.project_id = project_id
+        self.location = location
+        self.credentials = credentials
+        self.backend = backend
+        self._client = None
+        self._cache_client: Optional[GenAiCacheServiceClient] = None
+        self._models: Dict[Tuple[str, Optional[str]], GenerativeModel] = {}
+    
+    @property
+    def api_endpoint(self) -> str:
+        if self.location == "global":
+            return "aiplatform.googleapis.com"
+        return f"{self.location}-aiplatform.googleapis.com"
+    
+    def start(self):
+        """Создать клиент предсказаний (gRPC канал) для location"""
+        if self._client is not None:
+            return
+        client_options = ClientOptions(api_endpoint=self.api_endpoint)
+        if self.backend == "async":
+            self._client = PredictionServiceAsyncClient(
+                credentials=self.credentials,
+                client_options=client_options
+            )
+        else:
+            self._client = PredictionServiceClient(
+                credentials=self.credentials,
+                client_options=client_options
+            )
+        logger.info(f"Vertex AI client ready for {self.location} ({self.api_endpoint})")
+    
+    def model_resource(self, model_name: str) -> str:
+        return (
+            f"projects/{self.project_id}/locations/{self.location}"
+            f"/publishers/google/models/{model_name}"
+        )
+    
+    def get_model(self, model_name: str, cached_content: Optional[str] = None) -> GenerativeModel:
+        """
+        Модель по полному имени ресурса с клиентом этого location
+        cached_content - имя CachedContent, который станет префиксом каждого запроса
+        """
+        key = (model_name, cached_content)
+        if key not in self._models:
+            self.start()
+            model = GenerativeModel(self.model_resource(model_name))
+            # Клиенты GenerativeModel - cached_property: подставляем свой,
+            # иначе SDK создаст клиент из глобальной конфигурации
+            if self.backend == "async":
+                model._prediction_async_client = self._client
+            else:
+                model._prediction_client = self._client
+            if cached_content:
+                # Как в GenerativeModel.from_cached_content, но без запроса CachedContent.get
+                model._cached_content = _CachedContentRef(cached_content)
+            self._models[key] = model
+        return self._models[key]
+    
+    def _get_cache_client(self) -> GenAiCacheServiceClient:
+        if self._cache_client is None:
+            self._cache_client = GenAiCacheServiceClient(
+                credentials=self.credentials,
+                client_options=ClientOptions(api_endpoint=self.api_endpoint)
+            )
+        return self._cache_client
+    
+    def create_cached_content(self, model_name: str, compiled: CompiledPrompt, ttl: int) -> str:
+        """Зарегистрировать промпт стиля как CachedContent (синхронный вызов)"""
+        cached_content = GapicCachedContent(
+            model=self.model_resource(model_name),
+            display_name=f"style-{compiled.style_id}-{compiled.version}",
+            contents=[GapicContent(role="user", parts=[GapicPart(text=compiled.prompt)])],
+            ttl=duration_pb2.Duration(seconds=ttl),
+        )
+        if compiled.system_instruction:
+            cached_content.system_instruction = GapicContent(
+                parts=[GapicPart(text=compiled.system_instruction)]
+            )
+        created = self._get_cache_client().create_cached_content(
+            parent=f"projects/{self.project_id}/locations/{self.location}",
+            cached_content=cached_content
+        )
+        return created.name
+    
+    def delete_cached_content(self, name: str):
+        self._get_cache_client().delete_cached_content(name=name)
+    
+    def close(self):
+        if self._client is not None and self.backend != "async":
+            self._client.transport.close()
+        if self._cache_client is not None:
+            self._cache_client.transport.close()
+        self._client = None
+        self._cache_client = None
+        self._models = {}
+
+
 class VertexAIService:
     """Сервис для работы с Vertex AI Gemini Image Generation"""
     
-    # Модели и их регионы
-    # Normal mode: regional endpoint (europe-west4)
+    # Модели и регионы-кандидаты (первый - предпочтительный)
+    # Normal mode: regional endpoints, запрос уходит в лучший по задержке и ошибкам
     # PRO mode: global endpoint (required for gemini-3-pro-image-preview)
     MODELS = {
         "normal": {
             "name": "gemini-2.5-flash-image",
-            "location": "europe-west4"  # Regional endpoint
+            "locations": ["europe-west4"]  # Regional endpoints
         },
         "pro": {
             "name": "gemini-3-pro-image-preview",
-            "location": "global"  # Global-only model
+            "locations": ["global"]  # Global-only model
         }
     }
     
     # Максимальное количество retry при ошибках
     MAX_RETRIES = 3
+    # Экспоненциальная пауза между попытками со случайным разбросом (full jitter)
     RETRY_DELAY = 2  # секунды
+    RETRY_MAX_DELAY = 10  # секунды
+    
+    # Оценка токенов на запрос (фото + промпт + изображение в ответе) для квоты TPM;
+    # после ответа поправляется по usage_metadata
+    TOKENS_PER_REQUEST = {"normal": 2000, "pro": 3000}
+    
+    # Размер пула потоков и лимит параллельных вызовов по режимам
+    DEFAULT_WORKERS = {"normal": 16, "pro": 8}
+    DEFAULT_CONCURRENCY = {"normal": 16, "pro": 8}
     
-    def __init__(self, project_id: str):
+    # Способ вызова модели:
+    # thread - синхронный generate_content в пуле потоков режима
+    # async - нативный generate_content_async (gRPC aio), без потоков
+    BACKENDS = ("thread", "async")
+    
+    def __init__(
+        self,
+        project_id: str,
+        workers: Optional[Dict[str, int]] = None,
+        concurrency: Optional[Dict[str, int]] = None,
+        backend: str = "thread",
+        result_cache: Optional[ResultCache] = None,
+        hedging: Optional[HedgePolicy] = None,
+        circuit_breakers: Optional[CircuitBreakerRegistry] = None,
+        locations: Optional[Dict[str, List[str]]] = None,
+        route_exploration: float = 0.05,
+        quota: Optional[QuotaGovernor] = None,
+        prompt_cache: Optional[PromptCache] = None
+    ):
         """
         Инициализация Vertex AI с ADC (Application Default Credentials)
         
         Args:
             project_id: ID проекта в Google Cloud
+            workers: Размер пула потоков по режимам (normal/pro)
+            concurrency: Лимит параллельных вызовов модели по режимам
+            backend: Способ вызова модели (thread или async)
+            result_cache: Кэш результатов генерации (None - без кэша)
+            hedging: Политика хеджирования вызовов модели (None - без хеджирования)
+            circuit_breakers: Предохранители по (модель, location) (None - без предохранителей)
+            locations: Регионы-кандидаты по режимам (по умолчанию - из MODELS)
+            route_exploration: Доля запросов в случайный регион-кандидат
+            quota: Общий регулятор квот RPM/TPM по моделям (None - без ограничения)
+            prompt_cache: Собранные промпты стилей и их context cache
         """
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown Vertex AI backend: {backend}")
+        
         self.project_id = project_id
+        self.backend = backend
+        self.result_cache = result_cache
+        self.hedging = hedging
+        self.circuit_breakers = circuit_breakers
+        self.quota = quota
+        self.prompt_cache = prompt_cache or PromptCache()
         
-        # Кэш моделей для переиспользования
-        self._models = {}
+        # Регионы-кандидаты моделей и маршрутизатор между ними
+        self._locations = {
+            mode: list((locations or {}).get(mode) or config["locations"])
+            for mode, config in self.MODELS.items()
+        }
+        self.router = RegionRouter(
+            {self.MODELS[mode]["name"]: mode_locations for mode, mode_locations in self._locations.items()},
+            exploration=route_exploration
+        )
+        
+        # Собственные пулы потоков для каждого режима вместо общего default executor
+        workers = {**self.DEFAULT_WORKERS, **(workers or {})}
+        concurrency = {**self.DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self._executors = {
+            mode: ModeExecutor(mode, workers[mode], concurrency[mode])
+            for mode in self.MODELS
+        }
         
-        # Отслеживание инициализированных locations
-        self._initialized_locations = set()
+        # Итоги генераций по (режим, GenerationOutcome) для метрик
+        self._outcomes: Counter = Counter()
         
-        logger.info(f"VertexAIService initialized for project {project_id}")
+        # Клиенты по location (создаются в warm_up или при первом обращении)
+        self._credentials = None
+        self._credentials_lock = asyncio.Lock()
+        self._clients: Dict[str, LocationClient] = {}
+        
+        logger.info(f"VertexAIService initialized for project {project_id} (backend: {backend})")
     
-    def _ensure_location_initialized(self, location: str):
-        """Убедиться что Vertex AI инициализирован для нужного location"""
-        if location not in self._initialized_locations:
-            vertexai.init(project=self.project_id, location=location)
-            self._initialized_locations.add(location)
-            logger.info(f"Initialized Vertex AI for location: {location}")
+    def _load_credentials(self):
+        """ADC (Application Default Credentials) с обновлённым токеном"""
+        if self._credentials is None:
+            credentials, _ = google.auth.default(scopes=LocationClient.SCOPES)
+            credentials.refresh(Request())
+            # GenerativeModel читает проект из глобальной конфигурации даже для полного
+            # имени ресурса; location глобально не задаётся - он у каждого клиента свой
+            vertexai.init(project=self.project_id, credentials=credentials)
+            self._credentials = credentials
+        return self._credentials
     
-    def _get_model(self, mode: str) -> GenerativeModel:
-        """Получить модель по режиму с правильным location"""
-        if mode not in self._models:
-            model_config = self.MODELS.get(mode, self.MODELS["normal"])
-            model_name = model_config["name"]
-            location = model_config["location"]
-            
-            # Инициализируем Vertex AI для нужного location
-            self._ensure_location_initialized(location)
-            
-            # Создаём модель
-            self._models[mode] = GenerativeModel(model_name)
-            logger.info(f"Loaded model {model_name} for mode '{mode}' in location '{location}'")
+    async def _ensure_credentials(self):
+        """
+        Загрузить учётные данные в потоке: refresh токена - синхронный HTTP-запрос,
+        в event loop он остановил бы все апдейты (путь без warm_up)
+        """
+        if self._credentials is None:
+            async with self._credentials_lock:
+                if self._credentials is None:
+                    await asyncio.to_thread(self._load_credentials)
+    
+    def _get_client(self, location: str) -> LocationClient:
+        """Клиент location (создаётся при первом обращении, если не было warm_up)"""
+        if location not in self._clients:
+            self._clients[location] = LocationClient(
+                self.project_id,
+                location,
+                self._load_credentials(),
+                backend=self.backend
+            )
+        return self._clients[location]
+    
+    async def warm_up(self):
+        """
+        Заранее создать клиенты всех location и модели всех режимов параллельно,
+        чтобы первый запрос не платил за авторизацию и создание канала
+        """
+        started = time.monotonic()
+        await self._ensure_credentials()
+        
+        locations = {
+            location
+            for mode_locations in self._locations.values()
+            for location in mode_locations
+        }
+        for location in locations:
+            self._get_client(location)
+        # Синхронный клиент создаём в потоке; async-клиент - в event loop
+        if self.backend == "async":
+            for location in locations:
+                self._clients[location].start()
+        else:
+            await asyncio.gather(*(
+                asyncio.to_thread(self._clients[location].start)
+                for location in locations
+            ))
+        
+        for mode, mode_locations in self._locations.items():
+            for location in mode_locations:
+                self._get_model(mode, location)
+        self.prompt_cache.compile_all(STYLES)
+        logger.info(
+            f"Vertex AI warmed up: {len(locations)} locations in {time.monotonic() - started:.2f}s"
+        )
+    
+    def _model_name(self, mode: str) -> str:
+        return self.MODELS.get(mode, self.MODELS["normal"])["name"]
+    
+    def _get_model(self, mode: str, location: str) -> GenerativeModel:
+        """Получить модель режима с клиентом нужного location"""
+        return self._get_client(location).get_model(self._model_name(mode))
+    
+    def _prepare_call(
+        self,
+        mode: str,
+        location: str,
+        contents: list,
+        prompt: Optional[CompiledPrompt]
+    ) -> Tuple[GenerativeModel, list, Optional[str]]:
+        """
+        Модель и содержимое запроса для location.
+        Если промпт стиля есть в context cache этого location - передаём только
+        contents со ссылкой на кэш, иначе промпт идёт текстом перед contents.
+        Возвращает (модель, содержимое, имя CachedContent или None).
+        """
+        client = self._get_client(location)
+        model_name = self._model_name(mode)
+        if prompt is None:
+            return client.get_model(model_name), contents, None
         
-        return self._models[mode]
+        cached_content = self.prompt_cache.lookup(
+            model_name,
+            location,
+            prompt,
+            create=lambda compiled, ttl: client.create_cached_content(model_name, compiled, ttl),
+            delete=client.delete_cached_content
+        )
+        if cached_content:
+            return client.get_model(model_name, cached_content), contents, cached_content
+        return client.get_model(model_name), [prompt.text, *contents], None
     
     def _get_generation_config(self) -> GenerationConfig:
         """Конфигурация для генерации изображений"""
@@ -83,57 +546,296 @@ class VertexAIService:
             max_output_tokens=8192,
         )
     
-    async def _generate_with_retry(
+    async def _call_model(
         self,
+        executor: ModeExecutor,
+        lease: _SlotLease,
         model: GenerativeModel,
         contents: list,
         generation_config: GenerationConfig
+    ):
+        """Один вызов модели через выбранный backend (под слотом lease)"""
+        if self.backend == "async":
+            # Ожидание ответа не занимает поток - держим сотни запросов в одном event loop
+            return await model.generate_content_async(
+                contents,
+                generation_config=generation_config
+            )
+        
+        # Запускаем синхронный вызов в пуле режима
+        return await executor.run(
+            lambda: model.generate_content(
+                contents,
+                generation_config=generation_config
+            ),
+            lease
+        )
+    
+    def _get_breaker(self, mode: str, location: str) -> Optional[CircuitBreaker]:
+        """Предохранитель endpoint (модель в location)"""
+        if self.circuit_breakers is None:
+            return None
+        return self.circuit_breakers.get(f"{self._model_name(mode)}@{location}")
+    
+    async def _call_in_slot(
+        self,
+        mode: str,
+        executor: ModeExecutor,
+        contents: list,
+        generation_config: GenerationConfig,
+        trace: Optional[GenerationTrace] = None,
+        prompt: Optional[CompiledPrompt] = None
+    ):
+        """
+        Вызов модели в слоте режима.
+        Регион выбирает маршрутизатор; при 429 или открытом предохранителе
+        запрос сразу уходит в следующий регион - попытка пользователя не тратится.
+        """
+        model_name = self._model_name(mode)
+        tried = set()
+        last_error: Optional[Exception] = None
+        
+        while True:
+            location = self.router.choose(model_name, exclude=tried)
+            if location is None:
+                raise last_error
+            tried.add(location)
+            
+            # Endpoint недоступен - не тратим на него ни квоту, ни слот
+            breaker = self._get_breaker(mode, location)
+            if breaker is not None and not breaker.allow():
+                last_error = CircuitOpenError(breaker.name, breaker.retry_in())
+                if trace is not None:
+                    trace.add_attempt(model_name, location, None, "circuit_open")
+                continue
+            
+            # Квота модели: ждём своей очереди вместо того, чтобы получить 429
+            tokens = self.TOKENS_PER_REQUEST.get(mode, self.TOKENS_PER_REQUEST["normal"])
+            if self.quota is not None:
+                try:
+                    await self.quota.acquire(
+                        model_name,
+                        location,
+                        tokens,
+                        on_position=trace.set_queue_position if trace is not None else None
+                    )
+                except BaseException as e:
+                    # Вызова не будет - пробный слот предохранителя освобождаем
+                    if breaker is not None:
+                        breaker.release()
+                    if isinstance(e, QuotaTimeout) and trace is not None:
+                        trace.add_attempt(model_name, location, None, "quota_timeout")
+                    raise
+            
+            def refund_quota():
+                """Запрос не ушёл в модель - квота возвращается в бакет"""
+                if self.quota is not None:
+                    self.quota.refund(model_name, location, tokens)
+            
+            try:
+                await self._ensure_credentials()
+                model, call_contents, cached_content = self._prepare_call(mode, location, contents, prompt)
+            except BaseException:
+                # Клиент региона не собрался (учётные данные, модель) - вызова не было,
+                # пробный слот предохранителя и квоту освобождаем
+                if breaker is not None:
+                    breaker.release()
+                refund_quota()
+                raise
+            started = None
+            try:
+                async with executor.slot() as lease:
+                    started = time.monotonic()
+                    response = await self._call_model(executor, lease, model, call_contents, generation_config)
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.release()
+                if started is None:
+                    # Отменён в ожидании слота (срок, проигравший hedge) - запрос не отправлен
+                    refund_quota()
+                raise
+            except (ResourceExhausted, TooManyRequests) as e:
+                # Квота региона исчерпана - это не отказ endpoint, переключаемся на другой регион
+                latency = time.monotonic() - started if started else None
+                if breaker is not None:
+                    breaker.release()
+                self.router.record(model_name, location, latency, "quota")
+                self._quota_feedback(model_name, location, tokens, quota_error=True)
+                if trace is not None:
+                    trace.add_attempt(model_name, location, latency, "quota")
+                last_error = e
+                continue
+            except Exception as e:
+                if cached_content is not None and isinstance(e, api_exceptions.NotFound):
+                    # Кэш промпта удалён или истёк раньше срока - повторяем в том же регионе с промптом текстом
+                    logger.warning(f"Context cache {cached_content} not found, falling back to full prompt")
+                    if breaker is not None:
+                        breaker.release()
+                    self.prompt_cache.invalidate(model_name, location, prompt.style_id)
+                    tried.discard(location)
+                    last_error = e
+                    continue
+                latency = time.monotonic() - started if started else None
+                if isinstance(e, _NON_RETRYABLE_ERRORS):
+                    # Ошибка запроса (аргументы, права, модель), а не отказ endpoint -
+                    # на здоровье региона не влияет
+                    if breaker is not None:
+                        breaker.release()
+                else:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    self.router.record(model_name, location, latency, "error")
+                if trace is not None:
+                    trace.add_attempt(model_name, location, latency, "error")
+                raise
+            
+            latency = time.monotonic() - started
+            self._quota_feedback(model_name, location, tokens, response=response)
+            if breaker is not None:
+                breaker.record_success(latency)
+            if self.hedging is not None:
+                # Порог хеджа - по длительности самого вызова, без ожидания квоты и слота
+                self.hedging.record_latency(model_name, latency)
+            self.router.record(model_name, location, latency, "ok")
+            if trace is not None:
+                trace.add_attempt(model_name, location, latency, "ok")
+            logger.info(f"{model_name} answered from {location} in {latency:.1f}s")
+            return response
+    
+    def _quota_feedback(
+        self,
+        model_name: str,
+        location: str,
+        estimated_tokens: int,
+        response=None,
+        quota_error: bool = False
+    ):
+        """Адаптация квоты региона: 429 снижает скорость, успех - восстанавливает и уточняет токены"""
+        bucket = self.quota.bucket(model_name, location) if self.quota is not None else None
+        if bucket is None:
+            return
+        if quota_error:
+            bucket.on_quota_error()
+            return
+        bucket.on_success()
+        usage = getattr(response, "usage_metadata", None)
+        total_tokens = getattr(usage, "total_token_count", 0) if usage else 0
+        if total_tokens:
+            bucket.adjust(total_tokens - estimated_tokens)
+    
+    async def _call_with_hedging(
+        self,
+        mode: str,
+        executor: ModeExecutor,
+        contents: list,
+        generation_config: GenerationConfig,
+        trace: Optional[GenerationTrace] = None,
+        prompt: Optional[CompiledPrompt] = None
+    ):
+        """Вызов модели; при включенном хеджировании - с запасным запросом по хвосту задержек"""
+        if self.hedging is None:
+            return await self._call_in_slot(mode, executor, contents, generation_config, trace, prompt)
+        
+        return await self.hedging.run(
+            mode,
+            self._model_name(mode),
+            lambda: self._call_in_slot(mode, executor, contents, generation_config, trace, prompt),
+            has_capacity=executor.has_free_slot
+        )
+    
+    def _retry_delay(self, attempt: int) -> float:
+        """Экспоненциальная пауза с full jitter: попытки разных запросов не синхронизируются"""
+        return random.uniform(0, min(self.RETRY_DELAY * 2 ** attempt, self.RETRY_MAX_DELAY))
+    
+    async def _generate_with_retry(
+        self,
+        mode: str,
+        contents: list,
+        generation_config: GenerationConfig,
+        trace: Optional[GenerationTrace] = None,
+        deadline: Optional[Deadline] = None,
+        prompt: Optional[CompiledPrompt] = None
     ) -> Optional[bytes]:
-        """Генерация с retry-логикой"""
-        last_error = None
+        """
+        Генерация с retry-логикой.
+        С дедлайном каждая попытка (включая ожидание квоты и слота) ограничена
+        оставшимся временем; зависший вызов в пуле потоков остаётся доработать
+        в фоне, его результат отбрасывается.
+        prompt - промпт стиля, который идёт перед contents (текстом или из context cache).
+        """
+        executor = self._executors.get(mode, self._executors["normal"])
+        outcome, detail = GenerationOutcome.TRANSIENT, None
         
         for attempt in range(self.MAX_RETRIES):
             try:
-                # Запускаем синхронный вызов в executor
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(
-                    None,
-                    lambda: model.generate_content(
-                        contents,
-                        generation_config=generation_config
-                    )
-                )
+                call = self._call_with_hedging(mode, executor, contents, generation_config, trace, prompt)
+                if deadline is not None:
+                    response = await deadline.run("generate", call)
+                else:
+                    response = await call
+                outcome, image_data, detail = classify_response(response)
                 
-                # Извлекаем изображение из ответа
-                if response.candidates and response.candidates[0].content.parts:
-                    for part in response.candidates[0].content.parts:
-                        # Проверяем наличие inline_data (изображение)
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            image_data = part.inline_data.data
-                            if isinstance(image_data, str):
-                                # Если данные в base64
-                                return base64.b64decode(image_data)
-                            return image_data
+            except DeadlineExceeded:
+                logger.warning(f"Generation deadline exceeded (attempt {attempt + 1}), result will be discarded")
+                self._record_outcome(mode, trace, GenerationOutcome.DEADLINE, "deadline")
+                raise
                 
-                # Если изображение не найдено в ответе
-                logger.warning(f"No image in response (attempt {attempt + 1})")
+            except (CircuitOpenError, QuotaTimeout) as e:
+                # Fail fast: энергия вернётся сразу, без ожидания retry
+                # (повтор после QuotaTimeout только удлинил бы очередь)
+                logger.warning(f"Generation rejected: {e}")
+                outcome, detail = classify_error(e)
+                self._record_outcome(mode, trace, outcome, detail)
+                return None
                 
             except Exception as e:
-                last_error = e
-                logger.error(f"Generation error (attempt {attempt + 1}/{self.MAX_RETRIES}): {e}")
-                
-                if attempt < self.MAX_RETRIES - 1:
-                    await asyncio.sleep(self.RETRY_DELAY * (attempt + 1))
+                outcome, detail = classify_error(e)
+                image_data = None
+                logger.error(
+                    f"Generation error (attempt {attempt + 1}/{self.MAX_RETRIES}, {outcome}): {e}"
+                )
+            
+            if outcome == GenerationOutcome.SUCCESS:
+                self._record_outcome(mode, trace, outcome, detail)
+                return image_data
+            
+            if outcome not in GenerationOutcome.RETRYABLE:
+                # Блокировка, ответ без изображения, квота - повтор не поможет
+                logger.warning(f"Generation failed without retry: {outcome} ({detail})")
+                break
+            
+            logger.warning(f"Transient generation failure (attempt {attempt + 1}): {detail}")
+            if attempt < self.MAX_RETRIES - 1:
+                if deadline is not None:
+                    # Повтор не успеет - не ждём зря
+                    await deadline.sleep("retry", self._retry_delay(attempt))
+                else:
+                    await asyncio.sleep(self._retry_delay(attempt))
         
-        if last_error:
-            logger.error(f"All retry attempts failed: {last_error}")
+        self._record_outcome(mode, trace, outcome, detail)
         return None
     
+    def _record_outcome(
+        self,
+        mode: str,
+        trace: Optional[GenerationTrace],
+        outcome: str,
+        detail: Optional[str]
+    ):
+        self._outcomes[(mode, outcome)] += 1
+        if trace is not None:
+            trace.set_outcome(outcome, detail)
+    
     async def generate_single(
         self, 
         photo_bytes: bytes, 
         style_id: str,
-        mode: str = "normal"
+        mode: str = "normal",
+        photo_key: Optional[str] = None,
+        use_cache: bool = True,
+        mime_type: str = "image/jpeg",
+        trace: Optional[GenerationTrace] = None,
+        deadline: Optional[Deadline] = None
     ) -> Optional[bytes]:
         """
         Генерация одного изображения
@@ -142,6 +844,12 @@ class VertexAIService:
             photo_bytes: Исходное фото в байтах
             style_id: ID стиля
             mode: Режим генерации (normal или pro)
+            photo_key: Стабильный идентификатор фото для кэша
+                (например file_unique_id), по умолчанию - хэш photo_bytes
+            use_cache: Использовать кэш результатов
+            mime_type: MIME-тип исходного фото
+            trace: Куда записать попытки вызова модели (регионы, задержки)
+            deadline: Срок генерации (при истечении - DeadlineExceeded)
             
         Returns:
             Сгенерированное изображение в байтах или None при ошибке
@@ -153,39 +861,120 @@ class VertexAIService:
                 logger.error(f"Style not found: {style_id}")
                 return None
             
-            # Получаем модель
-            model = self._get_model(mode)
+            # Проверяем кэш результатов (стили могут отключить кэш через cache_results)
+            cache_key = None
+            if use_cache and self.result_cache and style.get("cache_results", True):
+                cache_key = ResultCache.make_key(
+                    photo_key or ResultCache.hash_photo(photo_bytes),
+                    style_id,
+                    mode,
+                    get_prompt_version(style)
+                )
+                cached = await self.result_cache.get(cache_key)
+                if cached:
+                    logger.info(f"Result cache hit for style '{style_id}' in mode '{mode}'")
+                    if trace is not None:
+                        trace.cache_hit = True
+                    return cached
             
             # Создаём Part из изображения пользователя
-            image_part = Part.from_data(photo_bytes, mime_type="image/jpeg")
-            
-            # Формируем промпт для трансформации
-            prompt = style["prompt"]
-            
-            # Добавляем системные инструкции если есть
-            system_instruction = style.get("system_instruction", "")
-            if system_instruction:
-                prompt = f"{system_instruction}\n\n{prompt}"
+            image_part = Part.from_data(photo_bytes, mime_type=mime_type)
             
-            # Собираем контент для модели
-            contents = [prompt, image_part]
+            # Промпт с системной инструкцией собирается один раз на версию стиля
+            prompt = self.prompt_cache.compile(style)
             
             # Генерируем с retry
             result = await self._generate_with_retry(
-                model=model,
-                contents=contents,
-                generation_config=self._get_generation_config()
+                mode=mode,
+                contents=[image_part],
+                generation_config=self._get_generation_config(),
+                trace=trace,
+                deadline=deadline,
+                prompt=prompt
             )
             
             if result:
                 logger.info(f"Successfully generated image for style '{style_id}' in mode '{mode}'")
+                if cache_key:
+                    await self.result_cache.set(cache_key, result)
             
             return result
             
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error in generate_single: {e}", exc_info=True)
             return None
     
+    async def iter_batch(
+        self,
+        photo_bytes: bytes,
+        style_id: str,
+        count: int = 1,
+        mode: str = "normal",
+        mime_type: str = "image/jpeg",
+        limiter: Optional[asyncio.Semaphore] = None,
+        trace: Optional[GenerationTrace] = None,
+        deadline: Optional[Deadline] = None
+    ) -> AsyncIterator[Tuple[int, Optional[bytes]]]:
+        """
+        Batch-генерация с выдачей результатов по мере готовности
+        
+        Args:
+            photo_bytes: Исходное фото в байтах
+            style_id: ID стиля
+            count: Количество генераций (макс 5)
+            mode: Режим генерации (normal или pro)
+            mime_type: MIME-тип исходного фото
+            limiter: Ограничение числа одновременных генераций
+                (например, общий лимит пользователя)
+            trace: Куда записать попытки вызова модели всех вариантов
+            deadline: Срок генерации всех вариантов (не успевшие варианты - None)
+            
+        Yields:
+            (номер варианта, изображение в байтах или None при ошибке)
+        """
+        # Ограничиваем количество параллельных генераций
+        count = min(count, 5)
+        
+        logger.info(f"Starting batch generation: {count} images, style={style_id}, mode={mode}")
+        
+        async def generate_item(index: int):
+            # Без кэша - иначе все варианты будут одинаковыми
+            def generate():
+                return self.generate_single(
+                    photo_bytes, style_id, mode,
+                    use_cache=False, mime_type=mime_type, trace=trace, deadline=deadline
+                )
+            try:
+                if limiter is not None:
+                    async with limiter:
+                        result = await generate()
+                else:
+                    result = await generate()
+            except Exception as e:
+                logger.error(f"Batch item {index + 1} failed: {e}")
+                result = None
+            if result is None:
+                logger.warning(f"Batch item {index + 1} returned no image")
+            return index, result
+        
+        tasks = [asyncio.create_task(generate_item(i)) for i in range(count)]
+        successful = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, result = await next_done
+                if result is not None:
+                    successful += 1
+                yield index, result
+        finally:
+            # Потребитель прервал итерацию - оставшиеся генерации не нужны
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        
+        logger.info(f"Batch generation complete: {successful}/{count} successful")
+    
     async def generate_batch(
         self, 
         photo_bytes: bytes, 
@@ -205,33 +994,33 @@ class VertexAIService:
         Returns:
             Список сгенерированных изображений в байтах
         """
-        # Ограничиваем количество параллельных генераций
-        count = min(count, 5)
-        
-        logger.info(f"Starting batch generation: {count} images, style={style_id}, mode={mode}")
-        
-        # Создаём задачи для параллельной генерации
-        tasks = [
-            self.generate_single(photo_bytes, style_id, mode)
-            for _ in range(count)
-        ]
-        
-        # Выполняем параллельно
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Фильтруем успешные результаты
-        successful_results = []
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                logger.error(f"Batch item {i + 1} failed: {result}")
-            elif result is not None:
-                successful_results.append(result)
-            else:
-                logger.warning(f"Batch item {i + 1} returned None")
+        results = {}
+        async for index, result in self.iter_batch(photo_bytes, style_id, count, mode):
+            if result is not None:
+                results[index] = result
         
-        logger.info(f"Batch generation complete: {len(successful_results)}/{count} successful")
-        
-        return successful_results
+        # Сохраняем исходный порядок вариантов
+        return [results[index] for index in sorted(results)]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики очередей к моделям и итоги генераций по режимам"""
+        stats = {}
+        for mode, executor in self._executors.items():
+            stats[mode] = executor.get_stats()
+            stats[mode]["outcomes"] = {
+                outcome: count
+                for (outcome_mode, outcome), count in self._outcomes.items()
+                if outcome_mode == mode
+            }
+        return stats
+    
+    def shutdown(self):
+        """Остановить пулы потоков и закрыть клиенты"""
+        for executor in self._executors.values():
+            executor.shutdown()
+        for client in self._clients.values():
+            client.close()
+        self._clients = {}
 
 
 # Синглтон для переиспользования
@@ -242,11 +1031,63 @@ def get_vertex_service(project_id: str) -> VertexAIService:
     """Получить инстанс Vertex AI сервиса (синглтон)"""
     global _vertex_service
     if _vertex_service is None:
-        _vertex_service = VertexAIService(project_id)
+        from bot.config import get_settings
+        settings = get_settings()
+        _vertex_service = VertexAIService(
+            project_id,
+            workers={
+                "normal": settings.vertex_normal_workers,
+                "pro": settings.vertex_pro_workers,
+            },
+            concurrency={
+                "normal": settings.vertex_normal_concurrency,
+                "pro": settings.vertex_pro_concurrency,
+            },
+            backend=settings.vertex_backend,
+            result_cache=get_result_cache(),
+            hedging=HedgePolicy(
+                percentile=settings.vertex_hedge_percentile,
+                budget=settings.vertex_hedge_budget,
+                # Вызов в пуле потоков не отменить - проигравший запрос дорабатывает
+                cancel_loser=settings.vertex_backend == "async"
+            ) if settings.vertex_hedge_enabled else None,
+            circuit_breakers=CircuitBreakerRegistry(
+                error_rate=settings.vertex_breaker_error_rate,
+                slow_call_seconds=settings.vertex_breaker_slow_seconds,
+                open_seconds=settings.vertex_breaker_open_seconds
+            ) if settings.vertex_breaker_enabled else None,
+            locations={
+                "normal": [
+                    location.strip()
+                    for location in settings.vertex_normal_locations.split(",")
+                    if location.strip()
+                ],
+            },
+            route_exploration=settings.vertex_route_exploration,
+            quota=get_quota_governor() if settings.vertex_quota_enabled else None,
+            prompt_cache=PromptCache(
+                models=[
+                    model.strip()
+                    for model in settings.vertex_context_cache_models.split(",")
+                    if model.strip()
+                ],
+                min_tokens=settings.vertex_context_cache_min_tokens,
+                ttl_seconds=settings.vertex_context_cache_ttl_seconds
+            )
+        )
+        register_stats_provider("vertex", _vertex_service.get_stats)
+        register_stats_provider("vertex_regions", _vertex_service.router.get_stats)
+        register_stats_provider("prompt_cache", _vertex_service.prompt_cache.get_stats)
+        if _vertex_service.hedging is not None:
+            register_stats_provider("vertex_hedging", _vertex_service.hedging.get_stats)
+        if _vertex_service.circuit_breakers is not None:
+            register_stats_provider("vertex_breakers", _vertex_service.circuit_breakers.get_stats)
     return _vertex_service
 
 
 def reset_vertex_service():
     """Сбросить синглтон (для тестирования)"""
     global _vertex_service
+    if _vertex_service is not None:
+        _vertex_service.shutdown()
     _vertex_service = None
@@ -1,3 +1,5 @@
+import hashlib
+
 # Данные о стилях фотосессий
 # В продакшене можно хранить в БД или загружать из CMS
 
@@ -35,6 +37,7 @@ Photorealistic. Preserve original color grading; only minimal coolness shift cau
 CONSTRAINTS (NO):
 No face change, no body reshaping, no new person, no extra limbs/fingers, no plastic skin, no anime/cartoon, no painterly look, no blur on the face, no text, no watermark, no logos.""",
         "system_instruction": DEFAULT_SYSTEM_INSTRUCTION,
+        "cache_results": True,  # False - не кэшировать результат (стили, где важна вариативность)
     },
     {
         "id": "winter_triptych",
@@ -59,6 +62,7 @@ Soft overcast daylight in outdoor frames; warm practical interior light in car f
 CONSTRAINTS (NO):
 No face change, no different person, no extra limbs/fingers, no stylization (no illustration), no text, no watermark, no logos.""",
         "system_instruction": DEFAULT_SYSTEM_INSTRUCTION,
+        "cache_results": True,  # False - не кэшировать результат (стили, где важна вариативность)
     },
     {
         "id": "placeholder_3",
@@ -108,3 +112,9 @@ def get_style_by_id(style_id: str):
 def get_all_style_ids():
     """Получить все ID стилей"""
     return [s["id"] for s in STYLES]
+
+
+def get_prompt_version(style: dict) -> str:
+    """Версия промпта стиля (меняется при любом изменении prompt/system_instruction)"""
+    raw = f"{style.get('system_instruction', '')}\n\n{style.get('prompt', '')}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:12]
@@ -0,0 +1,92 @@
+"""
+Benchmark of the input photo ingestion stage
+Измеряет время и размер результата normalize_photo для каждого режима:
+в текущем процессе и через пул процессов (как в боте).
+
+Run: python -m scripts.benchmark_ingest [photo.jpg ...] [--runs 20] [--workers 2]
+Без файлов используется синтетическое фото 3000x4000 с EXIF-ориентацией.
+"""
+import argparse
+import asyncio
+import io
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from PIL import Image
+
+from bot.services.image_ops import normalize_photo
+from bot.services.photo_ingest import PhotoIngestor
+
+
+def make_synthetic_photo(width: int = 3000, height: int = 4000) -> bytes:
+    """Синтетическое «фото с телефона»: шум + градиент, EXIF Orientation=6"""
+    noise = Image.effect_noise((width, height), 64).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    img = Image.blend(noise, gradient, 0.5)
+
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: повернуть на 90°
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=95, exif=exif)
+    return buffer.getvalue()
+
+
+def bench_inline(data: bytes, max_side: int, max_bytes: int, runs: int):
+    timings = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = normalize_photo(data, max_side, max_bytes)
+        timings.append(time.perf_counter() - started)
+    return timings, result
+
+
+async def bench_pool(data: bytes, max_side: int, max_bytes: int, runs: int, workers: int) -> float:
+    """Пропускная способность пула: runs задач параллельно, фото/сек"""
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Прогрев процессов
+        await asyncio.gather(*[
+            loop.run_in_executor(pool, normalize_photo, data, max_side, max_bytes)
+            for _ in range(workers)
+        ])
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            loop.run_in_executor(pool, normalize_photo, data, max_side, max_bytes)
+            for _ in range(runs)
+        ])
+        return runs / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark photo ingestion")
+    parser.add_argument("photos", nargs="*", help="Paths to input photos")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-bytes", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    inputs = []
+    for path in args.photos:
+        with open(path, "rb") as f:
+            inputs.append((path, f.read()))
+    if not inputs:
+        inputs.append(("synthetic 3000x4000", make_synthetic_photo()))
+
+    for name, data in inputs:
+        print(f"\n=== {name}: {len(data)} bytes ===")
+        for mode, max_side in PhotoIngestor.DEFAULT_TARGET_SIDE.items():
+            timings, (out, width, height) = bench_inline(data, max_side, args.max_bytes, args.runs)
+            throughput = asyncio.run(bench_pool(data, max_side, args.max_bytes, args.runs, args.workers))
+            print(
+                f"[{mode:6}] -> {len(out)} bytes ({len(out) / len(data):.1%}), {width}x{height} | "
+                f"inline median {statistics.median(timings) * 1000:.1f} ms, "
+                f"max {max(timings) * 1000:.1f} ms | "
+                f"pool x{args.workers}: {throughput:.1f} photos/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
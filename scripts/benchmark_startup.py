@@ -0,0 +1,168 @@
+"""
+Benchmark of the bot cold start
+Запускает бота (python -m bot.main) в отдельном процессе и измеряет:
+    ready         - от запуска процесса до первого ответа /health (порт открыт после init_bot)
+    first_webhook - от запуска процесса до первого 200 на POST /webhook
+и забирает из /stats длительности этапов startup.* и warm_up.* (бот запускается
+со случайным STATS_TOKEN, который передаётся в заголовке X-Stats-Token).
+
+Run: python -m scripts.benchmark_startup [--runs 5] [--output startup.jsonl] [--env KEY=VALUE ...]
+По умолчанию бот запускается с фиктивным токеном, FSM в памяти и без отметок
+апдейтов в Firestore; --env переопределяет переменные окружения (например, для
+замера с настоящими GCP-учётными данными). Результаты с --output дописываются
+построчно в JSON, чтобы сравнивать старт между изменениями.
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+# Минимальный апдейт: текстовое сообщение /start
+WEBHOOK_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Benchmark"},
+        "text": "/start",
+    },
+}
+
+DEFAULT_ENV = {
+    "BOT_TOKEN": "123456:benchmark",
+    "GCP_PROJECT_ID": "benchmark",
+    "FSM_STORAGE": "memory",
+    "UPDATES_DEDUP_SHARED": "false",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for(session: aiohttp.ClientSession, method: str, url: str, timeout: float, **kwargs) -> float:
+    """Опрашивать URL до ответа 200; возвращает момент ответа (time.monotonic)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status == 200:
+                    return time.monotonic()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"No 200 from {url} in {timeout:.0f}s")
+
+
+async def fetch_stages(session: aiohttp.ClientSession, base_url: str, stats_token: str, wait_warm_up: float) -> dict:
+    """Этапы startup.* и warm_up.* из /stats (warm_up ждём, пока не появится)"""
+    deadline = time.monotonic() + wait_warm_up
+    headers = {"X-Stats-Token": stats_token}
+    stages = {}
+    while True:
+        async with session.get(f"{base_url}/stats", headers=headers) as response:
+            response.raise_for_status()
+            pipeline = (await response.json()).get("pipeline", {})
+        stages = {
+            key: value["avg_ms"]
+            for key, value in pipeline.items()
+            if key.startswith(("startup.", "warm_up."))
+        }
+        if "warm_up.total" in stages or time.monotonic() > deadline:
+            return stages
+        await asyncio.sleep(0.1)
+
+
+async def run_once(env: dict, timeout: float, wait_warm_up: float) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    # Токен из --env, иначе одноразовый на запуск
+    stats_token = env.get("STATS_TOKEN") or secrets.token_hex(16)
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bot.main"],
+        env={**os.environ, **env, "PORT": str(port), "STATS_TOKEN": stats_token},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        async with aiohttp.ClientSession() as session:
+            ready = await wait_for(session, "GET", f"{base_url}/health", timeout)
+            first_webhook = await wait_for(
+                session, "POST", f"{base_url}/webhook", timeout, json=WEBHOOK_UPDATE
+            )
+            stages = await fetch_stages(session, base_url, stats_token, wait_warm_up)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    return {
+        "ready_ms": round((ready - started) * 1000, 1),
+        "first_webhook_ms": round((first_webhook - started) * 1000, 1),
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot cold start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Max seconds to wait for readiness")
+    parser.add_argument("--wait-warm-up", type=float, default=30.0, help="Max seconds to wait for warm_up stages")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--label", default="", help="Label stored with the results (e.g. git revision)")
+    parser.add_argument("--output", help="Append results as a JSON line to this file")
+    args = parser.parse_args()
+
+    env = dict(DEFAULT_ENV)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    runs = []
+    for i in range(args.runs):
+        result = asyncio.run(run_once(env, args.timeout, args.wait_warm_up))
+        runs.append(result)
+        print(
+            f"run {i + 1}: ready {result['ready_ms']:.0f} ms, "
+            f"first webhook {result['first_webhook_ms']:.0f} ms"
+        )
+
+    first_webhook = sorted(run["first_webhook_ms"] for run in runs)
+    ready = sorted(run["ready_ms"] for run in runs)
+    summary = {
+        "label": args.label,
+        "runs": args.runs,
+        "ready_median_ms": statistics.median(ready),
+        "first_webhook_median_ms": statistics.median(first_webhook),
+        "first_webhook_max_ms": first_webhook[-1],
+        # Этапы последнего запуска (в процессе бота каждый этап замерен один раз)
+        "stages": runs[-1]["stages"],
+    }
+
+    print(f"\nready median {summary['ready_median_ms']:.0f} ms, "
+          f"first webhook median {summary['first_webhook_median_ms']:.0f} ms "
+          f"(max {summary['first_webhook_max_ms']:.0f} ms)")
+    for stage, duration in sorted(summary["stages"].items()):
+        print(f"  {stage:28} {duration:8.1f} ms")
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**summary, "timestamp": time.time()}) + "\n")
+
+
+if __name__ == "__main__":
+    main()